@@ -0,0 +1,570 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Collection, Dict, List, Optional, Tuple
+
+from models import QuestionListResponse, LessonResponse
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+CACHE_DB_PATH = os.getenv("CACHE_DB_PATH", "cache/lessongenie.sqlite3")
+PAPER_CACHE_TTL_SECONDS = int(os.getenv("PAPER_CACHE_TTL_SECONDS", str(7 * 24 * 3600))) # How long a question list is kept
+PAPER_CACHE_MAX_ENTRIES = int(os.getenv("PAPER_CACHE_MAX_ENTRIES", "1000"))
+# The File API keeps uploads for ~48h; stop reusing a file a little before that.
+GEMINI_FILE_VALIDITY_SECONDS = int(os.getenv("GEMINI_FILE_VALIDITY_SECONDS", str(47 * 3600)))
+FILE_LEASE_SECONDS = int(os.getenv("FILE_LEASE_SECONDS", str(2 * 3600))) # Idle time after which an upload is deleted
+LESSON_CACHE_MEMORY_ENTRIES = int(os.getenv("LESSON_CACHE_MEMORY_ENTRIES", "256"))
+LESSON_CACHE_TTL_SECONDS = int(os.getenv("LESSON_CACHE_TTL_SECONDS", str(30 * 24 * 3600)))
+LESSON_CACHE_SYNC_SECONDS = 1.0 # How often the in-process tier checks for purges made by other workers
+CACHE_DB_BUSY_TIMEOUT_MS = int(os.getenv("CACHE_DB_BUSY_TIMEOUT_MS", "5000")) # Wait for other workers' writes
+# The same wait for writes made on the event loop thread, which stalls every request while it lasts
+CACHE_DB_LOOP_BUSY_TIMEOUT_MS = int(os.getenv("CACHE_DB_LOOP_BUSY_TIMEOUT_MS", "50"))
+
+
+def _on_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+class _Connection(sqlite3.Connection):
+    """ Sets the busy timeout of each transaction by the thread that opens it (see CACHE_DB_LOOP_BUSY_TIMEOUT_MS). """
+
+    def __enter__(self):
+        busy_timeout_ms = CACHE_DB_LOOP_BUSY_TIMEOUT_MS if _on_event_loop() else CACHE_DB_BUSY_TIMEOUT_MS
+        self.execute(f"PRAGMA busy_timeout = {busy_timeout_ms}")
+        return super().__enter__()
+
+
+def is_busy(error: Exception) -> bool:
+    """ True if a write failed because another worker held the database for longer than the busy timeout. """
+    return isinstance(error, sqlite3.OperationalError) and "locked" in str(error)
+
+
+def connect(db_path: str = CACHE_DB_PATH) -> sqlite3.Connection:
+    """
+    Opens the shared cache database, creating its directory if needed. WAL mode
+    lets every worker process read while one writes. Writes from the event loop
+    thread only wait briefly for another worker's write; callers either treat
+    them as best-effort or make them from a worker thread.
+    """
+    if db_path != ":memory:":
+        pathlib.Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=CACHE_DB_BUSY_TIMEOUT_MS / 1000, factory=_Connection)
+    conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA busy_timeout = {CACHE_DB_BUSY_TIMEOUT_MS}")
+    if db_path != ":memory:":
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL") # Safe with WAL; a crash loses at most the last commits
+    return conn
+
+
+# --- Paper Index (content-addressed uploads + question lists) ---
+
+class PaperIndex:
+    """
+    Maps the SHA-256 digest of an uploaded PDF to its extracted question list and
+    the Gemini File API name it was uploaded under, so identical papers are only
+    uploaded and analysed once. Also records uploads of page ranges of a paper.
+    on_evict is called with the digests of evicted papers.
+    """
+
+    def __init__(self, db_path: str = CACHE_DB_PATH,
+                 ttl_seconds: int = PAPER_CACHE_TTL_SECONDS,
+                 max_entries: int = PAPER_CACHE_MAX_ENTRIES,
+                 file_validity_seconds: int = GEMINI_FILE_VALIDITY_SECONDS,
+                 on_evict: Optional[Callable[[List[str]], None]] = None):
+        self.on_evict = on_evict
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.file_validity_seconds = file_validity_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = connect(db_path)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS papers ("
+                " digest TEXT PRIMARY KEY,"
+                " file_name TEXT,"
+                " file_uploaded_at REAL,"
+                " questions_json TEXT NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " last_used REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS papers_file_name ON papers (file_name)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS page_slices ("
+                " digest TEXT NOT NULL,"
+                " page_start INTEGER NOT NULL,"
+                " page_end INTEGER NOT NULL,"
+                " file_name TEXT NOT NULL,"
+                " uploaded_at REAL NOT NULL,"
+                " PRIMARY KEY (digest, page_start, page_end))"
+            )
+
+    def lookup(self, digest: str) -> Tuple[Optional[QuestionListResponse], Optional[str]]:
+        """
+        Returns (question_list, file_name) for a digest. file_name is None when the
+        cached upload is gone or too close to its expiry to be reused.
+        """
+        now = time.time()
+        with self._lock:
+            try:
+                self._evict(now)
+            except sqlite3.OperationalError as e:
+                if not is_busy(e):
+                    raise # Otherwise left for the next lookup or store
+            row = self._conn.execute("SELECT * FROM papers WHERE digest = ?", (digest,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None, None
+            self.hits += 1
+            try:
+                with self._conn:
+                    self._conn.execute("UPDATE papers SET last_used = ? WHERE digest = ?", (now, digest))
+            except sqlite3.OperationalError as e:
+                if not is_busy(e):
+                    raise # Only the LRU order is a little off
+        file_name = row["file_name"]
+        if file_name and now - (row["file_uploaded_at"] or 0) > self.file_validity_seconds:
+            file_name = None
+        return QuestionListResponse.model_validate_json(row["questions_json"]), file_name
+
+    def store(self, digest: str, file_name: str, question_list: QuestionListResponse):
+        """ Records a freshly uploaded and extracted paper. """
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO papers (digest, file_name, file_uploaded_at, questions_json, created_at, last_used)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (digest, file_name, now, question_list.model_dump_json(), now, now)
+            )
+            self._evict(now)
+
+    def update_file(self, digest: str, file_name: str):
+        """ Points a cached paper at a new upload (after the previous one expired). """
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE papers SET file_name = ?, file_uploaded_at = ? WHERE digest = ?",
+                (file_name, time.time(), digest)
+            )
+
+    def forget_file(self, file_name: Optional[str]):
+        """ Drops a deleted upload from the index; the question list stays cached. """
+        if not file_name:
+            return
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE papers SET file_name = NULL, file_uploaded_at = NULL WHERE file_name = ?", (file_name,)
+            )
+            self._conn.execute("DELETE FROM page_slices WHERE file_name = ?", (file_name,))
+
+    def get_slice(self, digest: str, page_start: int, page_end: int) -> Optional[str]:
+        """ Returns the File API name of a still-valid upload of a page range of a paper. """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT file_name FROM page_slices WHERE digest = ? AND page_start = ? AND page_end = ? AND uploaded_at >= ?",
+                (digest, page_start, page_end, time.time() - self.file_validity_seconds)
+            ).fetchone()
+        return row["file_name"] if row else None
+
+    def store_slice(self, digest: str, page_start: int, page_end: int, file_name: str):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO page_slices (digest, page_start, page_end, file_name, uploaded_at) VALUES (?, ?, ?, ?, ?)",
+                (digest, page_start, page_end, file_name, time.time())
+            )
+
+    def get_questions(self, digest: str) -> Optional[QuestionListResponse]:
+        """ Returns the cached question list for a digest without counting a cache hit. """
+        with self._lock:
+            row = self._conn.execute("SELECT questions_json FROM papers WHERE digest = ?", (digest,)).fetchone()
+        return QuestionListResponse.model_validate_json(row["questions_json"]) if row else None
+
+    def digest_for_file(self, file_name: str) -> Optional[str]:
+        """ Finds the paper digest an uploaded file belongs to, if it is indexed. """
+        with self._lock:
+            row = self._conn.execute("SELECT digest FROM papers WHERE file_name = ?", (file_name,)).fetchone()
+        return row["digest"] if row else None
+
+    def references_file(self, file_name: str) -> bool:
+        """ Whether an upload is indexed, as a whole paper or as a page slice. """
+        with self._lock:
+            return self._conn.execute(
+                "SELECT 1 FROM papers WHERE file_name = ? UNION ALL SELECT 1 FROM page_slices WHERE file_name = ? LIMIT 1",
+                (file_name, file_name)
+            ).fetchone() is not None
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM papers").fetchone()[0]
+        return {"entries": entries, "hits": self.hits, "misses": self.misses}
+
+    def _evict(self, now: float):
+        """ Removes expired entries, then the least recently used ones over the size limit. Caller holds the lock. """
+        evicted = [row["digest"] for row in self._conn.execute(
+            "SELECT digest FROM papers WHERE created_at < ?"
+            " OR digest NOT IN (SELECT digest FROM papers ORDER BY last_used DESC LIMIT ?)",
+            (now - self.ttl_seconds, self.max_entries)
+        )]
+        with self._conn:
+            self._conn.execute("DELETE FROM page_slices WHERE uploaded_at < ?", (now - self.file_validity_seconds,))
+            if not evicted:
+                return
+            self._conn.executemany("DELETE FROM papers WHERE digest = ?", [(digest,) for digest in evicted])
+            self._conn.executemany("DELETE FROM page_slices WHERE digest = ?", [(digest,) for digest in evicted])
+        if self.on_evict:
+            self.on_evict(evicted)
+
+
+# --- File Leases (lifetime of Gemini File API uploads) ---
+
+class FileLeases:
+    """
+    Lease per uploaded Gemini file. Using a file extends its lease; files whose
+    lease ran out are claimed by the lifecycle reaper and deleted. A lease never
+    extends past the File API's own retention of the upload.
+    """
+
+    def __init__(self, db_path: str = CACHE_DB_PATH,
+                 lease_seconds: int = FILE_LEASE_SECONDS,
+                 max_age_seconds: int = GEMINI_FILE_VALIDITY_SECONDS):
+        self.lease_seconds = lease_seconds
+        self.max_age_seconds = max_age_seconds
+        self._lock = threading.Lock()
+        self._conn = connect(db_path)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS file_leases ("
+                " file_name TEXT PRIMARY KEY,"
+                " uploaded_at REAL NOT NULL,"
+                " expires_at REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS file_leases_expiry ON file_leases (expires_at)")
+
+    def register(self, file_name: str, uploaded_at: Optional[float] = None, expires_at: Optional[float] = None):
+        """ Starts a lease for a new upload (or adopts an existing one with the given times). """
+        now = time.time()
+        uploaded_at = uploaded_at or now
+        if expires_at is None:
+            expires_at = min(now + self.lease_seconds, uploaded_at + self.max_age_seconds)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO file_leases (file_name, uploaded_at, expires_at) VALUES (?, ?, ?)",
+                (file_name, uploaded_at, expires_at)
+            )
+
+    def touch(self, file_name: str) -> bool:
+        """ Extends the lease of a file in use. False if the file has no lease. """
+        now = time.time()
+        with self._lock:
+            try:
+                with self._conn:
+                    return self._conn.execute(
+                        "UPDATE file_leases SET expires_at = MAX(expires_at, MIN(?, uploaded_at + ?)) WHERE file_name = ?",
+                        (now + self.lease_seconds, self.max_age_seconds, file_name)
+                    ).rowcount == 1
+            except sqlite3.OperationalError as e:
+                if not is_busy(e):
+                    raise
+                # Not extended this time; the file is still usable while its current lease lasts
+                return self._conn.execute(
+                    "SELECT 1 FROM file_leases WHERE file_name = ? AND expires_at > ?", (file_name, now)
+                ).fetchone() is not None
+
+    def claim_expired(self, limit: int, exclude: Collection[str] = ()) -> List[str]:
+        """ Removes and returns up to limit files whose lease has expired, leaving those in exclude leased. """
+        now = time.time()
+        exclude = list(exclude)
+        with self._lock, self._conn:
+            names = [row["file_name"] for row in self._conn.execute(
+                "SELECT file_name FROM file_leases WHERE expires_at <= ?"
+                f" AND file_name NOT IN ({', '.join('?' * len(exclude))}) ORDER BY expires_at LIMIT ?",
+                (now, *exclude, limit)
+            )]
+            # Re-check expiry in the delete, so a lease touched in between is kept
+            return [name for name in names if self._conn.execute(
+                "DELETE FROM file_leases WHERE file_name = ? AND expires_at <= ?", (name, now)
+            ).rowcount == 1]
+
+    def claim_if_expired(self, file_name: str) -> bool:
+        """ Removes the lease of file_name if it has expired. True if it was removed. """
+        with self._lock, self._conn:
+            return self._conn.execute(
+                "DELETE FROM file_leases WHERE file_name = ? AND expires_at <= ?", (file_name, time.time())
+            ).rowcount == 1
+
+    def forget(self, file_name: str):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM file_leases WHERE file_name = ?", (file_name,))
+
+    def names(self) -> List[str]:
+        with self._lock:
+            return [row["file_name"] for row in self._conn.execute("SELECT file_name FROM file_leases")]
+
+    def stats(self) -> dict:
+        with self._lock:
+            active, next_expiry = self._conn.execute("SELECT COUNT(*), MIN(expires_at) FROM file_leases").fetchone()
+        return {"leased_files": active, "next_expiry_in_s": round(next_expiry - time.time(), 1) if next_expiry else None}
+
+
+# --- Rate Buckets (budgets shared by all worker processes) ---
+
+class RateBuckets:
+    """
+    Token buckets kept in SQLite, so every worker process draws on the same budget.
+    Each bucket refills continuously to its capacity over its period; levels may go
+    negative to record overspend. A bucket can also be paused until a given time.
+    """
+
+    def __init__(self, db_path: str = CACHE_DB_PATH):
+        self._limits: Dict[str, Tuple[float, float]] = {} # Name -> (capacity, period in seconds)
+        self._lock = threading.Lock()
+        self._conn = connect(db_path)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS rate_buckets ("
+                " name TEXT PRIMARY KEY,"
+                " level REAL NOT NULL,"
+                " updated REAL NOT NULL,"
+                " paused_until REAL NOT NULL DEFAULT 0)"
+            )
+
+    def configure(self, name: str, capacity: float, period_seconds: float = 60.0):
+        """ Sets a bucket's limit for this process; every worker should configure the same limits. """
+        if capacity <= 0:
+            raise ValueError(f"Rate bucket {name!r} needs a positive capacity.")
+        self._limits[name] = (float(capacity), float(period_seconds))
+
+    def try_take(self, amounts: Dict[str, float]) -> float:
+        """
+        Takes every amount if all buckets allow it and returns 0; otherwise takes
+        nothing and returns the seconds until they would. Amounts above a bucket's
+        capacity only need a full bucket. Unconfigured buckets are unlimited.
+        """
+        amounts = {name: amount for name, amount in amounts.items() if name in self._limits}
+        if not amounts:
+            return 0.0
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN IMMEDIATE") # Read and take atomically across processes
+            levels, wait = {}, 0.0
+            for name, amount in amounts.items():
+                capacity, period = self._limits[name]
+                level, paused_until = self._level(name, now)
+                levels[name] = level
+                needed = min(amount, capacity)
+                wait = max(wait, paused_until - now, 0.0 if level >= needed else (needed - level) * period / capacity)
+            if wait > 0:
+                return wait
+            self._conn.executemany(
+                "INSERT INTO rate_buckets (name, level, updated) VALUES (?, ?, ?)"
+                " ON CONFLICT (name) DO UPDATE SET level = excluded.level, updated = excluded.updated",
+                [(name, min(self._limits[name][0], levels[name] - amount), now) for name, amount in amounts.items()]
+            )
+            return 0.0
+
+    def adjust(self, name: str, amount: float):
+        """ Takes amount from a bucket (or returns it, when negative) without waiting. """
+        if name not in self._limits:
+            return
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            level, _ = self._level(name, now)
+            self._conn.execute(
+                "INSERT INTO rate_buckets (name, level, updated) VALUES (?, ?, ?)"
+                " ON CONFLICT (name) DO UPDATE SET level = excluded.level, updated = excluded.updated",
+                (name, min(self._limits[name][0], level - amount), now)
+            )
+
+    def pause(self, name: str, until: float):
+        """ Holds back every take from a bucket until the given Unix time. """
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO rate_buckets (name, level, updated, paused_until) VALUES (?, ?, ?, ?)"
+                " ON CONFLICT (name) DO UPDATE SET paused_until = MAX(paused_until, excluded.paused_until)",
+                (name, self._limits.get(name, (0.0, 60.0))[0], time.time(), until)
+            )
+
+    def paused_for(self, name: str) -> float:
+        """ Seconds until a paused bucket may be taken from again. """
+        with self._lock:
+            row = self._conn.execute("SELECT paused_until FROM rate_buckets WHERE name = ?", (name,)).fetchone()
+        return max(0.0, row["paused_until"] - time.time()) if row else 0.0
+
+    def level(self, name: str) -> Optional[float]:
+        """ Current level of a configured bucket, after refilling. """
+        if name not in self._limits:
+            return None
+        with self._lock:
+            return self._level(name, time.time())[0]
+
+    def _level(self, name: str, now: float) -> Tuple[float, float]:
+        """ Refilled (level, paused_until) of a bucket; full if it has no row yet. Caller holds the lock. """
+        capacity, period = self._limits[name]
+        row = self._conn.execute("SELECT level, updated, paused_until FROM rate_buckets WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return capacity, 0.0
+        return min(capacity, row["level"] + max(0.0, now - row["updated"]) * capacity / period), row["paused_until"]
+
+
+# --- Lesson Cache (in-process LRU in front of SQLite) ---
+
+class LessonCache:
+    """
+    Two-tier cache of generated lessons. Keys include the model name and the
+    prompt version, so changing either makes old entries unreachable. The
+    in-process tier is dropped when another worker purges the cache.
+    """
+
+    def __init__(self, db_path: str = CACHE_DB_PATH,
+                 memory_entries: int = LESSON_CACHE_MEMORY_ENTRIES,
+                 ttl_seconds: int = LESSON_CACHE_TTL_SECONDS):
+        self.memory_entries = memory_entries
+        self.ttl_seconds = ttl_seconds
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory: "OrderedDict[str, Tuple[float, LessonResponse]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = connect(db_path)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS lessons ("
+                " cache_key TEXT PRIMARY KEY,"
+                " paper_digest TEXT NOT NULL,"
+                " question_id TEXT NOT NULL,"
+                " model_name TEXT NOT NULL,"
+                " prompt_version TEXT NOT NULL,"
+                " lesson_json TEXT NOT NULL,"
+                " created_at REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS lessons_paper ON lessons (paper_digest)")
+            # Bumped by every purge, so each worker knows when its in-process tier is stale
+            self._conn.execute("CREATE TABLE IF NOT EXISTS lesson_cache_generation (id INTEGER PRIMARY KEY CHECK (id = 0), generation INTEGER NOT NULL)")
+            self._conn.execute("INSERT OR IGNORE INTO lesson_cache_generation (id, generation) VALUES (0, 0)")
+        self._generation = self._read_generation()
+        self._synced_at = time.monotonic()
+
+    @staticmethod
+    def make_key(paper_digest: str, question_id: str, model_name: str, prompt_version: str) -> str:
+        return "|".join((paper_digest, question_id, model_name, prompt_version))
+
+    def get(self, key: str) -> Optional[LessonResponse]:
+        return self._lookup(key, count=True)
+
+    def peek(self, key: str) -> Optional[LessonResponse]:
+        """ Like get, but not counted as a hit or miss; for lookups that never lead to generation. """
+        return self._lookup(key, count=False)
+
+    def _lookup(self, key: str, count: bool) -> Optional[LessonResponse]:
+        now = time.time()
+        with self._lock:
+            self._sync_memory()
+            entry = self._memory.get(key)
+            if entry and now - entry[0] <= self.ttl_seconds:
+                self._memory.move_to_end(key)
+                self.memory_hits += count
+                return entry[1]
+            row = self._conn.execute(
+                "SELECT lesson_json, created_at FROM lessons WHERE cache_key = ? AND created_at >= ?",
+                (key, now - self.ttl_seconds)
+            ).fetchone()
+            if row is None:
+                self._memory.pop(key, None)
+                self.misses += count
+                return None
+            self.disk_hits += count
+            lesson = LessonResponse.model_validate_json(row["lesson_json"])
+            self._remember(key, row["created_at"], lesson)
+            return lesson
+
+    def contains(self, key: str) -> bool:
+        """ True if a fresh lesson is cached for key; unlike get, not counted as a hit or miss. """
+        now = time.time()
+        with self._lock:
+            self._sync_memory()
+            entry = self._memory.get(key)
+            if entry and now - entry[0] <= self.ttl_seconds:
+                return True
+            return self._conn.execute(
+                "SELECT 1 FROM lessons WHERE cache_key = ? AND created_at >= ?",
+                (key, now - self.ttl_seconds)
+            ).fetchone() is not None
+
+    def put(self, key: str, lesson: LessonResponse):
+        paper_digest, rest = key.split("|", 1)
+        question_id, model_name, prompt_version = rest.rsplit("|", 2) # Question IDs may contain '|'
+        now = time.time()
+        with self._lock:
+            try:
+                with self._conn:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO lessons"
+                        " (cache_key, paper_digest, question_id, model_name, prompt_version, lesson_json, created_at)"
+                        " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (key, paper_digest, question_id, model_name, prompt_version, lesson.model_dump_json(), now)
+                    )
+                    self._conn.execute("DELETE FROM lessons WHERE created_at < ?", (now - self.ttl_seconds,))
+            except sqlite3.OperationalError as e:
+                if not is_busy(e):
+                    raise
+                logger.warning("Lesson cache database is busy; %s is only cached in this worker.", question_id)
+            self._remember(key, now, lesson)
+
+    def purge(self, paper_digest: Optional[str] = None) -> int:
+        """ Removes all cached lessons, or only those of one paper. Returns the number of rows deleted. """
+        with self._lock:
+            with self._conn:
+                if paper_digest:
+                    deleted = self._conn.execute("DELETE FROM lessons WHERE paper_digest = ?", (paper_digest,)).rowcount
+                else:
+                    deleted = self._conn.execute("DELETE FROM lessons").rowcount
+                self._conn.execute("UPDATE lesson_cache_generation SET generation = generation + 1")
+            self._generation = self._read_generation()
+            if paper_digest:
+                for key in [k for k in self._memory if k.startswith(paper_digest + "|")]:
+                    del self._memory[key]
+            else:
+                self._memory.clear()
+        return deleted
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM lessons").fetchone()[0]
+            return {
+                "entries": entries, "memory_entries": len(self._memory),
+                "memory_hits": self.memory_hits, "disk_hits": self.disk_hits, "misses": self.misses
+            }
+
+    def _read_generation(self) -> int:
+        return self._conn.execute("SELECT generation FROM lesson_cache_generation").fetchone()[0]
+
+    def _sync_memory(self):
+        """ Clears the in-process tier if another worker purged the cache. Caller holds the lock. """
+        now = time.monotonic()
+        if now - self._synced_at < LESSON_CACHE_SYNC_SECONDS:
+            return
+        self._synced_at = now
+        generation = self._read_generation()
+        if generation != self._generation:
+            self._generation = generation
+            self._memory.clear()
+
+    def _remember(self, key: str, created_at: float, lesson: LessonResponse):
+        """ Adds to the in-process LRU tier. Caller holds the lock. """
+        self._memory[key] = (created_at, lesson)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
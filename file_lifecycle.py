@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Background lifecycle manager for Gemini File API uploads. Each upload holds a
+lease that is extended whenever it is used; a reaper task deletes files whose
+lease ran out in batches, off the request path. Optionally, the File API listing
+is reconciled with the lease table on startup, so that this app's orphans from
+earlier runs are cleaned up.
+"""
+import asyncio
+import datetime
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Collection, Optional
+
+import gemini_utils
+from cache import FileLeases
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+FILE_REAPER_INTERVAL_SECONDS = int(os.getenv("FILE_REAPER_INTERVAL_SECONDS", "60"))
+FILE_REAPER_BATCH_SIZE = int(os.getenv("FILE_REAPER_BATCH_SIZE", "20")) # Deletes issued together per batch
+# Opt-in: lists every upload on the API key. Only files named with the app's upload prefix are ever deleted
+FILE_RECONCILE_ON_STARTUP = os.getenv("FILE_RECONCILE_ON_STARTUP", "0") == "1"
+# Unleased files younger than this are left alone: another worker may be about to register them
+FILE_RECONCILE_GRACE_SECONDS = int(os.getenv("FILE_RECONCILE_GRACE_SECONDS", "600"))
+
+
+class FileLifecycleManager:
+    """
+    Owns the deletion of uploaded files. on_expire(file_name) deletes an expired
+    upload; on_missing(file_name) drops references to an upload the File API no
+    longer has; is_referenced(file_name) tells reconciliation whether an unleased
+    upload is still known to the app (adopted) or an orphan (deleted). Uploads
+    named by in_use() keep their expired lease until release_if_expired is called.
+    """
+
+    def __init__(self, leases: FileLeases,
+                 on_expire: Callable[[str], Awaitable[None]],
+                 on_missing: Callable[[str], None],
+                 is_referenced: Callable[[str], bool],
+                 in_use: Callable[[], Collection[str]] = lambda: (),
+                 interval_seconds: int = FILE_REAPER_INTERVAL_SECONDS,
+                 batch_size: int = FILE_REAPER_BATCH_SIZE):
+        self.leases = leases
+        self.on_expire = on_expire
+        self.on_missing = on_missing
+        self.is_referenced = is_referenced
+        self.in_use = in_use
+        self.interval_seconds = interval_seconds
+        self.batch_size = batch_size
+        self._task: Optional[asyncio.Task] = None
+        self._stats = {"reaped": 0, "adopted": 0, "orphans": 0, "foreign": 0, "missing": 0, "reconciled_at": None}
+
+    def register(self, file_name: str):
+        """ Starts the lease of a new upload. """
+        self.leases.register(file_name)
+
+    def touch(self, file_name: Optional[str]) -> bool:
+        """ Extends the lease of an upload in use. False if the upload is unknown or already expired. """
+        return bool(file_name) and self.leases.touch(file_name)
+
+    def start(self, reconcile: bool = FILE_RECONCILE_ON_STARTUP):
+        self._task = asyncio.create_task(self._run(reconcile), name="file-reaper")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self, reconcile: bool):
+        if reconcile:
+            try:
+                await self.reconcile()
+            except Exception as e:
+                logger.warning("File reconciliation failed: %s: %s", type(e).__name__, e)
+        while True:
+            try:
+                await self.reap_once()
+            except Exception as e:
+                logger.exception("File reaper pass failed: %s", e)
+            await asyncio.sleep(self.interval_seconds)
+
+    async def reap_once(self) -> int:
+        """ Deletes every file whose lease has expired, batch_size deletes at a time. Returns the count. """
+        reaped = 0
+        while True:
+            expired = self.leases.claim_expired(self.batch_size, exclude=self.in_use())
+            if not expired:
+                break
+            logger.info("Deleting %s expired uploads: %s", len(expired), ", ".join(expired))
+            results = await asyncio.gather(*(self.on_expire(name) for name in expired), return_exceptions=True)
+            for name, result in zip(expired, results):
+                if isinstance(result, Exception):
+                    logger.warning("Failed to release expired upload %s: %s", name, result)
+            reaped += len(expired)
+            if len(expired) < self.batch_size:
+                break
+        self._stats["reaped"] += reaped
+        return reaped
+
+    async def release_if_expired(self, file_name: str) -> bool:
+        """ Deletes an upload that was in use when its lease expired, unless it has been used again since. """
+        if not self.leases.claim_if_expired(file_name):
+            return False
+        await self.on_expire(file_name)
+        self._stats["reaped"] += 1
+        return True
+
+    async def reconcile(self):
+        """
+        Compares the File API listing with the lease table. Leases of files the API
+        no longer has are dropped; unleased files the app still references are
+        adopted, and unknown ones (orphans) are expired for the reaper to delete.
+        Files without the app's upload prefix belong to other tools sharing the
+        API key and are never touched.
+        """
+        remote_files = await asyncio.to_thread(gemini_utils.list_uploaded_files)
+        leased = set(self.leases.names())
+        remote_names = set()
+        now = time.time()
+        for remote_file in remote_files:
+            remote_names.add(remote_file.name)
+            if remote_file.name in leased:
+                continue
+            create_time = getattr(remote_file, "create_time", None)
+            uploaded_at = create_time.timestamp() if isinstance(create_time, datetime.datetime) else now
+            if now - uploaded_at < FILE_RECONCILE_GRACE_SECONDS:
+                continue
+            if self.is_referenced(remote_file.name):
+                self.leases.register(remote_file.name, uploaded_at=uploaded_at)
+                self._stats["adopted"] += 1
+            elif not gemini_utils.is_app_upload(getattr(remote_file, "display_name", None)):
+                self._stats["foreign"] += 1
+            else:
+                self.leases.register(remote_file.name, uploaded_at=uploaded_at, expires_at=now)
+                self._stats["orphans"] += 1
+        for file_name in leased - remote_names:
+            self.leases.forget(file_name)
+            self.on_missing(file_name)
+            self._stats["missing"] += 1
+        self._stats["reconciled_at"] = now
+        logger.info(
+            "Reconciled %s remote uploads: %s adopted, %s orphans queued for deletion, %s left alone (not ours), %s leases without a file dropped.",
+            len(remote_names), self._stats["adopted"], self._stats["orphans"], self._stats["foreign"], self._stats["missing"]
+        )
+
+    def stats(self) -> dict:
+        return {**self.leases.stats(), **self._stats}
@@ -2,19 +2,48 @@
 import os
 import pathlib
 import json
-from typing import List, Optional, Union, Any
-from pydantic import BaseModel, Field, ValidationError
-import google.generativeai as genai
+import hashlib
+import asyncio
+import functools
+import threading
+import time
+import datetime
+import contextvars
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple, Union, Any
+from pydantic import ValidationError
 
-# Attempt to import File type hint, fallback to Any
-try:
-    from google.generativeai.types import File as GeminiFile, GenerationConfig
-except ImportError:
-    print("Warning: Could not import specific 'File' type from google.generativeai.types.")
-    GeminiFile = type("GeminiFile", (), {}) # Dummy type
+from log_config import truncate_payload
+
+logger = logging.getLogger(__name__)
+
+# The SDK takes most of the process start-up time, so it is imported on first use (see _sdk)
+if TYPE_CHECKING:
+    from google.generativeai.types import File as GeminiFile
+else:
+    GeminiFile = Any
 
 # Import Pydantic models
 from models import LessonResponse, QuestionListResponse, ExtractedQuestionItem
+from scheduler import gemini_scheduler, GeminiBusyError, GeminiTimeoutError, GEMINI_SCHEDULER_MAX_WAIT, set_cancel_event, is_cancelled, \
+    set_call_deadline, remaining_time
+import metrics
+import json_repair
+
+# --- Execution Settings ---
+# The SDK is blocking, so every call runs on a dedicated thread pool instead of the event loop.
+GEMINI_MAX_WORKERS = int(os.getenv("GEMINI_MAX_WORKERS", "8"))
+GEMINI_CALL_TIMEOUT = float(os.getenv("GEMINI_CALL_TIMEOUT", "120")) # Seconds, per call
+# Model calls may also wait in the scheduler (rate limits, retries) before the call itself
+MODEL_CALL_TIMEOUT = GEMINI_CALL_TIMEOUT + GEMINI_SCHEDULER_MAX_WAIT
+# Optional context caching: the PDF and tutor instructions are cached once per uploaded file and
+# reused by later lessons. Requires a versioned model name (e.g. gemini-1.5-flash-002) and a
+# document above the API's minimum cacheable size; otherwise lessons fall back to sending the PDF.
+CONTEXT_CACHE_ENABLED = os.getenv("GEMINI_CONTEXT_CACHE", "0") == "1"
+CONTEXT_CACHE_TTL_SECONDS = int(os.getenv("CONTEXT_CACHE_TTL_SECONDS", "900")) # Renewed on use
+# Prepended to the display name of every upload, so reconciliation only ever deletes this app's files
+UPLOAD_DISPLAY_NAME_PREFIX = os.getenv("UPLOAD_DISPLAY_NAME_PREFIX", "lessongenie-")
 
 # --- Manual Schemas for Gemini API ---
 
@@ -23,7 +52,9 @@ extracted_question_item_schema = {
     "type": "OBJECT",
     "properties": {
         "questionId": {"type": "STRING", "description": "A unique identifier you assign to this question (e.g., 'q1', 'q2a')."},
-        "questionText": {"type": "STRING", "description": "The full text of the extracted question."}
+        "questionText": {"type": "STRING", "description": "The full text of the extracted question."},
+        "pageStart": {"type": "INTEGER", "nullable": True, "description": "1-based page number where the question starts."},
+        "pageEnd": {"type": "INTEGER", "nullable": True, "description": "1-based page number where the question ends."}
     },
     "required": ["questionId", "questionText"]
 }
@@ -68,29 +99,273 @@ visual_aid_schema_props_lesson = {
 lesson_data_schema["properties"]["visualAid"]["properties"] = visual_aid_schema_props_lesson
 lesson_data_schema["required"].append("visualAid") # Make the object required, but its content optional via nullable/isPresent
 
+# --- Prompt for Lesson Generation ---
+# Fixed tutor instructions, sent as the system instruction (and stored in the context cache when enabled)
+LESSON_SYSTEM_INSTRUCTION = (
+    "You are an expert tutor AI. You explain questions from the provided PDF exam document. "
+    "For the question identified in each request, generate a detailed, step-by-step educational lesson explaining how to understand and solve that specific question. "
+    "Your response MUST strictly adhere to the provided JSON schema. "
+    "Extract the full question text accurately into 'questionText'. "
+    "Determine the 'subject' and 'topic' for this question. "
+    "Write a clear explanation for 'coreConceptHtml' using HTML tags like <p>, <ul>, <li>, <code>, <strong>. "
+    "Provide detailed steps in the 'steps' array, using 'stepNumber', 'title', and 'descriptionHtml' (also allowing HTML). "
+    "Identify if a relevant graph or image is directly associated with *this specific question* in the PDF and set 'visualAid.isPresent' to true or false. If true, include the 'visualAid' object with 'imageUrl' set to null. If false, omit 'visualAid' or set it to null. " # Clarify optionality
+    "Include helpful 'hints' as a list of strings (can contain simple HTML like <strong>)."
+)
+# Per-question part of the prompt
+LESSON_PROMPT_TEMPLATE = (
+    "Referencing the provided PDF document '{display_name}' (ID: {file_name}), "
+    "focus *only* on the question identified by {question_context}. "
+    "Use the provided '{question_id}' as the 'questionId' in your response."
+)
+# Asks for only the fields a truncated or invalid lesson is missing; appended to the lesson prompt
+LESSON_CONTINUATION_TEMPLATE = (
+    " A previous answer for this question was cut off. This part of it is usable: {partial}. "
+    "Return a JSON object with only the missing fields ({fields}), consistent with that part."
+)
+# Changes to the prompt or schema change this version, which invalidates cached lessons.
+LESSON_PROMPT_VERSION = hashlib.sha256(
+    (LESSON_SYSTEM_INSTRUCTION + LESSON_PROMPT_TEMPLATE + json.dumps(MANUAL_LESSON_RESPONSE_SCHEMA, sort_keys=True)).encode("utf-8")
+).hexdigest()[:16]
+
+
+# --- SDK Client ---
+# The SDK is imported and configured on first use, or ahead of it by prewarm() once the
+# server is accepting connections. Models are built once per model name and instruction.
+
+_sdk_lock = threading.Lock()
+_genai = None
+_models: Dict[Tuple[str, Optional[str]], Any] = {}
+_sdk_state = {"warm": False, "import_seconds": None, "warmed_at": None, "error": None}
+
+def _sdk():
+    """ Returns the configured google.generativeai module, importing it on the first call. """
+    global _genai
+    if _genai is not None:
+        return _genai
+    with _sdk_lock:
+        if _genai is None:
+            started = time.perf_counter()
+            import google.generativeai as genai
+            genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+            _sdk_state["import_seconds"] = round(time.perf_counter() - started, 3)
+            logger.info("Gemini SDK imported and configured in %.2fs.", _sdk_state["import_seconds"])
+            _genai = genai
+    return _genai
+
+def _generation_config(response_schema: dict):
+    return _sdk().types.GenerationConfig(response_mime_type='application/json', response_schema=response_schema)
+
+def get_model(model_name: str, system_instruction: Optional[str] = None):
+    """ Returns the GenerativeModel for a model name and system instruction, built once and shared. """
+    key = (model_name, system_instruction)
+    model = _models.get(key)
+    if model is None:
+        genai = _sdk()
+        with _sdk_lock:
+            model = _models.get(key)
+            if model is None:
+                model = _models[key] = genai.GenerativeModel(model_name, system_instruction=system_instruction)
+    return model
+
+def prewarm(extraction_model: str, lesson_model: str):
+    """ Imports the SDK and builds the models requests will use. Failures are recorded, not raised. """
+    try:
+        get_model(extraction_model)
+        get_model(lesson_model, LESSON_SYSTEM_INSTRUCTION)
+    except Exception as e:
+        _sdk_state["error"] = f"{type(e).__name__}: {e}"
+        logger.error("Gemini SDK pre-warm failed: %s", _sdk_state["error"])
+        return
+    _sdk_state.update(warm=True, warmed_at=time.time(), error=None)
+
+def sdk_state() -> dict:
+    """ Whether the SDK is imported and the models are built, for the readiness check. """
+    return {**_sdk_state, "models": len(_models)}
+
+
+# --- Context Cache Registry ---
+# Uploaded file name -> (CachedContent, time of last TTL renewal)
+_context_caches: dict = {}
+_context_cache_unavailable: set = set() # Files whose cache could not be created; not retried
+_context_cache_locks: dict = {} # Per-file locks so concurrent first lessons create one cache
+_context_cache_lock = threading.Lock()
+
+def _get_context_cache(file_ref: GeminiFile, model_name: str):
+    """ Returns the context cache for an uploaded file, creating or renewing it. None if unavailable. """
+    with _context_cache_lock:
+        if file_ref.name in _context_cache_unavailable:
+            return None
+        file_lock = _context_cache_locks.setdefault(file_ref.name, threading.Lock())
+    ttl = datetime.timedelta(seconds=CONTEXT_CACHE_TTL_SECONDS)
+    with file_lock:
+        with _context_cache_lock:
+            entry = _context_caches.get(file_ref.name)
+        if entry:
+            cached_content, renewed_at = entry
+            if time.time() - renewed_at < CONTEXT_CACHE_TTL_SECONDS / 2:
+                return cached_content
+            try:
+                cached_content.update(ttl=ttl)
+                with _context_cache_lock:
+                    _context_caches[file_ref.name] = (cached_content, time.time())
+                return cached_content
+            except Exception as e:
+                logger.warning("Could not renew context cache %s: %s. Recreating it.", cached_content.name, e)
+        try:
+            cached_content = gemini_scheduler.run(
+                "context cache creation",
+                _sdk().caching.CachedContent.create,
+                model=model_name,
+                display_name=f"lesson-context-{file_ref.display_name}"[:128],
+                system_instruction=LESSON_SYSTEM_INSTRUCTION,
+                contents=[file_ref],
+                ttl=ttl
+            )
+        except (GeminiBusyError, GeminiTimeoutError) as e:
+            logger.warning("Could not create context cache for %s (%s). Sending the PDF with this lesson.", file_ref.name, e)
+            return None
+        except Exception as e:
+            logger.warning("Context caching unavailable for %s (%s: %s). Sending the PDF with each lesson.", file_ref.name, type(e).__name__, e)
+            with _context_cache_lock:
+                _context_cache_unavailable.add(file_ref.name)
+            return None
+        logger.info("Created context cache %s for file %s (TTL %ss).", cached_content.name, file_ref.name, CONTEXT_CACHE_TTL_SECONDS)
+        with _context_cache_lock:
+            _context_caches[file_ref.name] = (cached_content, time.time())
+        return cached_content
+
+def delete_context_cache(file_name: str):
+    """ Deletes the context cache created for an uploaded file, if any. """
+    with _context_cache_lock:
+        entry = _context_caches.pop(file_name, None)
+        _context_cache_unavailable.discard(file_name)
+        _context_cache_locks.pop(file_name, None)
+    if not entry:
+        return
+    try:
+        entry[0].delete()
+        logger.info("Context cache %s deleted.", entry[0].name)
+    except Exception as e:
+        logger.warning("Failed to delete context cache %s: %s", entry[0].name, e)
+
+def _log_usage(response, label: str):
+    """
+    Logs prompt/cached/output token counts so context-cache savings are visible,
+    and reports the total to the scheduler's tokens/min accounting.
+    """
+    usage = getattr(response, "usage_metadata", None)
+    if not usage:
+        return
+    gemini_scheduler.record_usage(label, usage.total_token_count or 0)
+    metrics.record_usage(label, usage)
+    prompt_tokens = usage.prompt_token_count or 0
+    cached_tokens = getattr(usage, "cached_content_token_count", 0) or 0
+    logger.info("Token usage for %s: prompt=%s (cached=%s, uncached=%s), output=%s", label, prompt_tokens, cached_tokens, prompt_tokens - cached_tokens, usage.candidates_token_count or 0)
+
 
 # --- Helper Functions ---
 
 def upload_pdf_to_gemini(pdf_path: str, display_name: str) -> Optional[GeminiFile]:
     """Uploads a PDF file (from path) to the Gemini File API."""
-    print(f"Uploading file '{pdf_path}' (display name: '{display_name}') to Gemini File API...")
+    logger.info("Uploading file '%s' (display name: '%s') to Gemini File API...", pdf_path, display_name)
     try:
         if not pathlib.Path(pdf_path).is_file():
-             print(f"--- Error: File not found at path: {pdf_path} ---")
+             logger.error("File not found at path: %s", pdf_path)
              return None
         # Use a descriptive display name if possible
-        safe_display_name = display_name or pathlib.Path(pdf_path).name
-        uploaded_file = genai.upload_file(
-            path=pdf_path,
-            display_name=safe_display_name,
-            mime_type="application/pdf"
-        )
-        print(f"Successfully uploaded: {uploaded_file.name} ({uploaded_file.display_name})")
+        safe_display_name = UPLOAD_DISPLAY_NAME_PREFIX + (display_name or pathlib.Path(pdf_path).name)
+        with metrics.stage("upload"):
+            uploaded_file = _sdk().upload_file(
+                path=pdf_path,
+                display_name=safe_display_name,
+                mime_type="application/pdf"
+            )
+        logger.info("Successfully uploaded: %s (%s)", uploaded_file.name, uploaded_file.display_name)
+        if is_cancelled():
+            # The caller timed out during the upload, so nothing would ever track or delete this file
+            logger.warning("Upload %s finished after its caller timed out. Deleting it.", uploaded_file.name)
+            delete_uploaded_file(uploaded_file.name)
+            return None
         return uploaded_file
     except Exception as e:
-        print(f"--- Error uploading file '{display_name}': {e} ---")
+        logger.error("Error uploading file '%s': %s", display_name, e)
         return None
 
+def is_app_upload(display_name: Optional[str]) -> bool:
+    """ True if an upload's display name carries this app's prefix (see upload_pdf_to_gemini). """
+    return bool(display_name) and display_name.startswith(UPLOAD_DISPLAY_NAME_PREFIX)
+
+def _document_name(file_ref: GeminiFile) -> str:
+    """ The display name the user gave the document, as shown to the model. """
+    return (file_ref.display_name or "").removeprefix(UPLOAD_DISPLAY_NAME_PREFIX)
+
+def _request_timeout() -> float:
+    """ HTTP timeout for a model request: GEMINI_CALL_TIMEOUT, or less if the caller's deadline is nearer. """
+    remaining = remaining_time()
+    return GEMINI_CALL_TIMEOUT if remaining is None else max(1.0, min(GEMINI_CALL_TIMEOUT, remaining))
+
+def _build_extraction_request(uploaded_file: GeminiFile, model_name: str):
+    """ Returns (model, contents, generation_config) for a question extraction call. """
+    prompt = (
+        f"Analyze the provided PDF document '{_document_name(uploaded_file)}'. "
+        "Identify and extract all distinct questions presented in the document. "
+        "For each question, assign a unique string ID (e.g., 'q1', 'q2a', 'q3') and extract its full text. "
+        "Also report the 1-based page numbers the question starts and ends on in 'pageStart' and 'pageEnd'. "
+        f"Return the results as a JSON object conforming to the specified schema. Include the provided PDF file ID '{uploaded_file.name}' in the 'pdfFileId' field."
+    )
+
+    generation_config = _generation_config(question_list_response_schema) # Use the manual dictionary schema
+
+    model = get_model(model_name)
+    # File first, then prompt describing the task
+    return model, [uploaded_file, prompt], generation_config
+
+def _log_validation_failure(label: str, error: ValidationError, response_text: str):
+    """ Logs a compact summary of a validation failure; the full errors and payload only at DEBUG. """
+    logger.warning(
+        "Pydantic validation failed during %s: %s error(s), first: %s. Raw JSON: %s",
+        label, error.error_count(), error.errors(include_url=False, include_input=False)[:3], truncate_payload(logger, response_text)
+    )
+    logger.debug("Full validation errors for %s: %s", label, error.json(indent=2))
+
+def parse_question_list(response_text: str, pdf_file_id: str) -> Optional[QuestionListResponse]:
+    """ Validates raw extraction JSON against QuestionListResponse. Returns None if invalid. """
+    try:
+        with metrics.stage("validate"):
+            validated_response = QuestionListResponse.model_validate_json(response_text)
+    except ValidationError as e:
+        metrics.validation_failures.inc(kind="question_list")
+        _log_validation_failure("question extraction", e, response_text)
+        validated_response = _repair_question_list(response_text, pdf_file_id)
+        if validated_response is None:
+            return None
+    # Add the file ID manually if the AI didn't include it (as a fallback)
+    if not validated_response.pdfFileId:
+         validated_response.pdfFileId = pdf_file_id
+    logger.info("Successfully extracted %s questions.", len(validated_response.questions))
+    return validated_response
+
+def _repair_question_list(response_text: str, pdf_file_id: str) -> Optional[QuestionListResponse]:
+    """
+    Salvages the complete questions of an invalid or truncated extraction. None if
+    there are none. A list that lost questions is marked salvaged, so it is not cached.
+    """
+    parsed = json_repair.load_partial(response_text)
+    cut_path = json_repair.truncated_path(response_text)
+    data = json_repair.repair_question_list(parsed, pdf_file_id, cut_path)
+    repaired = None
+    if data and data["questions"]:
+        try:
+            repaired = QuestionListResponse.model_validate(data)
+        except ValidationError:
+            pass
+    json_repair.record("question_list", "repaired" if repaired else "failed")
+    if repaired:
+        repaired._salvaged = bool(cut_path) or len(data["questions"]) < len(parsed["questions"])
+        logger.info("Repaired invalid question list JSON; kept %s questions.", len(repaired.questions))
+    return repaired
+
 def extract_questions_from_pdf(
     uploaded_file: GeminiFile,
     model_name: str = "gemini-1.5-flash-latest" # Use a capable model
@@ -98,52 +373,178 @@ def extract_questions_from_pdf(
     """
     Asks Gemini to extract all questions from the PDF and return a structured list.
     """
-    print(f"Extracting questions from '{uploaded_file.display_name}' using {model_name}...")
+    logger.info("Extracting questions from '%s' using %s...", uploaded_file.display_name, model_name)
     response_text = None
     try:
-        prompt = (
-            f"Analyze the provided PDF document '{uploaded_file.display_name}'. "
-            "Identify and extract all distinct questions presented in the document. "
-            "For each question, assign a unique string ID (e.g., 'q1', 'q2a', 'q3') and extract its full text. "
-            f"Return the results as a JSON object conforming to the specified schema. Include the provided PDF file ID '{uploaded_file.name}' in the 'pdfFileId' field."
-        )
+        model, contents, generation_config = _build_extraction_request(uploaded_file, model_name)
 
-        generation_config = GenerationConfig(
-            response_mime_type='application/json',
-            response_schema=question_list_response_schema # Use the manual dictionary schema
-        )
+        logger.debug("Sending request to Gemini API for question extraction...")
+        with metrics.stage("extract"):
+            response = gemini_scheduler.run(
+                "question extraction",
+                model.generate_content,
+                contents=contents,
+                generation_config=generation_config,
+                request_options={"timeout": _request_timeout()}
+            )
+
+        logger.debug("API response received for extraction. Validating structure using Pydantic...")
+        _log_usage(response, "question extraction")
+        response_text = response.text
+        return parse_question_list(response_text, uploaded_file.name)
 
-        model = genai.GenerativeModel(model_name)
-        # Only need the file for question extraction
-        contents = [uploaded_file] # If prompt is needed, add it here
+    except (GeminiBusyError, GeminiTimeoutError):
+        raise # Rate limited or abandoned; the caller reports it as temporarily unavailable
+    except Exception as e:
+        logger.error("An error occurred during question extraction: %s: %s", type(e).__name__, e)
+        if response_text: logger.warning("Raw response text: %s", truncate_payload(logger, response_text))
+        return None
 
-        print("Sending request to Gemini API for question extraction...")
-        # Add the prompt *after* the file for this task
-        response = model.generate_content(
-            contents=[uploaded_file, prompt], # File first, then prompt describing the task
+def stream_questions_from_pdf(
+    uploaded_file: GeminiFile,
+    model_name: str = "gemini-1.5-flash-latest"
+) -> Iterator[str]:
+    """
+    Streaming variant of extract_questions_from_pdf: yields the raw JSON text as
+    Gemini generates it. Validate the joined text with parse_question_list.
+    Raises on API errors.
+    """
+    logger.info("Streaming question extraction from '%s' using %s...", uploaded_file.display_name, model_name)
+    model, contents, generation_config = _build_extraction_request(uploaded_file, model_name)
+    with metrics.stage("extract"):
+        response = gemini_scheduler.run(
+            "streamed question extraction",
+            model.generate_content,
+            contents=contents,
             generation_config=generation_config,
-            # request_options={"timeout": 600} # Potentially long task
+            stream=True,
+            request_options={"timeout": _request_timeout()}
         )
+        for chunk in response:
+            if chunk.parts:
+                yield chunk.text
+    _log_usage(response, "streamed question extraction")
 
-        print("API response received for extraction. Validating structure using Pydantic...")
-        response_text = response.text
-        validated_response = QuestionListResponse.model_validate_json(response_text)
-        # Add the file ID manually if the AI didn't include it (as a fallback)
-        if not validated_response.pdfFileId:
-             validated_response.pdfFileId = uploaded_file.name
-        print(f"Successfully extracted {len(validated_response.questions)} questions.")
-        return validated_response
+def _build_lesson_request(
+    pdf_file_id: str,
+    selected_question_id: str,
+    selected_question_text: Optional[str],
+    model_name: str
+):
+    """ Returns (model, contents, generation_config) for a lesson call. Raises if the file is missing. """
+    # Re-construct the File object reference using the name/ID
+    # This assumes the file still exists in the File API storage (within 48h usually)
+    file_ref = _sdk().get_file(name=pdf_file_id)
+    if not file_ref:
+         raise LookupError(f"Could not retrieve file reference for ID: {pdf_file_id}")
+    logger.debug("Retrieved file reference: %s (%s)", file_ref.name, file_ref.display_name)
+
+    # Construct the prompt for generating the lesson for the SPECIFIC question
+    question_context = f"question ID '{selected_question_id}'"
+    if selected_question_text:
+        question_context += f" with text starting: '{selected_question_text[:100]}...'" # Use text snippet for context
+
+    prompt = LESSON_PROMPT_TEMPLATE.format(
+        display_name=_document_name(file_ref),
+        file_name=file_ref.name,
+        question_context=question_context,
+        question_id=selected_question_id
+    )
+
+    generation_config = _generation_config(MANUAL_LESSON_RESPONSE_SCHEMA) # Use the manual dictionary schema
 
+    cached_content = _get_context_cache(file_ref, model_name) if CONTEXT_CACHE_ENABLED else None
+    if cached_content:
+        # The cache already holds the PDF and the system instruction
+        model = _sdk().GenerativeModel.from_cached_content(cached_content=cached_content)
+        return model, [prompt], generation_config
+
+    model = get_model(model_name, LESSON_SYSTEM_INSTRUCTION)
+    return model, [file_ref, prompt], generation_config # File ref first, then prompt
+
+def parse_lesson(
+    response_text: str,
+    continue_lesson: Optional[Callable[[dict, List[str]], Optional[dict]]] = None
+) -> Optional[LessonResponse]:
+    """
+    Validates raw lesson JSON against LessonResponse. Invalid or truncated JSON is
+    repaired; fields still missing are requested with continue_lesson(lesson_data,
+    missing_fields) when given. Returns None if the lesson cannot be salvaged.
+    """
+    try:
+        with metrics.stage("validate"):
+            validated_lesson = LessonResponse.model_validate_json(response_text)
     except ValidationError as e:
-        print("--- Pydantic Validation Error during Question Extraction ---")
-        print(e.json(indent=2))
-        print("--- Raw JSON that failed validation ---")
-        print(response_text)
+        metrics.validation_failures.inc(kind="lesson")
+        _log_validation_failure("lesson generation", e, response_text)
+        return _repair_lesson(response_text, continue_lesson)
+    logger.info("Successfully parsed and validated lesson response against Pydantic model.")
+    return validated_lesson
+
+def _repair_lesson(response_text: str, continue_lesson) -> Optional[LessonResponse]:
+    lesson_data = json_repair.repair_lesson(json_repair.load_partial(response_text))
+    if lesson_data is None:
+        json_repair.record("lesson", "failed")
         return None
-    except Exception as e:
-        print(f"--- An error occurred during question extraction: {type(e).__name__}: {e} ---")
-        if response_text: print(f"--- Raw Response Text: {response_text} ---")
+    outcome = "repaired"
+    # The field the output was cut off in may be partial (e.g. its last steps missing), so it is asked for again
+    cut_field = json_repair.truncated_lesson_field(response_text)
+    cut_value = lesson_data.pop(cut_field, None) if cut_field else None
+    missing = json_repair.missing_lesson_fields(lesson_data)
+    if cut_field and cut_field not in missing:
+        missing.append(cut_field) # An optional field such as visualAid
+    if missing and continue_lesson:
+        logger.info("Repaired lesson JSON is missing %s; requesting only those fields.", ", ".join(missing))
+        try:
+            continuation = continue_lesson(lesson_data, missing)
+        except Exception as e:
+            logger.warning("Lesson continuation failed: %s: %s", type(e).__name__, e)
+            continuation = None
+        if continuation:
+            lesson_data = json_repair.repair_lesson({**lesson_data, **{k: v for k, v in continuation.items() if k in missing}})
+            outcome = "continued"
+    if cut_value is not None and cut_field not in lesson_data:
+        lesson_data[cut_field] = cut_value # Better the partial value than no lesson
+    try:
+        repaired = LessonResponse.model_validate({"lessonData": lesson_data})
+    except ValidationError as e:
+        logger.warning("Lesson could not be repaired: %s error(s), first: %s", e.error_count(), e.errors(include_url=False, include_input=False)[:3])
+        json_repair.record("lesson", "failed")
         return None
+    repaired._salvaged = cut_field is not None or outcome == "continued"
+    json_repair.record("lesson", outcome)
+    logger.info("Repaired invalid lesson JSON (%s).", outcome)
+    return repaired
+
+def continue_lesson(
+    pdf_file_id: str,
+    selected_question_id: str,
+    selected_question_text: Optional[str],
+    model_name: str,
+    lesson_data: dict,
+    missing_fields: List[str]
+) -> Optional[dict]:
+    """ Asks Gemini for only the missing fields of a partial lesson. Returns them as a dict, or None. """
+    model, contents, _ = _build_lesson_request(pdf_file_id, selected_question_id, selected_question_text, model_name)
+    prompt = contents[-1] + LESSON_CONTINUATION_TEMPLATE.format(
+        partial=json.dumps(lesson_data, ensure_ascii=False), fields=", ".join(missing_fields)
+    )
+    generation_config = _generation_config({
+        "type": "OBJECT",
+        "properties": {name: lesson_data_schema["properties"][name] for name in missing_fields},
+        "required": missing_fields
+    })
+    with metrics.stage("generate"):
+        response = gemini_scheduler.run(
+            "lesson continuation",
+            model.generate_content,
+            contents=contents[:-1] + [prompt],
+            generation_config=generation_config,
+            request_options={"timeout": _request_timeout()}
+        )
+    _log_usage(response, "lesson continuation")
+    continuation = json_repair.load_partial(response.text)
+    return continuation if isinstance(continuation, dict) else None
 
 def generate_structured_lesson(
     # uploaded_file: GeminiFile, # Keep this signature if needed elsewhere
@@ -156,83 +557,295 @@ def generate_structured_lesson(
     Generates structured lesson JSON for a SPECIFIC question, referencing
     an already uploaded PDF via its File API ID (name).
     """
-    print(f"Generating lesson for Q ID '{selected_question_id}' from file '{pdf_file_id}' using {model_name}...")
+    logger.info("Generating lesson for Q ID '%s' from file '%s' using %s...", selected_question_id, pdf_file_id, model_name)
     response_text = None
     try:
-        # Re-construct the File object reference using the name/ID
-        # This assumes the file still exists in the File API storage (within 48h usually)
-        file_ref = genai.get_file(name=pdf_file_id)
-        if not file_ref:
-             print(f"--- Error: Could not retrieve file reference for ID: {pdf_file_id} ---")
-             return None
-        print(f"Retrieved file reference: {file_ref.name} ({file_ref.display_name})")
-
-        # Construct the prompt for generating the lesson for the SPECIFIC question
-        question_context = f"question ID '{selected_question_id}'"
-        if selected_question_text:
-            question_context += f" with text starting: '{selected_question_text[:100]}...'" # Use text snippet for context
-
-        prompt = (
-            f"You are an expert tutor AI. Referencing the provided PDF document '{file_ref.display_name}' (ID: {file_ref.name}), "
-            f"focus *only* on the question identified by {question_context}. "
-            "Generate a detailed, step-by-step educational lesson explaining how to understand and solve that specific question. "
-            "Your response MUST strictly adhere to the provided JSON schema. "
-            "Use the provided '{selected_question_id}' as the 'questionId' in your response. "
-            "Extract the full question text accurately into 'questionText'. "
-            "Determine the 'subject' and 'topic' for this question. "
-            "Write a clear explanation for 'coreConceptHtml' using HTML tags like <p>, <ul>, <li>, <code>, <strong>. "
-            "Provide detailed steps in the 'steps' array, using 'stepNumber', 'title', and 'descriptionHtml' (also allowing HTML). "
-            "Identify if a relevant graph or image is directly associated with *this specific question* in the PDF and set 'visualAid.isPresent' to true or false. If true, include the 'visualAid' object with 'imageUrl' set to null. If false, omit 'visualAid' or set it to null. " # Clarify optionality
-            "Include helpful 'hints' as a list of strings (can contain simple HTML like <strong>)."
-        )
-
-        generation_config = GenerationConfig(
-            response_mime_type='application/json',
-            response_schema=MANUAL_LESSON_RESPONSE_SCHEMA # Use the manual dictionary schema
+        model, contents, generation_config = _build_lesson_request(
+            pdf_file_id, selected_question_id, selected_question_text, model_name
         )
 
-        model = genai.GenerativeModel(model_name)
-        contents = [file_ref, prompt] # File ref first, then prompt
-
-        print("Sending request to Gemini API for specific lesson generation...")
-        response = model.generate_content(
-            contents=contents,
-            generation_config=generation_config,
-            # request_options={"timeout": 600}
-        )
+        logger.debug("Sending request to Gemini API for specific lesson generation...")
+        with metrics.stage("generate"):
+            response = gemini_scheduler.run(
+                "lesson generation",
+                model.generate_content,
+                contents=contents,
+                generation_config=generation_config,
+                request_options={"timeout": _request_timeout()}
+            )
 
-        print("API response received for lesson generation. Validating structure using Pydantic...")
+        logger.debug("API response received for lesson generation. Validating structure using Pydantic...")
+        _log_usage(response, "lesson generation")
         response_text = response.text
-        validated_lesson = LessonResponse.model_validate_json(response_text)
-        print("Successfully parsed and validated lesson response against Pydantic model.")
-        return validated_lesson
+        return parse_lesson(
+            response_text,
+            functools.partial(continue_lesson, pdf_file_id, selected_question_id, selected_question_text, model_name)
+        )
 
-    except ValidationError as e:
-        print("--- Pydantic Validation Error during Lesson Generation ---")
-        print(e.json(indent=2))
-        print("--- Raw JSON that failed validation ---")
-        print(response_text)
-        return None
+    except (GeminiBusyError, GeminiTimeoutError):
+        raise # Rate limited or abandoned; the caller reports it as temporarily unavailable
     except Exception as e:
-        print(f"--- An error occurred during specific lesson generation: {type(e).__name__}: {e} ---")
+        logger.error("An error occurred during specific lesson generation: %s: %s", type(e).__name__, e)
         # Handle specific errors like file not found (genai.exceptions.NotFound) if needed
         if "not found" in str(e).lower() and pdf_file_id in str(e).lower():
-            print(f"--- Error: Could not find file {pdf_file_id} in File API. It might have expired (>48h). ---")
-        if response_text: print(f"--- Raw Response Text: {response_text} ---")
+            logger.error("Could not find file %s in File API. It might have expired (>48h).", pdf_file_id)
+        if response_text: logger.warning("Raw response text: %s", truncate_payload(logger, response_text))
         return None
 
+def stream_structured_lesson(
+    pdf_file_id: str,
+    selected_question_id: str,
+    selected_question_text: Optional[str],
+    model_name: str = "gemini-1.5-flash-latest"
+) -> Iterator[str]:
+    """
+    Streaming variant of generate_structured_lesson: yields the raw JSON text as
+    Gemini generates it. Validate the joined text with parse_lesson.
+    Raises on API errors.
+    """
+    logger.info("Streaming lesson for Q ID '%s' from file '%s' using %s...", selected_question_id, pdf_file_id, model_name)
+    model, contents, generation_config = _build_lesson_request(
+        pdf_file_id, selected_question_id, selected_question_text, model_name
+    )
+    with metrics.stage("generate"):
+        response = gemini_scheduler.run(
+            "streamed lesson generation",
+            model.generate_content,
+            contents=contents,
+            generation_config=generation_config,
+            stream=True,
+            request_options={"timeout": _request_timeout()}
+        )
+        for chunk in response:
+            if chunk.parts:
+                yield chunk.text
+    _log_usage(response, "streamed lesson generation")
+
 # delete_uploaded_file remains the same
 def delete_uploaded_file(file_name: Optional[str]): # Accept name directly
     """ Deletes the file from the Gemini File API using its name/ID. """
     if not file_name:
-        print("Invalid or missing file name provided for deletion.")
+        logger.warning("Invalid or missing file name provided for deletion.")
         return
 
-    print(f"Attempting to delete file: {file_name}...")
+    delete_context_cache(file_name)
+    logger.debug("Attempting to delete file: %s...", file_name)
     try:
-        genai.delete_file(file_name)
-        print(f"File {file_name} deleted successfully.")
+        with metrics.stage("delete"):
+            _sdk().delete_file(file_name)
+        logger.info("File %s deleted successfully.", file_name)
     except Exception as e:
         # Log error but don't stop execution, cleanup is best-effort
-        print(f"--- Warning: Failed to delete uploaded file {file_name}: {e} ---")
+        logger.warning("Failed to delete uploaded file %s: %s", file_name, e)
+
+
+def list_uploaded_files() -> List[GeminiFile]:
+    """ Lists every file currently stored in the Gemini File API for this API key. """
+    with metrics.stage("list_files"):
+        return list(_sdk().list_files())
+
+
+# --- Async Execution Layer ---
+# Async variants of the helpers above. Each call is handed to a bounded thread pool
+# so a slow model call never stalls the event loop. After a timeout the caller gets
+# GeminiTimeoutError and the worker stops at its next model call attempt; an upload
+# that finishes anyway is deleted.
+
+_executor = ThreadPoolExecutor(max_workers=GEMINI_MAX_WORKERS, thread_name_prefix="gemini")
+_stats_lock = threading.Lock()
+_stats = {"in_flight": 0, "running": 0, "peak_in_flight": 0, "completed": 0, "timed_out": 0}
+
+def _run_tracked(func, *args, **kwargs):
+    """Runs on a worker thread; counts the calls actually occupying a thread."""
+    if is_cancelled():
+        raise GeminiTimeoutError(f"{func.__name__} abandoned: its caller timed out before it started.")
+    with _stats_lock:
+        _stats["running"] += 1
+    try:
+        return func(*args, **kwargs)
+    finally:
+        with _stats_lock:
+            _stats["running"] -= 1
+            _stats["completed"] += 1
+
+def _call_context(cancelled: threading.Event, deadline: Optional[float]) -> contextvars.Context:
+    """
+    A copy of the caller's context for a worker thread, so the scheduling priority of
+    the calling task applies there, carrying the call's cancel event and deadline.
+    """
+    context = contextvars.copy_context()
+    context.run(set_cancel_event, cancelled)
+    context.run(set_call_deadline, deadline)
+    return context
+
+async def _run_off_loop(func, *args, timeout: Optional[float] = None, **kwargs):
+    """Runs a blocking helper on the Gemini thread pool. Raises GeminiTimeoutError on timeout."""
+    loop = asyncio.get_running_loop()
+    timeout = GEMINI_CALL_TIMEOUT if timeout is None else timeout
+    cancelled = threading.Event()
+    with _stats_lock:
+        _stats["in_flight"] += 1
+        _stats["peak_in_flight"] = max(_stats["peak_in_flight"], _stats["in_flight"])
+    try:
+        context = _call_context(cancelled, time.monotonic() + timeout)
+        call = functools.partial(context.run, _run_tracked, func, *args, **kwargs)
+        return await asyncio.wait_for(loop.run_in_executor(_executor, call), timeout=timeout)
+    except asyncio.TimeoutError:
+        cancelled.set()
+        with _stats_lock:
+            _stats["timed_out"] += 1
+        logger.error("%s timed out after %ss", func.__name__, timeout)
+        raise GeminiTimeoutError(f"{func.__name__} timed out after {timeout}s") from None
+    except asyncio.CancelledError:
+        cancelled.set() # The awaiting task was cancelled, e.g. the client disconnected
+        raise
+    finally:
+        with _stats_lock:
+            _stats["in_flight"] -= 1
+
+def get_executor_stats() -> dict:
+    """ Returns a snapshot of the Gemini thread pool concurrency counters. """
+    with _stats_lock:
+        return {"max_workers": GEMINI_MAX_WORKERS, "call_timeout": GEMINI_CALL_TIMEOUT, **_stats}
+
+def shutdown_executor():
+    """ Stops accepting new Gemini calls; called when the app shuts down. """
+    _executor.shutdown(wait=False, cancel_futures=True)
+
+async def prewarm_async(extraction_model: str, lesson_model: str):
+    try:
+        await _run_off_loop(prewarm, extraction_model, lesson_model, timeout=GEMINI_CALL_TIMEOUT)
+    except GeminiTimeoutError:
+        pass # Logged; the SDK finishes loading on the worker or on first use
+
+async def upload_pdf_to_gemini_async(pdf_path: str, display_name: str, timeout: Optional[float] = None) -> Optional[GeminiFile]:
+    return await _run_off_loop(upload_pdf_to_gemini, pdf_path, display_name, timeout=timeout)
+
+async def extract_questions_from_pdf_async(
+    uploaded_file: GeminiFile,
+    model_name: str = "gemini-1.5-flash-latest",
+    timeout: Optional[float] = None
+) -> Optional[QuestionListResponse]:
+    return await _run_off_loop(extract_questions_from_pdf, uploaded_file, model_name, timeout=timeout or MODEL_CALL_TIMEOUT)
+
+async def generate_structured_lesson_async(
+    pdf_file_id: str,
+    selected_question_id: str,
+    selected_question_text: Optional[str],
+    model_name: str = "gemini-1.5-flash-latest",
+    timeout: Optional[float] = None
+) -> Optional[LessonResponse]:
+    return await _run_off_loop(
+        generate_structured_lesson, pdf_file_id, selected_question_id, selected_question_text, model_name,
+        timeout=timeout or MODEL_CALL_TIMEOUT
+    )
+
+async def parse_lesson_async(
+    response_text: str,
+    pdf_file_id: str,
+    selected_question_id: str,
+    selected_question_text: Optional[str],
+    model_name: str,
+    deadline: Optional[float] = None
+) -> Optional[LessonResponse]:
+    """
+    parse_lesson for a streamed lesson, with the continuation call for missing fields.
+    deadline (event loop time) is the one the stream was given, so the whole lesson shares it.
+    """
+    timeout = MODEL_CALL_TIMEOUT if deadline is None else deadline - asyncio.get_running_loop().time()
+    return await _run_off_loop(
+        parse_lesson,
+        response_text,
+        functools.partial(continue_lesson, pdf_file_id, selected_question_id, selected_question_text, model_name),
+        timeout=timeout
+    )
+
+async def delete_uploaded_file_async(file_name: Optional[str], timeout: Optional[float] = None):
+    try:
+        await _run_off_loop(delete_uploaded_file, file_name, timeout=timeout)
+    except GeminiTimeoutError:
+        pass # Best-effort, like delete_uploaded_file; the deletion may still finish on the worker
+
+async def _stream_off_loop(gen_func, *args, timeout: Optional[float] = None, deadline: Optional[float] = None) -> AsyncIterator[str]:
+    """
+    Drives a blocking generator on the Gemini thread pool and yields its items on
+    the event loop. The timeout applies to the wait for each item; the first item
+    may additionally wait for the scheduler. deadline (event loop time) bounds the
+    whole stream. Raises GeminiTimeoutError on timeout; the generator is then
+    stopped like an abandoned _run_off_loop call.
+    """
+    loop = asyncio.get_running_loop()
+    timeout = GEMINI_CALL_TIMEOUT if timeout is None else timeout
+    queue: asyncio.Queue = asyncio.Queue()
+    finished = object()
+    stop = threading.Event() # Doubles as the call's cancel event
+
+    def post(item, error=None):
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, (item, error))
+        except RuntimeError:
+            stop.set() # Event loop already closed
+
+    def pump():
+        try:
+            for item in gen_func(*args):
+                if stop.is_set():
+                    break
+                post(item)
+            post(finished)
+        except Exception as e:
+            post(finished, e)
+
+    with _stats_lock:
+        _stats["in_flight"] += 1
+        _stats["peak_in_flight"] = max(_stats["peak_in_flight"], _stats["in_flight"])
+    context = _call_context(stop, None if deadline is None else time.monotonic() + deadline - loop.time())
+    worker = loop.run_in_executor(_executor, functools.partial(context.run, _run_tracked, pump))
+    worker.add_done_callback(lambda future: future.cancelled() or future.exception()) # Abandoned before it started
+    first_item = True
+    try:
+        while True:
+            try:
+                item_timeout = timeout + GEMINI_SCHEDULER_MAX_WAIT if first_item else timeout
+                if deadline is not None:
+                    item_timeout = min(item_timeout, deadline - loop.time())
+                item, error = await asyncio.wait_for(queue.get(), timeout=item_timeout)
+                first_item = False
+            except asyncio.TimeoutError:
+                with _stats_lock:
+                    _stats["timed_out"] += 1
+                if deadline is not None and loop.time() >= deadline:
+                    message = f"{gen_func.__name__} did not finish before its deadline"
+                else:
+                    message = f"{gen_func.__name__} produced no output for {item_timeout:.1f}s"
+                logger.error("%s", message)
+                raise GeminiTimeoutError(message) from None
+            if item is finished:
+                if error:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        with _stats_lock:
+            _stats["in_flight"] -= 1
+
+def stream_questions_from_pdf_async(
+    uploaded_file: GeminiFile,
+    model_name: str = "gemini-1.5-flash-latest",
+    timeout: Optional[float] = None
+) -> AsyncIterator[str]:
+    return _stream_off_loop(stream_questions_from_pdf, uploaded_file, model_name, timeout=timeout)
 
+def stream_structured_lesson_async(
+    pdf_file_id: str,
+    selected_question_id: str,
+    selected_question_text: Optional[str],
+    model_name: str = "gemini-1.5-flash-latest",
+    timeout: Optional[float] = None,
+    deadline: Optional[float] = None
+) -> AsyncIterator[str]:
+    return _stream_off_loop(
+        stream_structured_lesson, pdf_file_id, selected_question_id, selected_question_text, model_name,
+        timeout=timeout, deadline=deadline
+    )
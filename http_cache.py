@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+HTTP caching helpers: JSON resources with strong ETags, conditional requests and
+gzip/brotli content negotiation, and static assets served from precompressed
+copies under content-versioned, immutable URLs. Brotli needs the optional
+'brotli' package; without it responses fall back to gzip.
+"""
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import tempfile
+from typing import Dict, List, Optional
+
+from fastapi import Request, Response
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse
+from starlette.staticfiles import NotModifiedResponse
+
+logger = logging.getLogger(__name__)
+
+try:
+    import brotli
+except ImportError:
+    logger.info("'brotli' is not installed. Responses are compressed with gzip only.")
+    brotli = None
+
+# --- Configuration ---
+COMPRESS_MIN_BYTES = 512 # Smaller bodies are sent uncompressed
+STATIC_PRECOMPRESSED_DIR = os.getenv("STATIC_PRECOMPRESSED_DIR", "cache/static") # Compressed copies of /static
+STATIC_COMPRESSIBLE = (".js", ".css", ".html", ".svg", ".json", ".txt", ".map")
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+_SUFFIXES = {"br": ".br", "gzip": ".gz"}
+
+
+def _accepted_encodings(request_headers: Headers) -> List[str]:
+    """ Encodings we can produce that the client accepts, best first. """
+    accepted = {}
+    for part in request_headers.get("accept-encoding", "").split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                continue
+        if name:
+            accepted[name.strip().lower()] = quality
+    available = (["br"] if brotli is not None else []) + ["gzip"]
+    return [encoding for encoding in available if accepted.get(encoding, accepted.get("*", 0)) > 0]
+
+
+def _compress(body: bytes, encoding: str, best: bool = False) -> bytes:
+    """ Fast settings for responses; best for static assets, which are compressed once. """
+    if encoding == "br":
+        return brotli.compress(body, quality=11 if best else 5)
+    return gzip.compress(body, compresslevel=9 if best else 6, mtime=0)
+
+
+def _etag_matches(if_none_match: Optional[str], digest: str) -> bool:
+    """ True if If-None-Match names any representation (identity or encoded) of this body. """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    for tag in if_none_match.split(","):
+        tag = tag.strip().removeprefix("W/").strip('"')
+        if tag.split("-", 1)[0] == digest:
+            return True
+    return False
+
+
+def cacheable_json(request: Request, body: str, cache_control: str) -> Response:
+    """
+    Returns a JSON body with a strong ETag and Cache-Control, compressed when the
+    client accepts it, or a 304 when the client's copy is current. Each encoding
+    is a separate representation with its own ETag.
+    """
+    raw = body.encode("utf-8")
+    digest = hashlib.sha256(raw).hexdigest()[:32]
+    headers = {"Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+    encoding = None
+    if len(raw) >= COMPRESS_MIN_BYTES:
+        encoding = next(iter(_accepted_encodings(request.headers)), None)
+    headers["ETag"] = f'"{digest}-{_SUFFIXES[encoding][1:]}"' if encoding else f'"{digest}"'
+    if _etag_matches(request.headers.get("if-none-match"), digest):
+        return Response(status_code=304, headers=headers)
+    if encoding:
+        raw = _compress(raw, encoding)
+        headers["Content-Encoding"] = encoding
+    return Response(content=raw, media_type="application/json", headers=headers)
+
+
+# --- Static Assets ---
+
+def _write_atomically(path: str, data: bytes):
+    """ Writes via a temp file and rename, so concurrent workers never see a partial file. """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, "wb") as temp_file:
+        temp_file.write(data)
+    os.replace(temp_path, path)
+
+
+def build_static_assets(directory: str, output_dir: str = STATIC_PRECOMPRESSED_DIR) -> Dict[str, str]:
+    """
+    Writes gzip (and brotli) copies of the compressible files in directory to
+    output_dir, skipping copies that are already up to date. Returns the content
+    version (hash prefix) of every file, by path relative to directory.
+    """
+    versions = {}
+    for root, _, files in os.walk(directory):
+        for file_name in files:
+            source_path = os.path.join(root, file_name)
+            relative_path = os.path.relpath(source_path, directory).replace(os.sep, "/")
+            with open(source_path, "rb") as source_file:
+                content = source_file.read()
+            versions[relative_path] = hashlib.sha256(content).hexdigest()[:12]
+            if not file_name.endswith(STATIC_COMPRESSIBLE):
+                continue
+            source_mtime = os.stat(source_path).st_mtime
+            for encoding in (["br"] if brotli is not None else []) + ["gzip"]:
+                target_path = os.path.join(output_dir, relative_path + _SUFFIXES[encoding])
+                if os.path.exists(target_path) and os.stat(target_path).st_mtime >= source_mtime:
+                    continue
+                _write_atomically(target_path, _compress(content, encoding, best=True))
+    logger.info("Prepared %s static assets (precompressed copies in %s).", len(versions), output_dir)
+    return versions
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """
+    StaticFiles that serves a precompressed copy when the client accepts it, and
+    marks requests for the current version (?v=<hash>, see url) immutable.
+    """
+
+    def __init__(self, *args, precompressed_dir: str = STATIC_PRECOMPRESSED_DIR, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.precompressed_dir = precompressed_dir
+        self.versions = build_static_assets(str(self.directory), precompressed_dir)
+
+    def url(self, path: str) -> str:
+        """ Versioned URL of a static file; changes whenever the file's content does. """
+        version = self.versions.get(path)
+        return f"/static/{path}?v={version}" if version else f"/static/{path}"
+
+    def file_response(self, full_path, stat_result, scope, status_code: int = 200):
+        request_headers = Headers(scope=scope)
+        relative_path = os.path.relpath(full_path, str(self.directory)).replace(os.sep, "/")
+        headers = {"Cache-Control": self._cache_control(relative_path, scope)}
+        response = None
+        if relative_path.endswith(STATIC_COMPRESSIBLE):
+            headers["Vary"] = "Accept-Encoding"
+            for encoding in _accepted_encodings(request_headers):
+                variant_path = os.path.join(self.precompressed_dir, relative_path + _SUFFIXES[encoding])
+                try:
+                    variant_stat = os.stat(variant_path)
+                except OSError:
+                    continue
+                if variant_stat.st_mtime < stat_result.st_mtime:
+                    continue # Stale copy; the source changed after it was built
+                response = FileResponse(
+                    variant_path, status_code=status_code, stat_result=variant_stat,
+                    media_type=mimetypes.guess_type(str(full_path))[0] or "application/octet-stream",
+                    headers={**headers, "Content-Encoding": encoding}
+                )
+                break
+        if response is None:
+            response = FileResponse(full_path, status_code=status_code, stat_result=stat_result, headers=headers)
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
+    def _cache_control(self, relative_path: str, scope) -> str:
+        query = scope.get("query_string", b"").decode("latin-1")
+        version = self.versions.get(relative_path)
+        if version and f"v={version}" in query.split("&"):
+            return IMMUTABLE_CACHE_CONTROL
+        return "no-cache" # Unversioned URLs revalidate (cheaply, via ETag) on every use
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+Background job queue: endpoints hand long pipelines to a pool of worker tasks and
+return a job ID right away. The job store keeps per-stage status and timing that
+clients poll (GET /jobs/{id}) or subscribe to (GET /jobs/{id}/events), in the
+shared cache database so any worker process can answer for any job.
+"""
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from cache import CACHE_DB_PATH, connect
+from models import JobStatus, JobStageModel
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4")) # Jobs processed at once
+JOB_QUEUE_MAX = int(os.getenv("JOB_QUEUE_MAX", "100")) # Jobs waiting beyond this are rejected
+JOB_RETENTION_SECONDS = int(os.getenv("JOB_RETENTION_SECONDS", "3600")) # Finished jobs are kept this long
+JOB_POLL_SECONDS = 0.5 # How often subscribers check for changes to jobs run by another worker
+
+TERMINAL_STATUSES = ("succeeded", "failed")
+
+
+class QueueFullError(Exception):
+    """ Raised when a job is submitted while the queue is at JOB_QUEUE_MAX. """
+
+
+class JobStore:
+    """
+    Store of job states with change notification for subscribers. A job is only
+    changed by the worker process running it, which keeps it in memory and writes
+    every change through to SQLite; other processes read it from there. Writes run
+    in order on a single writer thread, so waiting for another worker's write never
+    holds up the event loop.
+    """
+
+    def __init__(self, db_path: str = CACHE_DB_PATH, retention_seconds: int = JOB_RETENTION_SECONDS):
+        self.retention_seconds = retention_seconds
+        self._jobs: Dict[str, JobStatus] = {} # Jobs created by this process
+        self._changed: Dict[str, asyncio.Event] = {}
+        self._versions: Dict[str, int] = {}
+        self._conn = connect(db_path) # Reads, on the event loop
+        self._write_conn = connect(db_path) # Used only by the writer thread
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="job-store")
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " job_id TEXT PRIMARY KEY,"
+                " status TEXT NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " version INTEGER NOT NULL,"
+                " job_json TEXT NOT NULL)"
+            )
+
+    def create(self, kind: str, stage_names: List[str]) -> JobStatus:
+        self._prune()
+        job = JobStatus(
+            jobId=uuid.uuid4().hex,
+            kind=kind,
+            createdAt=time.time(),
+            stages=[JobStageModel(name=name) for name in stage_names]
+        )
+        self._jobs[job.jobId] = job
+        self._changed[job.jobId] = asyncio.Event()
+        self._versions[job.jobId] = 0
+        self._save(job)
+        return job
+
+    def get(self, job_id: str) -> Optional[JobStatus]:
+        job = self._jobs.get(job_id)
+        if job is not None:
+            return job
+        row = self._conn.execute("SELECT job_json FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return JobStatus.model_validate_json(row["job_json"]) if row else None
+
+    def start_stage(self, job_id: str, stage_name: str):
+        """ Marks a stage (and the job) as running. """
+        job = self._jobs[job_id]
+        job.status = "running"
+        stage = self._stage(job, stage_name)
+        stage.status = "running"
+        stage.startedAt = time.time()
+        self._notify(job_id)
+
+    def finish_stage(self, job_id: str, stage_name: str, start_next: bool = True):
+        """ Marks a stage done and, unless start_next is False, starts the next pending one. """
+        job = self._jobs[job_id]
+        stage = self._stage(job, stage_name)
+        now = time.time()
+        stage.status = "done"
+        stage.startedAt = stage.startedAt or now
+        stage.finishedAt = now
+        stage.durationMs = round((now - stage.startedAt) * 1000, 1)
+        next_stage = next((s for s in job.stages if s.status == "pending"), None)
+        if next_stage and start_next:
+            next_stage.status = "running"
+            next_stage.startedAt = now
+        self._notify(job_id)
+
+    def mark_queued(self, job_id: str):
+        """ Marks a job as waiting for a worker. """
+        self._jobs[job_id].status = "queued"
+        self._notify(job_id)
+
+    def succeed(self, job_id: str, result):
+        job = self._jobs[job_id]
+        for stage in job.stages:
+            if stage.status != "done":
+                self.finish_stage(job_id, stage.name)
+        job.status = "succeeded"
+        job.result = result
+        self._notify(job_id)
+
+    def fail(self, job_id: str, error: str):
+        job = self._jobs[job_id]
+        now = time.time()
+        for stage in job.stages:
+            if stage.status == "running":
+                stage.status = "failed"
+                stage.finishedAt = now
+                stage.durationMs = round((now - (stage.startedAt or now)) * 1000, 1)
+        job.status = "failed"
+        job.error = error
+        self._notify(job_id)
+
+    def version(self, job_id: str) -> int:
+        """ Change counter of a job; pass it to wait_for_change so no update is missed. """
+        if job_id in self._versions:
+            return self._versions[job_id]
+        row = self._conn.execute("SELECT version FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return row["version"] if row else 0
+
+    async def wait_for_change(self, job_id: str, seen_version: int, timeout: float) -> bool:
+        """ Waits until the job changes after seen_version. Returns False on timeout. """
+        event = self._changed.get(job_id)
+        if event is None:
+            return await self._poll_for_change(job_id, seen_version, timeout)
+        if self._versions[job_id] != seen_version:
+            return True
+        try:
+            await asyncio.wait_for(event.wait(), timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def _poll_for_change(self, job_id: str, seen_version: int, timeout: float) -> bool:
+        """ wait_for_change for a job run by another worker process. """
+        deadline = time.monotonic() + timeout
+        while True:
+            if self.version(job_id) != seen_version:
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            await asyncio.sleep(min(JOB_POLL_SECONDS, remaining))
+
+    def stats(self) -> dict:
+        """ Job counts by status, across all worker processes. """
+        rows = self._conn.execute("SELECT status, COUNT(*) AS jobs FROM jobs GROUP BY status").fetchall()
+        return {row["status"]: row["jobs"] for row in rows}
+
+    def _stage(self, job: JobStatus, stage_name: str) -> JobStageModel:
+        return next(stage for stage in job.stages if stage.name == stage_name)
+
+    def _notify(self, job_id: str):
+        # Wake current subscribers, and give later ones a fresh event to wait on
+        self._versions[job_id] += 1
+        self._save(self._jobs[job_id])
+        self._changed[job_id].set()
+        self._changed[job_id] = asyncio.Event()
+
+    def _save(self, job: JobStatus):
+        # Serialised now, so the row matches this version even if the job changes before it is written
+        self._write(
+            "INSERT OR REPLACE INTO jobs (job_id, status, created_at, version, job_json) VALUES (?, ?, ?, ?, ?)",
+            (job.jobId, job.status, job.createdAt, self._versions[job.jobId], job.model_dump_json())
+        )
+
+    def _prune(self):
+        cutoff = time.time() - self.retention_seconds
+        for job_id in [j.jobId for j in self._jobs.values() if j.status in TERMINAL_STATUSES and j.createdAt < cutoff]:
+            del self._jobs[job_id]
+            self._changed.pop(job_id, None)
+            self._versions.pop(job_id, None)
+        self._write(
+            "DELETE FROM jobs WHERE created_at < ? AND status IN (%s)" % ", ".join("?" * len(TERMINAL_STATUSES)),
+            (cutoff, *TERMINAL_STATUSES)
+        )
+
+    def _write(self, sql: str, params: Tuple):
+        """ Queues a write for the writer thread. """
+        self._writer.submit(self._execute_write, sql, params)
+
+    def _execute_write(self, sql: str, params: Tuple):
+        try:
+            with self._write_conn:
+                self._write_conn.execute(sql, params)
+        except sqlite3.Error as e:
+            logger.error("Failed to write job state: %s: %s", type(e).__name__, e)
+
+
+class JobQueue:
+    """ Fixed pool of worker tasks running submitted job coroutines in FIFO order. """
+
+    def __init__(self, worker_count: int = JOB_WORKERS, max_queued: int = JOB_QUEUE_MAX):
+        self.worker_count = worker_count
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queued)
+        self._workers: List[asyncio.Task] = []
+
+    def start(self):
+        self._workers = [asyncio.create_task(self._work(), name=f"job-worker-{i}") for i in range(self.worker_count)]
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def submit(self, run: Callable[[], Awaitable[None]]):
+        """ Queues a job coroutine factory. Raises QueueFullError when the queue is full. """
+        try:
+            self._queue.put_nowait(run)
+        except asyncio.QueueFull:
+            raise QueueFullError()
+
+    def stats(self) -> dict:
+        return {"workers": self.worker_count, "queued": self._queue.qsize()}
+
+    async def _work(self):
+        while True:
+            run = await self._queue.get()
+            try:
+                await run()
+            except Exception as e:
+                logger.exception("Unexpected error in background job: %s", e)
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+Salvage of model JSON that failed validation: truncated documents are closed at
+the last complete value, and the result is normalised towards the response models
+(numbers given as strings, unknown fields, missing visualAid). What is still
+missing afterwards is reported so it can be asked for on its own instead of
+regenerating the whole response.
+"""
+import json
+import re
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import metrics
+from models import ExtractedQuestionItem, LessonDataModel, StepModel, VisualAidModel
+
+_LITERAL_END = re.compile(r"[\s,\]}]")
+_PARTIAL_ESCAPE = re.compile(r"\\(u[0-9a-fA-F]{0,3})?$")
+_LEADING_INT = re.compile(r"-?\d+")
+
+_stats = {"attempted": 0, "repaired": 0, "continued": 0, "failed": 0}
+
+
+# --- Truncated JSON ---
+
+def close_truncated_json(text: str) -> str:
+    """
+    Returns text with a cut-off JSON document completed: an open string value is
+    closed, a partial key or literal is dropped back to the last complete value,
+    and every open array and object is closed. Complete documents are unchanged.
+    """
+    text = text.strip()
+    stack: List[str] = [] # Closers of the open containers
+    safe: Optional[Tuple[int, Tuple[str, ...]]] = None # Cut point after the last complete value
+    in_string = string_is_key = escaped = expect_key = False
+    literal_start = None
+    for index, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+                if not string_is_key:
+                    safe = (index + 1, tuple(stack))
+            continue
+        if literal_start is not None and _LITERAL_END.match(char):
+            safe = (index, tuple(stack))
+            literal_start = None
+        if char == '"':
+            in_string = True
+            string_is_key = expect_key
+        elif char in "{[":
+            stack.append("}" if char == "{" else "]")
+            expect_key = char == "{"
+            safe = (index + 1, tuple(stack))
+        elif char in "}]":
+            if stack:
+                stack.pop()
+            expect_key = False
+            safe = (index + 1, tuple(stack))
+        elif char == ",":
+            expect_key = bool(stack) and stack[-1] == "}"
+        elif char == ":":
+            expect_key = False
+        elif not char.isspace() and literal_start is None:
+            literal_start = index
+
+    if not stack and not in_string:
+        return text
+    if in_string and not string_is_key:
+        return _PARTIAL_ESCAPE.sub("", text) + '"' + "".join(reversed(stack))
+    if literal_start is not None and not in_string and _is_literal(text[literal_start:]):
+        return text + "".join(reversed(stack))
+    if safe is None:
+        return text
+    cut, open_containers = safe
+    return text[:cut].rstrip().rstrip(",") + "".join(reversed(open_containers))
+
+
+def truncated_path(text: str) -> List[Union[str, int]]:
+    """
+    The object keys and array indexes of the values still open where a cut-off JSON
+    document stops, outermost first; [] if the document is complete. Values on the
+    path may have been closed early by close_truncated_json, so they are partial.
+    """
+    text = text.strip()
+    frames: List[List[Any]] = [] # [closer, current key or index] per open container
+    in_string = string_is_key = escaped = expect_key = False
+    key_start = 0
+    for index, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+                if string_is_key and frames:
+                    try:
+                        frames[-1][1] = json.loads(text[key_start:index + 1])
+                    except ValueError:
+                        pass
+            continue
+        if char == '"':
+            in_string = True
+            string_is_key = expect_key
+            key_start = index
+        elif char in "{[":
+            frames.append(["}", None] if char == "{" else ["]", 0])
+            expect_key = char == "{"
+        elif char in "}]":
+            if frames:
+                frames.pop()
+            expect_key = False
+        elif char == ",":
+            if frames and frames[-1][0] == "]":
+                frames[-1][1] += 1
+            elif frames:
+                frames[-1][1] = None
+            expect_key = bool(frames) and frames[-1][0] == "}"
+        elif char == ":":
+            expect_key = False
+    if not frames and not in_string:
+        return []
+    path = []
+    for _, position in frames:
+        if position is None:
+            break # Cut between two entries of this object
+        path.append(position)
+    return path
+
+
+def _is_literal(token: str) -> bool:
+    try:
+        json.loads(token)
+    except ValueError:
+        return False
+    return True
+
+
+def load_partial(text: str) -> Optional[Any]:
+    """ Parses text as JSON, closing it first if it was cut off. None if it cannot be salvaged. """
+    for candidate in (text, close_truncated_json(text)):
+        try:
+            return json.loads(candidate)
+        except ValueError:
+            continue
+    return None
+
+
+# --- Normalisation towards the response models ---
+
+def _known_fields(data: Dict[str, Any], model) -> Dict[str, Any]:
+    return {key: value for key, value in data.items() if key in model.model_fields}
+
+
+def _to_int(value: Any) -> Optional[int]:
+    """ 3, 3.0, "3", "Step 3" and "3." all become 3. """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, str):
+        match = _LEADING_INT.search(value)
+        return int(match.group()) if match else None
+    return None
+
+
+def repair_lesson(data: Any) -> Optional[Dict[str, Any]]:
+    """ Normalises a parsed lesson document. Returns the lessonData dict, or None if there is none. """
+    if not isinstance(data, dict):
+        return None
+    lesson_data = data.get("lessonData", data if "steps" in data or "coreConceptHtml" in data else None)
+    if not isinstance(lesson_data, dict):
+        return None
+    lesson_data = _known_fields(lesson_data, LessonDataModel)
+    for key in ("questionId", "questionText", "subject", "topic", "coreConceptHtml"):
+        if isinstance(lesson_data.get(key), (int, float)):
+            lesson_data[key] = str(lesson_data[key])
+
+    if "steps" in lesson_data:
+        steps = []
+        for position, step in enumerate(lesson_data["steps"] if isinstance(lesson_data["steps"], list) else [], start=1):
+            if not isinstance(step, dict) or not step.get("title") or not step.get("descriptionHtml"):
+                continue # Cut off mid-step
+            step = _known_fields(step, StepModel)
+            step["stepNumber"] = _to_int(step.get("stepNumber")) or position
+            steps.append(step)
+        if steps:
+            lesson_data["steps"] = steps
+        else:
+            del lesson_data["steps"]
+
+    hints = lesson_data.get("hints")
+    if isinstance(hints, str):
+        lesson_data["hints"] = [hints]
+    elif isinstance(hints, list):
+        lesson_data["hints"] = [str(hint) for hint in hints if hint is not None]
+
+    visual_aid = lesson_data.get("visualAid")
+    if isinstance(visual_aid, bool):
+        visual_aid = {"isPresent": visual_aid}
+    if isinstance(visual_aid, dict):
+        visual_aid = _known_fields(visual_aid, VisualAidModel)
+        visual_aid.setdefault("imageUrl", None)
+        if not isinstance(visual_aid.get("isPresent"), bool):
+            visual_aid["isPresent"] = bool(visual_aid["imageUrl"])
+        lesson_data["visualAid"] = visual_aid
+    else:
+        lesson_data["visualAid"] = {"imageUrl": None, "isPresent": False}
+    return lesson_data
+
+
+def missing_lesson_fields(lesson_data: Dict[str, Any]) -> List[str]:
+    """ Required lessonData fields the repaired document still lacks. """
+    return [
+        name for name, field in LessonDataModel.model_fields.items()
+        if field.is_required() and lesson_data.get(name) in (None, "")
+    ]
+
+
+def truncated_lesson_field(text: str) -> Optional[str]:
+    """
+    The lessonData field a cut-off lesson document ended in, or None if the document
+    is complete or stopped between fields. Its value may look valid but be partial,
+    e.g. steps missing their last entries, a string closed mid-sentence or a number
+    missing its last digits.
+    """
+    path = truncated_path(text)
+    if path[:1] == ["lessonData"]:
+        path = path[1:]
+    return path[0] if path and path[0] in LessonDataModel.model_fields else None
+
+
+def repair_question_list(data: Any, pdf_file_id: str, cut_path: Optional[List[Union[str, int]]] = None) -> Optional[Dict[str, Any]]:
+    """
+    Normalises a parsed question list. Questions cut off before their text are
+    dropped, as is the question the document stopped in (cut_path, see truncated_path).
+    """
+    if not isinstance(data, dict) or not isinstance(data.get("questions"), list):
+        return None
+    cut_index = cut_path[1] if cut_path and len(cut_path) > 1 and cut_path[0] == "questions" else None
+    questions = []
+    for index, item in enumerate(data["questions"]):
+        if index == cut_index:
+            continue # Still being written when the output stopped
+        if not isinstance(item, dict) or item.get("questionId") in (None, "") or not item.get("questionText"):
+            continue
+        item = _known_fields(item, ExtractedQuestionItem)
+        item["questionId"] = str(item["questionId"])
+        for key in ("pageStart", "pageEnd"):
+            if key in item:
+                item[key] = _to_int(item[key])
+        questions.append(item)
+    return {"pdfFileId": str(data.get("pdfFileId") or pdf_file_id), "questions": questions}
+
+
+# --- Outcome Counters ---
+
+def record(kind: str, outcome: str):
+    """ Counts a repair attempt's outcome: 'repaired', 'continued' (after a continuation call) or 'failed'. """
+    _stats["attempted"] += 1
+    _stats[outcome] += 1
+    metrics.json_repairs.inc(kind=kind, outcome=outcome)
+
+
+def stats() -> dict:
+    return {**_stats, "regenerations_avoided": _stats["repaired"] + _stats["continued"]}
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental JSON scanner for streamed model output.
+
+Gemini streams its JSON response as arbitrary text chunks. JsonStreamParser is fed
+those chunks and reports every value at a watched path as soon as the value is
+complete, e.g. each item of "questions" before the array itself has been closed.
+"""
+import json
+from typing import Any, Dict, List, Sequence, Tuple
+
+WILDCARD = "*" # Matches any object key or array index in a watched path
+
+_WHITESPACE = " \t\r\n"
+
+
+def _path_matches(pattern: Sequence[Any], path: Sequence[Any]) -> bool:
+    return len(pattern) == len(path) and all(p == WILDCARD or p == k for p, k in zip(pattern, path))
+
+
+class JsonStreamParser:
+    """
+    Tracks nesting while text is fed in and emits (event_name, value) pairs for
+    completed values whose path matches one of the watched patterns.
+
+        parser = JsonStreamParser({("questions", "*"): "question"})
+        for chunk in chunks:
+            for event, value in parser.feed(chunk): ...
+    """
+
+    def __init__(self, watch: Dict[Tuple[Any, ...], str]):
+        self.watch = watch
+        self.text = ""
+        self._pos = 0
+        # One frame per open container: [kind ('obj'/'arr'), current key or index, expecting a key?]
+        self._stack: List[list] = []
+        self._in_string = False
+        self._string_is_key = False
+        self._string_start = 0
+        self._escape = False
+        self._in_primitive = False
+        self._pending: Dict[int, Tuple[int, str]] = {} # depth -> (start offset, event name)
+
+    def feed(self, chunk: str) -> List[Tuple[str, Any]]:
+        """ Consumes a chunk of text and returns the watched values completed by it. """
+        self.text += chunk
+        events: List[Tuple[str, Any]] = []
+        text = self.text
+        i = self._pos
+        while i < len(text):
+            c = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    if self._string_is_key:
+                        self._stack[-1][1] = json.loads(text[self._string_start:i + 1])
+                        self._stack[-1][2] = False
+                    else:
+                        self._value_end(i + 1, events)
+                i += 1
+                continue
+            if self._in_primitive:
+                if c not in _WHITESPACE and c not in ",]}":
+                    i += 1
+                    continue
+                self._in_primitive = False
+                self._value_end(i, events) # Delimiter is processed below
+            if c in _WHITESPACE or c == ":":
+                pass
+            elif c == "{" or c == "[":
+                self._value_start(i)
+                self._stack.append(["obj", None, True] if c == "{" else ["arr", 0, False])
+            elif c == "}" or c == "]":
+                if self._stack:
+                    self._stack.pop()
+                self._value_end(i + 1, events)
+            elif c == ",":
+                if self._stack:
+                    frame = self._stack[-1]
+                    if frame[0] == "obj":
+                        frame[2] = True
+                    else:
+                        frame[1] += 1
+            elif c == '"':
+                self._in_string = True
+                self._string_start = i
+                self._string_is_key = bool(self._stack) and self._stack[-1][0] == "obj" and self._stack[-1][2]
+                if not self._string_is_key:
+                    self._value_start(i)
+            else:
+                self._in_primitive = True
+                self._value_start(i)
+            i += 1
+        self._pos = i
+        return events
+
+    def _value_start(self, offset: int):
+        path = tuple(frame[1] for frame in self._stack)
+        for pattern, name in self.watch.items():
+            if _path_matches(pattern, path):
+                self._pending[len(self._stack)] = (offset, name)
+                break
+
+    def _value_end(self, end: int, events: List[Tuple[str, Any]]):
+        pending = self._pending.pop(len(self._stack), None)
+        if pending is None:
+            return
+        start, name = pending
+        try:
+            events.append((name, json.loads(self.text[start:end])))
+        except ValueError:
+            pass # Malformed fragment; the final validation will report it
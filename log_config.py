@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Logging setup: records are handed to a queue on the calling thread and written as
+JSON lines (or plain text) by a background listener thread, so formatting and
+stdout I/O never block a request. Every record carries the correlation ID of the
+request that produced it.
+"""
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
+import uuid
+from typing import Optional
+
+# --- Configuration ---
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json") # "json" or "text"
+LOG_PAYLOAD_CHARS = int(os.getenv("LOG_PAYLOAD_CHARS", "500")) # Raw model output kept in logs below DEBUG
+
+# Correlation ID of the current request; copied into tasks and worker threads with the context
+_correlation_id: contextvars.ContextVar = contextvars.ContextVar("correlation_id", default="-")
+
+# Attributes every LogRecord has; anything else was passed via extra= and is emitted as a field
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "correlation_id"}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def new_correlation_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+def set_correlation_id(correlation_id: str):
+    _correlation_id.set(correlation_id)
+
+
+def get_correlation_id() -> str:
+    return _correlation_id.get()
+
+
+def truncate_payload(logger: logging.Logger, text: Optional[str]) -> Optional[str]:
+    """ Returns raw model output cut to LOG_PAYLOAD_CHARS, or in full when the logger is at DEBUG. """
+    if text is None or logger.isEnabledFor(logging.DEBUG) or len(text) <= LOG_PAYLOAD_CHARS:
+        return text
+    return f"{text[:LOG_PAYLOAD_CHARS]}... [truncated, {len(text)} chars]"
+
+
+class _CorrelationFilter(logging.Filter):
+    """ Stamps the correlation ID on the calling thread, before the record is queued. """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.correlation_id = _correlation_id.get()
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """ Queues records with only the message merged; all output formatting happens on the listener. """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.message = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # Tracebacks hold frame references, so render them before crossing threads
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """ One JSON object per line: time, level, logger, correlation ID, message and any extra fields. """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "correlation_id": getattr(record, "correlation_id", "-"),
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+def configure_logging():
+    """ Routes all logging through a queue to a stdout handler on a listener thread. Idempotent. """
+    global _listener
+    if _listener is not None:
+        return
+    output = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == "text":
+        output.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(correlation_id)s] %(name)s: %(message)s"))
+    else:
+        output.setFormatter(JsonFormatter())
+
+    log_queue: queue.Queue = queue.Queue(-1)
+    queue_handler = _QueueHandler(log_queue)
+    queue_handler.addFilter(_CorrelationFilter())
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    for name in ("uvicorn", "uvicorn.access", "uvicorn.error"):
+        # Let uvicorn's records reach the queue instead of its own stderr handlers
+        logging.getLogger(name).handlers = []
+        logging.getLogger(name).propagate = True
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
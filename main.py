@@ -3,42 +3,141 @@ import os
 import pathlib
 import tempfile
 import shutil
+import secrets
+import asyncio
+import json
+import logging
+from contextlib import asynccontextmanager
 from typing import Optional, Union
-import uvicorn
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Request, Body # Import Body
-from fastapi.responses import HTMLResponse, JSONResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Request, Body, Header, Path # Import Body
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse, PlainTextResponse
 from fastapi.templating import Jinja2Templates
 from dotenv import load_dotenv
-import google.generativeai as genai
+
+# Load .env before importing the modules below; they read their settings at import time
+load_dotenv()
+
+import log_config
+log_config.configure_logging() # Before the other imports, so their import-time warnings are queued too
+logger = logging.getLogger(__name__)
 
 # Import utility functions and models
 import gemini_utils
+import http_cache
+import json_repair
+import metrics
+import scheduler
+import services
+import uploads
+from jobs import JobStore, JobQueue, QueueFullError, TERMINAL_STATUSES
+from file_lifecycle import FILE_RECONCILE_ON_STARTUP
+from services import paper_index, lesson_cache
 # Import all necessary response models
-from models import LessonResponse, ErrorResponse, QuestionListResponse, GenerateLessonRequest
+from models import (
+    LessonResponse, ErrorResponse, QuestionListResponse, GenerateLessonRequest,
+    BatchLessonRequest, BatchLessonItem, StepModel, JobStatus
+)
 
 # --- Configuration ---
-load_dotenv()
 API_KEY = os.getenv("GEMINI_API_KEY")
 
 if not API_KEY:
-    print("Error: GEMINI_API_KEY environment variable not set.")
+    logger.error("GEMINI_API_KEY environment variable not set.")
     exit(1)
+# The Gemini SDK is imported and configured in the background once the app has started,
+# instead of on import; /ready reports when that is done. Without it, the first call does it.
+GEMINI_PREWARM = os.getenv("GEMINI_PREWARM", "1") == "1"
 
-try:
-    genai.configure(api_key=API_KEY)
-    print("Gemini API Key configured successfully.")
-except Exception as e:
-    print(f"Error configuring Gemini API: {e}")
-    exit(1)
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN") # Admin endpoints are disabled when unset
+JOB_EVENTS_KEEPALIVE_SECONDS = 15 # Comment lines keep idle job subscriptions open through proxies
+# Question lists name the paper's current upload, which changes when it is re-uploaded
+QUESTIONS_CACHE_CONTROL = "public, max-age=300"
+# Lessons only change when the cache is purged or the prompt changes; shared caches may serve them stale meanwhile
+LESSON_CACHE_CONTROL = "public, max-age=86400, stale-while-revalidate=604800"
+PAPER_HASH_PATTERN = "^[0-9a-f]{64}$"
+
+job_store = JobStore()
+job_queue = JobQueue()
 
 # --- FastAPI App Setup ---
-app = FastAPI(title="LessonGenie API")
-app.mount("/static", StaticFiles(directory="static"), name="static")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    job_queue.start()
+    # Reconciliation lists files through the SDK, so without pre-warm it would import it at boot
+    if FILE_RECONCILE_ON_STARTUP and not GEMINI_PREWARM:
+        logger.info("Skipping startup file reconciliation because GEMINI_PREWARM is off.")
+    services.file_manager.start(reconcile=FILE_RECONCILE_ON_STARTUP and GEMINI_PREWARM)
+    if GEMINI_PREWARM:
+        # Not awaited, so the server starts accepting connections while the SDK loads
+        task = asyncio.create_task(
+            gemini_utils.prewarm_async(services.EXTRACTION_MODEL_NAME, services.LESSON_MODEL_NAME),
+            name="gemini-prewarm"
+        )
+        _background_tasks.add(task) # Keep a reference until it finishes
+        task.add_done_callback(_background_tasks.discard)
+        task.add_done_callback(_log_task_failure)
+    yield
+    await services.file_manager.stop()
+    await job_queue.stop()
+    # Release the Gemini worker threads on shutdown
+    gemini_utils.shutdown_executor()
+
+app = FastAPI(title="LessonGenie API", lifespan=lifespan)
+static_files = http_cache.PrecompressedStaticFiles(directory="static")
+app.mount("/static", static_files, name="static")
 templates = Jinja2Templates(directory="templates")
+templates.env.globals["static_url"] = static_files.url # Versioned asset URLs, cached as immutable
 TEMP_DIR_BASE = "temp_uploads"
 pathlib.Path(TEMP_DIR_BASE).mkdir(exist_ok=True)
 
+UPLOAD_PATHS = {"/extract-questions", "/extract-questions/stream", "/extract-questions/jobs"}
+
+@app.middleware("http")
+async def reject_oversized_uploads(request: Request, call_next):
+    """Rejects uploads whose declared size is over the limit before the body is read."""
+    if request.method == "POST" and request.url.path in UPLOAD_PATHS \
+            and uploads.content_length_too_large(request.headers.get("content-length")):
+        return JSONResponse(
+            status_code=413,
+            content=ErrorResponse(detail=uploads.too_large_detail()).model_dump()
+        )
+    return await call_next(request)
+
+# Bodies without a (truthful) Content-Length are cut off once they pass the limit
+app.add_middleware(uploads.UploadBodyLimit, paths=UPLOAD_PATHS)
+
+@app.middleware("http")
+async def observe_requests(request: Request, call_next):
+    """Counts requests and errors per endpoint and adds the Server-Timing header when enabled."""
+    metrics.start_request_timings()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    endpoint = getattr(route, "path", "other") # Route template, e.g. /jobs/{job_id}
+    metrics.endpoint_requests.inc(endpoint=endpoint, status=response.status_code)
+    if response.status_code >= 400:
+        metrics.endpoint_errors.inc(endpoint=endpoint, status=response.status_code)
+    if metrics.SERVER_TIMING_ENABLED:
+        server_timing = metrics.server_timing_header()
+        if server_timing:
+            response.headers["Server-Timing"] = server_timing
+    return response
+
+@app.middleware("http")
+async def assign_correlation_id(request: Request, call_next):
+    """Tags every log line of a request with its X-Request-ID (taken from the client or generated)."""
+    correlation_id = request.headers.get("x-request-id") or log_config.new_correlation_id()
+    log_config.set_correlation_id(correlation_id[:64])
+    response = await call_next(request)
+    response.headers["X-Request-ID"] = correlation_id[:64]
+    return response
+
+metrics.CallbackGauge("lessongenie_gemini_calls_in_flight", "Gemini calls submitted and not yet finished.",
+                      lambda: gemini_utils.get_executor_stats()["in_flight"])
+metrics.CallbackGauge("lessongenie_scheduler_queue_depth", "Gemini calls waiting for rate-limit capacity.",
+                      lambda: sum(scheduler.gemini_scheduler.stats()["queue_depth"].values()))
+metrics.CallbackGauge("lessongenie_jobs_queued", "Background jobs waiting for a worker.",
+                      lambda: job_queue.stats()["queued"])
+
 # --- API Endpoints ---
 
 @app.get("/", response_class=HTMLResponse)
@@ -46,6 +145,79 @@ async def read_root(request: Request):
     """Serves the main HTML page."""
     return templates.TemplateResponse("index.html", {"request": request})
 
+async def _save_upload(pdf_file: UploadFile):
+    """ Streams an uploaded PDF into a fresh temp directory. Returns (temp_dir_path, temp_pdf_path, sha256 digest). """
+    temp_dir_path = tempfile.mkdtemp(dir=TEMP_DIR_BASE)
+    # Only keep the base name; the client controls the filename
+    temp_pdf_path = os.path.join(temp_dir_path, os.path.basename(pdf_file.filename or "") or "temp_upload.pdf")
+
+    logger.debug("Saving uploaded file temporarily to: %s", temp_pdf_path)
+    try:
+        with metrics.stage("save"):
+            pdf_digest, pdf_size = await uploads.save_pdf_upload(pdf_file, temp_pdf_path)
+    except BaseException:
+        _remove_temp_dir(temp_dir_path)
+        raise
+    logger.info("Saved %s bytes (sha256 %s).", pdf_size, pdf_digest[:12])
+    return temp_dir_path, temp_pdf_path, pdf_digest
+
+def _remove_temp_dir(temp_dir_path: Optional[str]):
+    if temp_dir_path and os.path.exists(temp_dir_path):
+        try:
+            logger.debug("Removing temporary directory: %s", temp_dir_path)
+            shutil.rmtree(temp_dir_path)
+            logger.debug("Temporary directory removed.")
+        except Exception as cleanup_error:
+            logger.warning("Failed to remove temporary directory %s: %s", temp_dir_path, cleanup_error)
+
+_background_tasks = set()
+
+def _log_task_failure(task: asyncio.Task):
+    """ Retrieves and logs the exception of a background task that nothing awaits. """
+    if not task.cancelled() and task.exception():
+        logger.error("Background task %s failed: %s", task.get_name(), task.exception())
+
+def _pipeline_http_error(pipeline_error: services.PipelineError) -> HTTPException:
+    """ Maps a service-layer failure to an HTTPException, with Retry-After when the AI service is busy. """
+    headers = None
+    if pipeline_error.retry_after is not None:
+        headers = {"Retry-After": str(max(1, round(pipeline_error.retry_after)))}
+    return HTTPException(status_code=pipeline_error.status_code, detail=pipeline_error.detail, headers=headers)
+
+def _sse_event(event: str, data: str) -> str:
+    """ Formats one Server-Sent Event; data is a single-line JSON string. """
+    return f"event: {event}\ndata: {data}\n\n"
+
+def _sse_response(producer, queue: asyncio.Queue, endpoint: str) -> StreamingResponse:
+    """
+    Streams the (event, data) pairs a producer coroutine puts on the queue as SSE.
+    The producer must put None when it is finished. 'error' events are counted
+    as endpoint errors, since the HTTP status has already been sent as 200.
+    """
+    async def stream_events():
+        task = asyncio.create_task(producer())
+        _background_tasks.add(task) # Keep a reference while the producer finishes its cleanup
+        task.add_done_callback(_background_tasks.discard)
+        finished = False
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    finished = True
+                    break
+                if item[0] == "error":
+                    metrics.endpoint_errors.inc(endpoint=endpoint, status="stream")
+                yield _sse_event(*item)
+        finally:
+            if not finished:
+                task.cancel() # Client went away before the producer finished
+
+    return StreamingResponse(
+        stream_events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.post("/extract-questions", response_model=Union[QuestionListResponse, ErrorResponse])
 async def extract_questions_endpoint(
     pdf_file: UploadFile = File(..., description="The PDF exam paper to analyze.")
@@ -53,77 +225,174 @@ async def extract_questions_endpoint(
     """
     Uploads a PDF, extracts questions using Gemini, returns the list of questions
     and the File API ID (name) of the uploaded PDF.
+    Identical papers (same SHA-256) are served from the paper index without
+    re-uploading or re-extracting while the earlier upload is still valid.
     Does NOT delete the PDF from File API yet.
     """
-    print("\nReceived request to extract questions from PDF.")
+    logger.info("Received request to extract questions from PDF.")
     temp_dir_path: Optional[str] = None
-    uploaded_gemini_file_obj = None # Keep track to potentially delete if extraction fails mid-way
 
     try:
         # --- Step 1: Save Uploaded File Temporarily ---
-        pdf_content = await pdf_file.read()
-        if not pdf_content:
-            raise HTTPException(status_code=400, detail="PDF file is empty.")
-
-        temp_dir_path = tempfile.mkdtemp(dir=TEMP_DIR_BASE)
-        temp_pdf_path = os.path.join(temp_dir_path, pdf_file.filename or "temp_upload.pdf")
+        temp_dir_path, temp_pdf_path, pdf_digest = await _save_upload(pdf_file)
 
-        print(f"Saving uploaded file temporarily to: {temp_pdf_path}")
-        with open(temp_pdf_path, "wb") as temp_pdf:
-            temp_pdf.write(pdf_content)
-
-        # --- Step 2: Upload the Temporary File to Gemini ---
-        display_name = pdf_file.filename or "uploaded_exam.pdf"
-        uploaded_gemini_file_obj = gemini_utils.upload_pdf_to_gemini(
+        # --- Step 2: Upload to Gemini and Extract Questions (or reuse the cached paper) ---
+        # Failed extractions delete their Gemini upload inside the service
+        question_list_response = await services.extract_paper(
             pdf_path=temp_pdf_path,
-            display_name=display_name
-        )
-        if not uploaded_gemini_file_obj:
-            raise HTTPException(status_code=500, detail="Failed to upload PDF to Gemini File API.")
-
-        # --- Step 3: Extract Questions using Gemini ---
-        question_list_response = gemini_utils.extract_questions_from_pdf(
-            uploaded_file=uploaded_gemini_file_obj,
-            model_name="gemini-1.5-flash-latest" # Or pro if needed
+            pdf_digest=pdf_digest,
+            display_name=pdf_file.filename or "uploaded_exam.pdf"
         )
 
-        if not question_list_response:
-            # Extraction failed, delete the file we just uploaded
-            if uploaded_gemini_file_obj:
-                 gemini_utils.delete_uploaded_file(uploaded_gemini_file_obj.name)
-            raise HTTPException(status_code=500, detail="Failed to extract questions from the PDF.")
-
-        # --- Step 4: Return Successful Question List ---
-        print("Successfully extracted questions. Returning list to client.")
-        # We need pdfFileId in the response for the next step
-        if not question_list_response.pdfFileId:
-             question_list_response.pdfFileId = uploaded_gemini_file_obj.name # Ensure it's set
-
+        # --- Step 3: Return Successful Question List ---
+        logger.info("Successfully extracted questions. Returning list to client.")
         return question_list_response # FastAPI handles serialization
 
+    except services.PipelineError as pipeline_error:
+        raise _pipeline_http_error(pipeline_error)
     except HTTPException as http_exc:
-        # If upload failed before gemini obj was created, we only clean up local temp
-        if uploaded_gemini_file_obj: # Clean up Gemini file if upload succeeded but extraction failed
-             gemini_utils.delete_uploaded_file(uploaded_gemini_file_obj.name)
         raise http_exc
     except Exception as e:
-        print(f"--- Unexpected Error in /extract-questions endpoint: {e} ---")
-        if uploaded_gemini_file_obj: # Clean up Gemini file on generic error too
-             gemini_utils.delete_uploaded_file(uploaded_gemini_file_obj.name)
+        logger.exception("Unexpected error in /extract-questions endpoint: %s", e)
         return JSONResponse(
             status_code=500,
             content=ErrorResponse(detail="An unexpected server error occurred during question extraction.").model_dump()
         )
     finally:
-        # --- Step 5: Cleanup Local Temporary File ---
+        # --- Step 4: Cleanup Local Temporary File ---
         # Gemini file cleanup happens ONLY if extraction fails OR in the generate lesson endpoint
-        if temp_dir_path and os.path.exists(temp_dir_path):
-            try:
-                print(f"Removing temporary directory: {temp_dir_path}")
-                shutil.rmtree(temp_dir_path)
-                print("Temporary directory removed.")
-            except Exception as cleanup_error:
-                print(f"--- Warning: Failed to remove temporary directory {temp_dir_path}: {cleanup_error} ---")
+        _remove_temp_dir(temp_dir_path)
+
+
+@app.post("/extract-questions/stream")
+async def extract_questions_stream_endpoint(
+    pdf_file: UploadFile = File(..., description="The PDF exam paper to analyze.")
+):
+    """
+    Streaming variant of /extract-questions. Responds with Server-Sent Events:
+    'question' (ExtractedQuestionItem) as soon as each question is extracted,
+    then 'done' (the fully validated QuestionListResponse) or 'error' (ErrorResponse).
+    """
+    logger.info("Received request to stream questions from PDF.")
+    temp_dir_path, temp_pdf_path, pdf_digest = await _save_upload(pdf_file)
+    display_name = pdf_file.filename or "uploaded_exam.pdf"
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def produce():
+        try:
+            question_list = await services.extract_paper(
+                pdf_path=temp_pdf_path,
+                pdf_digest=pdf_digest,
+                display_name=display_name,
+                on_question=lambda question: queue.put_nowait(("question", question.model_dump_json()))
+            )
+            queue.put_nowait(("done", question_list.model_dump_json()))
+        except services.PipelineError as pipeline_error:
+            queue.put_nowait(("error", ErrorResponse(detail=pipeline_error.detail).model_dump_json()))
+        except Exception as e:
+            logger.exception("Unexpected error in /extract-questions/stream endpoint: %s", e)
+            queue.put_nowait(("error", ErrorResponse(detail="An unexpected server error occurred during question extraction.").model_dump_json()))
+        finally:
+            _remove_temp_dir(temp_dir_path)
+            queue.put_nowait(None)
+
+    return _sse_response(produce, queue, "/extract-questions/stream")
+
+
+@app.post("/extract-questions/jobs", status_code=202, response_model=JobStatus)
+async def extract_questions_job_endpoint(
+    pdf_file: UploadFile = File(..., description="The PDF exam paper to analyze.")
+):
+    """
+    Job variant of /extract-questions. Saves the upload, queues the upload and
+    extraction stages for the worker pool and returns the job right away (202).
+    Poll GET /jobs/{jobId} or subscribe to GET /jobs/{jobId}/events for progress;
+    the finished job carries the QuestionListResponse as its result.
+    """
+    logger.info("Received request to extract questions as a background job.")
+    job = job_store.create("extract-questions", ["saved", "uploaded", "extracted"])
+    job_store.start_stage(job.jobId, "saved")
+    try:
+        temp_dir_path, temp_pdf_path, pdf_digest = await _save_upload(pdf_file)
+    except HTTPException as http_exc:
+        job_store.fail(job.jobId, http_exc.detail)
+        raise
+    except Exception as e:
+        logger.exception("Failed to save upload for extraction job %s: %s", job.jobId, e)
+        job_store.fail(job.jobId, "Failed to save the uploaded file.")
+        raise HTTPException(status_code=500, detail="Failed to save the uploaded file.")
+    job_store.finish_stage(job.jobId, "saved", start_next=False)
+    job_store.mark_queued(job.jobId)
+    display_name = pdf_file.filename or "uploaded_exam.pdf"
+    correlation_id = log_config.get_correlation_id()
+
+    async def run():
+        log_config.set_correlation_id(correlation_id) # Workers run outside the request's context
+        job_store.start_stage(job.jobId, "uploaded")
+        try:
+            question_list = await services.extract_paper(
+                pdf_path=temp_pdf_path,
+                pdf_digest=pdf_digest,
+                display_name=display_name,
+                on_stage=lambda stage: job_store.finish_stage(job.jobId, stage)
+            )
+            job_store.succeed(job.jobId, question_list)
+            logger.info("Job %s finished with %s questions.", job.jobId, len(question_list.questions))
+        except services.PipelineError as pipeline_error:
+            job_store.fail(job.jobId, pipeline_error.detail)
+        except Exception as e:
+            logger.exception("Unexpected error in extraction job %s: %s", job.jobId, e)
+            job_store.fail(job.jobId, "An unexpected server error occurred during question extraction.")
+        finally:
+            _remove_temp_dir(temp_dir_path)
+
+    try:
+        job_queue.submit(run)
+    except QueueFullError:
+        _remove_temp_dir(temp_dir_path)
+        job_store.fail(job.jobId, "Too many extraction jobs are queued.")
+        raise HTTPException(status_code=503, detail="Too many extraction jobs are queued. Please retry shortly.")
+    logger.info("Queued extraction job %s.", job.jobId)
+    return job
+
+
+@app.get("/jobs/{job_id}", response_model=JobStatus)
+async def get_job_endpoint(job_id: str):
+    """Returns the current status, per-stage timings and (once finished) result of a job."""
+    job = job_store.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Unknown or expired job ID.")
+    return job
+
+
+@app.get("/jobs/{job_id}/events")
+async def job_events_endpoint(job_id: str):
+    """
+    Subscribes to a job. Responds with Server-Sent Events: 'status' (JobStatus)
+    now and on every change, ending after the job succeeds or fails.
+    """
+    if not job_store.get(job_id):
+        raise HTTPException(status_code=404, detail="Unknown or expired job ID.")
+
+    async def stream_events():
+        while True:
+            job = job_store.get(job_id)
+            if not job:
+                return
+            seen_version = job_store.version(job_id)
+            yield _sse_event("status", job.model_dump_json())
+            if job.status in TERMINAL_STATUSES:
+                return
+            while not await job_store.wait_for_change(job_id, seen_version, timeout=JOB_EVENTS_KEEPALIVE_SECONDS):
+                if not job_store.get(job_id):
+                    return
+                yield ": keep-alive\n\n"
+
+    return StreamingResponse(
+        stream_events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 
 @app.post("/generate-specific-lesson", response_model=Union[LessonResponse, ErrorResponse])
@@ -134,18 +403,18 @@ async def generate_specific_lesson_endpoint(
     """
     Generates a detailed lesson for a specific question, referencing the
     PDF already uploaded via its File API ID (name).
-    Deletes the PDF from File API after generating the lesson.
+    Lessons for indexed papers are served from the lesson cache when available.
+    The upload is kept for further questions and deleted by the file reaper once
+    it goes unused.
     """
-    print(f"\nReceived request to generate lesson for Q_ID: '{request_data.selectedQuestionId}' from File ID: '{request_data.pdfFileId}'")
-    pdf_file_id_to_delete = request_data.pdfFileId # Store ID for cleanup
+    logger.info("Received request to generate lesson for Q_ID: '%s' from File ID: '%s'", request_data.selectedQuestionId, request_data.pdfFileId)
 
     try:
-        # --- Step 1: Generate Lesson using Gemini ---
-        lesson_response_model = gemini_utils.generate_structured_lesson(
+        # --- Step 1: Generate Lesson using Gemini (or the lesson cache) ---
+        lesson_response_model = await services.get_lesson(
             pdf_file_id=request_data.pdfFileId,
-            selected_question_id=request_data.selectedQuestionId,
-            selected_question_text=request_data.selectedQuestionText, # Pass optional text
-            model_name="gemini-1.5-flash-latest"
+            question_id=request_data.selectedQuestionId,
+            question_text=request_data.selectedQuestionText # Pass optional text
         )
 
         if not lesson_response_model:
@@ -154,32 +423,194 @@ async def generate_specific_lesson_endpoint(
             raise HTTPException(status_code=500, detail="Failed to generate or validate lesson content from Gemini.")
 
         # --- Step 2: Return Successful Response ---
-        print("Successfully generated specific lesson. Returning to client.")
+        logger.info("Successfully generated specific lesson. Returning to client.")
         return lesson_response_model
 
+    except services.PipelineError as pipeline_error:
+        raise _pipeline_http_error(pipeline_error)
     except HTTPException as http_exc:
         # Don't try deleting file on HTTP error typically raised before generation attempt
         raise http_exc
     except Exception as e:
-        print(f"--- Unexpected Error in /generate-specific-lesson endpoint: {e} ---")
+        logger.exception("Unexpected error in /generate-specific-lesson endpoint: %s", e)
         return JSONResponse(
             status_code=500,
             content=ErrorResponse(detail="An unexpected server error occurred during lesson generation.").model_dump()
         )
-    finally:
-        # --- Step 3: Cleanup - Delete the referenced PDF from Gemini File API ---
-        print("--- Specific Lesson Endpoint finished, initiating file cleanup ---")
-        if pdf_file_id_to_delete:
-             gemini_utils.delete_uploaded_file(pdf_file_id_to_delete)
-        else:
-             print("No PDF File ID was provided in the request for cleanup.")
 
 
-# --- Run the App (for local development) ---
+@app.post("/generate-specific-lesson/stream")
+async def generate_specific_lesson_stream_endpoint(
+    request_data: GenerateLessonRequest = Body(...)
+):
+    """
+    Streaming variant of /generate-specific-lesson. Responds with Server-Sent Events:
+    'concept' (the coreConceptHtml string) and 'step' (StepModel) as soon as each is
+    generated, then 'done' (the fully validated LessonResponse) or 'error' (ErrorResponse).
+    """
+    logger.info("Received request to stream lesson for Q_ID: '%s' from File ID: '%s'", request_data.selectedQuestionId, request_data.pdfFileId)
+    queue: asyncio.Queue = asyncio.Queue()
+
+    def on_part(event: str, value):
+        data = value.model_dump_json() if isinstance(value, StepModel) else json.dumps(value)
+        queue.put_nowait((event, data))
+
+    async def produce():
+        try:
+            lesson = await services.get_lesson(
+                pdf_file_id=request_data.pdfFileId,
+                question_id=request_data.selectedQuestionId,
+                question_text=request_data.selectedQuestionText,
+                on_part=on_part
+            )
+            if lesson:
+                queue.put_nowait(("done", lesson.model_dump_json()))
+            else:
+                queue.put_nowait(("error", ErrorResponse(detail="Failed to generate or validate lesson content from Gemini.").model_dump_json()))
+        except services.PipelineError as pipeline_error:
+            queue.put_nowait(("error", ErrorResponse(detail=pipeline_error.detail).model_dump_json()))
+        except Exception as e:
+            logger.exception("Unexpected error in /generate-specific-lesson/stream endpoint: %s", e)
+            queue.put_nowait(("error", ErrorResponse(detail="An unexpected server error occurred during lesson generation.").model_dump_json()))
+        finally:
+            queue.put_nowait(None)
+
+    return _sse_response(produce, queue, "/generate-specific-lesson/stream")
+
+
+@app.post("/generate-lessons-batch")
+async def generate_lessons_batch_endpoint(
+    request_data: BatchLessonRequest = Body(...)
+):
+    """
+    Generates lessons for several questions of an uploaded PDF concurrently
+    (at most BATCH_LESSON_CONCURRENCY at a time) and streams each result as an
+    NDJSON line (BatchLessonItem) as soon as it finishes.
+    """
+    logger.info("Received batch lesson request for File ID: '%s'", request_data.pdfFileId)
+    known_questions = services.questions_for_file(request_data.pdfFileId)
+    if request_data.questionIds == "all":
+        if known_questions is None:
+            raise HTTPException(status_code=404, detail="Unknown pdfFileId; list the question IDs explicitly.")
+        question_ids = [q.questionId for q in known_questions]
+    else:
+        question_ids = list(dict.fromkeys(request_data.questionIds)) # De-duplicate, keep order
+    if not question_ids:
+        raise HTTPException(status_code=400, detail="No questions to generate lessons for.")
+    question_texts = {q.questionId: q.questionText for q in known_questions or []}
+    semaphore = asyncio.Semaphore(services.BATCH_LESSON_CONCURRENCY)
+
+    async def generate_one(question_id: str) -> BatchLessonItem:
+        scheduler.set_priority(scheduler.PRIORITY_BATCH) # Interactive lessons go first
+        async with semaphore:
+            try:
+                lesson = await services.get_lesson(request_data.pdfFileId, question_id, question_texts.get(question_id))
+            except services.PipelineError as pipeline_error:
+                return BatchLessonItem(questionId=question_id, status="error", detail=pipeline_error.detail)
+            except Exception as e:
+                logger.error("Error generating batch lesson for Q_ID '%s': %s", question_id, e)
+                lesson = None
+        if not lesson:
+            return BatchLessonItem(questionId=question_id, status="error", detail="Failed to generate or validate lesson content from Gemini.")
+        return BatchLessonItem(questionId=question_id, status="ok", lesson=lesson)
+
+    async def stream_results():
+        tasks = [asyncio.create_task(generate_one(question_id)) for question_id in question_ids]
+        try:
+            for finished in asyncio.as_completed(tasks):
+                item = await finished
+                if item.status == "error":
+                    metrics.endpoint_errors.inc(endpoint="/generate-lessons-batch", status="item")
+                logger.info("Batch lesson for Q_ID '%s' finished with status '%s'.", item.questionId, item.status)
+                yield item.model_dump_json() + "\n"
+        finally:
+            # Runs after the last lesson, or when the client disconnects early
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+
+@app.get("/papers/{paper_hash}/questions", response_model=QuestionListResponse)
+async def get_paper_questions_endpoint(request: Request, paper_hash: str = Path(..., pattern=PAPER_HASH_PATTERN)):
+    """
+    The extracted question list of an indexed paper, addressed by the SHA-256 of the
+    PDF (paperHash in extraction responses). Cacheable: ETag, Cache-Control, 304.
+    """
+    question_list = services.current_question_list(paper_hash)
+    if not question_list:
+        raise HTTPException(status_code=404, detail="Unknown paper.")
+    return http_cache.cacheable_json(request, question_list.model_dump_json(), QUESTIONS_CACHE_CONTROL)
+
+
+@app.get("/papers/{paper_hash}/lessons/{question_id:path}", response_model=LessonResponse)
+async def get_paper_lesson_endpoint(request: Request, question_id: str, paper_hash: str = Path(..., pattern=PAPER_HASH_PATTERN)):
+    """
+    A previously generated lesson, addressed by paper hash and question ID, so
+    browsers, CDNs and proxies can cache it. Never generates: 404 until a POST to
+    /generate-specific-lesson (or a batch or prefetch) has produced it.
+    The question ID is the rest of the path, so IDs such as "3/a" work as-is.
+    """
+    lesson = services.cached_lesson(paper_hash, question_id)
+    if not lesson:
+        raise HTTPException(status_code=404, detail="No lesson has been generated for this question yet.")
+    return http_cache.cacheable_json(request, lesson.model_dump_json(), LESSON_CACHE_CONTROL)
+
+
+@app.get("/ready")
+async def ready_endpoint():
+    """Readiness check: 200 once the Gemini SDK is loaded and the models are built, 503 until then."""
+    sdk = gemini_utils.sdk_state()
+    ready = sdk["warm"] or not GEMINI_PREWARM
+    return JSONResponse(status_code=200 if ready else 503, content={"ready": ready, "gemini": sdk})
+
+
+@app.get("/stats")
+async def stats_endpoint():
+    """Reports Gemini concurrency, cache, prefetch, job, uploaded file and JSON repair counters."""
+    return {
+        "gemini": gemini_utils.get_executor_stats(),
+        "scheduler": scheduler.gemini_scheduler.stats(),
+        "paper_cache": paper_index.stats(),
+        "lesson_cache": lesson_cache.stats(),
+        "prefetch": services.prefetch_stats(),
+        "single_flight": {
+            "extractions": services.extraction_flights.stats(),
+            "lessons": services.lesson_flights.stats()
+        },
+        "jobs": {**job_queue.stats(), **job_store.stats()},
+        "files": services.file_manager.stats(),
+        "json_repair": json_repair.stats()
+    }
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    """Stage latency histograms, error and token counters in the Prometheus text format."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.delete("/admin/lesson-cache")
+async def purge_lesson_cache_endpoint(
+    paper_hash: Optional[str] = None,
+    x_admin_token: Optional[str] = Header(None)
+):
+    """Purges cached lessons (all, or one paper's via ?paper_hash=). Requires the X-Admin-Token header."""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled (ADMIN_TOKEN not set).")
+    if not x_admin_token or not secrets.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=401, detail="Invalid admin token.")
+    deleted = lesson_cache.purge(paper_hash)
+    logger.info("Purged %s cached lessons%s.", deleted, f" for paper {paper_hash[:12]}" if paper_hash else "")
+    return {"deleted": deleted}
+
+
+# --- Run the App (for local development; see serve.py for production) ---
 if __name__ == "__main__":
-    print("Starting LessonGenie FastAPI server...")
+    logger.info("Starting LessonGenie FastAPI server...")
     pathlib.Path(TEMP_DIR_BASE).mkdir(exist_ok=True)
     pathlib.Path("lesson_outputs").mkdir(exist_ok=True) # If using save function
 
-    uvicorn.run("main:app", host="127.0.0.1", port=8000, reload=True)
+    import uvicorn
+    uvicorn.run("main:app", host="127.0.0.1", port=8000, reload=True, log_config=None) # Keep our queued logging
 
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+In-process metrics: stage timing histograms, error and token counters, and
+callback gauges, rendered in the Prometheus text exposition format for /metrics.
+Stage timings of the current request are also collected for the Server-Timing header.
+"""
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+# --- Configuration ---
+SERVER_TIMING_ENABLED = os.getenv("SERVER_TIMING", "0") == "1" # Adds a Server-Timing header to responses
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160) # Seconds
+
+_registry: List["_Metric"] = []
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"] + self._samples()
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help_text, label_names=()):
+        super().__init__(name, help_text, label_names)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            return [f"{self.name}{_format_labels(self.label_names, key)} {value}" for key, value in sorted(self._values.items())]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, label_names=(), buckets=STAGE_BUCKETS):
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(buckets)
+        self._series: Dict[Tuple[str, ...], list] = {} # key -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def _samples(self):
+        lines = []
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                for index, bound in enumerate(self.buckets):
+                    labels = _format_labels(self.label_names, key, 'le="%s"' % bound)
+                    lines.append(f"{self.name}_bucket{labels} {series[index]}")
+                labels = _format_labels(self.label_names, key, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{labels} {series[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {round(series[-2], 6)}")
+                lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {series[-1]}")
+        return lines
+
+
+class CallbackGauge(_Metric):
+    """ A gauge whose value is read from a callback at scrape time. """
+    kind = "gauge"
+
+    def __init__(self, name, help_text, callback: Callable[[], float]):
+        super().__init__(name, help_text)
+        self.callback = callback
+
+    def _samples(self):
+        try:
+            return [f"{self.name} {float(self.callback())}"]
+        except Exception:
+            return []
+
+
+# --- Application Metrics ---
+stage_seconds = Histogram(
+    "lessongenie_stage_seconds", "Time spent in each pipeline stage.", ("stage",)
+)
+validation_failures = Counter(
+    "lessongenie_validation_failures_total", "Model responses that failed Pydantic validation.", ("kind",)
+)
+endpoint_requests = Counter(
+    "lessongenie_http_requests_total", "HTTP requests by endpoint and status code.", ("endpoint", "status")
+)
+endpoint_errors = Counter(
+    "lessongenie_endpoint_errors_total", "Failed requests (4xx/5xx, or an error event on a stream) by endpoint.", ("endpoint", "status")
+)
+json_repairs = Counter(
+    "lessongenie_json_repairs_total", "Invalid model responses salvaged or given up, by kind and outcome.", ("kind", "outcome")
+)
+gemini_tokens = Counter(
+    "lessongenie_gemini_tokens_total", "Gemini tokens from usage_metadata, by call type and token kind.", ("call", "kind")
+)
+
+
+# --- Per-Request Stage Timings (Server-Timing) ---
+# The list is shared by reference with tasks and worker threads started during the request
+_request_timings: contextvars.ContextVar = contextvars.ContextVar("request_timings", default=None)
+
+
+def start_request_timings():
+    """ Starts collecting stage timings for the current request. """
+    _request_timings.set([])
+
+
+def server_timing_header() -> Optional[str]:
+    timings = _request_timings.get()
+    if not timings:
+        return None
+    return ", ".join(f"{name};dur={duration_ms:.1f}" for name, duration_ms in timings)
+
+
+@contextmanager
+def stage(name: str):
+    """ Times a pipeline stage into stage_seconds and the current request's Server-Timing. """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        stage_seconds.observe(elapsed, stage=name)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.append((name, elapsed * 1000))
+
+
+def record_usage(call: str, usage):
+    """ Counts prompt, candidate and cached tokens from a response's usage_metadata. """
+    gemini_tokens.inc(usage.prompt_token_count or 0, call=call, kind="prompt")
+    gemini_tokens.inc(usage.candidates_token_count or 0, call=call, kind="candidates")
+    gemini_tokens.inc(getattr(usage, "cached_content_token_count", 0) or 0, call=call, kind="cached")
+
+
+def render() -> str:
+    """ All metrics in the Prometheus text exposition format (version 0.0.4). """
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
-from typing import List, Optional, Union
-from pydantic import BaseModel, Field
+from typing import List, Literal, Optional, Union
+from pydantic import BaseModel, Field, PrivateAttr
 
 # --- Models for Lesson Generation Output ---
 
@@ -29,6 +29,8 @@ class LessonDataModel(BaseModel):
 class LessonResponse(BaseModel):
     """Overall response structure for a generated lesson."""
     lessonData: LessonDataModel
+    # Set when the lesson was rebuilt from cut-off model output; such lessons are served but not cached
+    _salvaged: bool = PrivateAttr(default=False)
 
 # --- Models for Question Extraction Output ---
 
@@ -38,12 +40,17 @@ class ExtractedQuestionItem(BaseModel):
     # Could refine prompt later to improve ID extraction
     questionId: str = Field(..., description="An identifier for the question (e.g., 'q1', 'q2a', or simply index).")
     questionText: str = Field(..., description="The extracted text of the question.")
+    pageStart: Optional[int] = Field(None, description="1-based page the question starts on, if known.")
+    pageEnd: Optional[int] = Field(None, description="1-based page the question ends on (inclusive), if known.")
 
 class QuestionListResponse(BaseModel):
     """Response structure containing the list of extracted questions."""
     # Include the File API name/ID so frontend can reference it later
     pdfFileId: str = Field(..., description="The internal identifier (name) of the uploaded PDF file in the File API.")
     questions: List[ExtractedQuestionItem] = Field(..., description="List of questions extracted from the PDF.")
+    paperHash: Optional[str] = Field(None, description="SHA-256 of the PDF; addresses the paper's GET resources under /papers.")
+    # Set when questions were lost to cut-off or invalid model output; such lists are served but not cached
+    _salvaged: bool = PrivateAttr(default=False)
 
 # --- Model for Specific Lesson Request ---
 
@@ -54,6 +61,40 @@ class GenerateLessonRequest(BaseModel):
     # Optionally include questionText too, might help AI focus
     selectedQuestionText: Optional[str] = Field(None, description="The text of the selected question (optional, for context).")
 
+# --- Models for Batch Lesson Generation ---
+
+class BatchLessonRequest(BaseModel):
+    """Data sent to request lessons for several questions of one uploaded PDF."""
+    pdfFileId: str = Field(..., description="The identifier (name) of the uploaded file from the extraction step.")
+    questionIds: Union[Literal["all"], List[str]] = Field(..., description="The question IDs to generate lessons for, or 'all' for every extracted question.")
+
+class BatchLessonItem(BaseModel):
+    """One line of the NDJSON stream returned by the batch endpoint."""
+    questionId: str = Field(..., description="The question this result belongs to.")
+    status: Literal["ok", "error"] = Field(..., description="Whether the lesson was generated.")
+    lesson: Optional[LessonResponse] = Field(None, description="The generated lesson, when status is 'ok'.")
+    detail: Optional[str] = Field(None, description="Error description, when status is 'error'.")
+
+# --- Models for Background Jobs ---
+
+class JobStageModel(BaseModel):
+    """Progress of one pipeline stage of a background job."""
+    name: str = Field(..., description="Stage name, e.g. 'saved', 'uploaded', 'extracted'.")
+    status: Literal["pending", "running", "done", "failed"] = Field("pending", description="Stage state.")
+    startedAt: Optional[float] = Field(None, description="Unix time the stage started.")
+    finishedAt: Optional[float] = Field(None, description="Unix time the stage finished.")
+    durationMs: Optional[float] = Field(None, description="Time spent in the stage, in milliseconds.")
+
+class JobStatus(BaseModel):
+    """State of a background job, as returned by /jobs/{jobId}."""
+    jobId: str = Field(..., description="Identifier to poll or subscribe to.")
+    kind: str = Field(..., description="What the job does, e.g. 'extract-questions'.")
+    status: Literal["queued", "running", "succeeded", "failed"] = Field("queued", description="Overall job state.")
+    createdAt: float = Field(..., description="Unix time the job was accepted.")
+    stages: List[JobStageModel] = Field(default_factory=list, description="Per-stage status and timing, in pipeline order.")
+    result: Optional[QuestionListResponse] = Field(None, description="The job's result once it succeeded.")
+    error: Optional[str] = Field(None, description="Error description if the job failed.")
+
 
 # --- Standard Error Model ---
 class ErrorResponse(BaseModel):
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Local page-level helpers for exam PDFs: a text-layer index that finds the pages
+each extracted question appears on, and page slicing so a lesson only sends the
+pages it needs. Requires the optional 'pypdf' package; without it every helper
+reports itself unavailable and callers fall back to the whole document.
+"""
+import importlib.util
+import logging
+import re
+from typing import List, Optional
+
+from models import ExtractedQuestionItem
+
+logger = logging.getLogger(__name__)
+
+# pypdf is slow to import, so it is only looked up here and imported by the helpers that use it
+PYPDF_AVAILABLE = importlib.util.find_spec("pypdf") is not None
+if not PYPDF_AVAILABLE:
+    logger.warning("'pypdf' is not installed. Page indexing and page slicing are disabled.")
+
+NEEDLE_CHARS = 60 # Leading/trailing characters of a question used to find it in the text layer
+MIN_NEEDLE_CHARS = 20
+
+
+def is_available() -> bool:
+    return PYPDF_AVAILABLE
+
+
+def normalize_text(text: str) -> str:
+    """ Lowercases and collapses everything but letters and digits, so layout differences don't matter. """
+    return re.sub(r"[^0-9a-z]+", " ", text.lower()).strip()
+
+
+def page_count(pdf_path: str) -> int:
+    from pypdf import PdfReader
+    return len(PdfReader(pdf_path).pages)
+
+
+def extract_page_texts(pdf_path: str) -> List[str]:
+    """ Returns the normalized text layer of each page (empty strings for scanned pages). """
+    from pypdf import PdfReader
+    texts = []
+    for page in PdfReader(pdf_path).pages:
+        try:
+            texts.append(normalize_text(page.extract_text() or ""))
+        except Exception:
+            texts.append("")
+    return texts
+
+
+def _find_page(page_texts: List[str], needle: str, first_page: int) -> Optional[int]:
+    """ Returns the 0-based index of the first page from first_page containing the needle. """
+    for index in range(first_page, len(page_texts)):
+        if needle in page_texts[index]:
+            return index
+    return None
+
+
+def locate_questions(pdf_path: str, questions: List[ExtractedQuestionItem]):
+    """
+    Fills pageStart/pageEnd (1-based, inclusive) on each question from the PDF's text
+    layer. Questions that cannot be found keep the page range the model reported,
+    if it is within the document; otherwise their range is cleared.
+    """
+    page_texts = extract_page_texts(pdf_path)
+    total_pages = len(page_texts)
+    found_starts: List[Optional[int]] = []
+    search_from = 0
+    for question in questions:
+        text = normalize_text(question.questionText)
+        start = None
+        for length in (NEEDLE_CHARS, MIN_NEEDLE_CHARS):
+            if len(text) >= MIN_NEEDLE_CHARS:
+                start = _find_page(page_texts, text[:length], search_from)
+                if start is None:
+                    start = _find_page(page_texts, text[:length], 0) # Out-of-order questions
+            if start is not None:
+                break
+        found_starts.append(start)
+        if start is not None:
+            search_from = start
+
+    for position, question in enumerate(questions):
+        start = found_starts[position]
+        if start is None:
+            # Model-reported fallback, kept only if it is plausible
+            if not (question.pageStart and 1 <= question.pageStart <= total_pages):
+                question.pageStart = question.pageEnd = None
+            elif not (question.pageEnd and question.pageStart <= question.pageEnd <= total_pages):
+                question.pageEnd = question.pageStart
+            continue
+        text = normalize_text(question.questionText)
+        end = _find_page(page_texts, text[-NEEDLE_CHARS:], start) if len(text) >= MIN_NEEDLE_CHARS else None
+        if end is None:
+            # Assume the question runs until the page where the next located question starts
+            next_starts = [s for s in found_starts[position + 1:] if s is not None and s >= start]
+            end = next_starts[0] if next_starts else start
+        question.pageStart = start + 1
+        question.pageEnd = end + 1
+
+
+def write_page_slice(src_path: str, dest_path: str, page_start: int, page_end: int):
+    """ Writes pages page_start..page_end (1-based, inclusive) of src_path to a new PDF. """
+    from pypdf import PdfReader, PdfWriter
+    reader = PdfReader(src_path)
+    writer = PdfWriter()
+    for index in range(page_start - 1, min(page_end, len(reader.pages))):
+        writer.add_page(reader.pages[index])
+    with open(dest_path, "wb") as out_file:
+        writer.write(out_file)
@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+"""
+Central scheduler for Gemini model calls. Every model call made on the Gemini
+worker threads passes through here first: calls are admitted in priority order
+(interactive before batch before prefetch) within a requests/min and tokens/min
+budget shared by all worker processes, and retried with jittered exponential backoff on 429 and 5xx responses,
+honouring the server's retry delay when it sends one.
+"""
+import contextvars
+import heapq
+import itertools
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+import metrics
+from cache import RateBuckets
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "60")) # Model calls per minute; 0 disables the limit
+GEMINI_TPM = int(os.getenv("GEMINI_TPM", "1000000")) # Tokens per minute; 0 disables the limit
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "4")) # Retries after a 429 or 5xx response
+GEMINI_RETRY_BASE_DELAY = float(os.getenv("GEMINI_RETRY_BASE_DELAY", "1")) # Seconds; doubled per retry
+GEMINI_RETRY_MAX_DELAY = float(os.getenv("GEMINI_RETRY_MAX_DELAY", "30"))
+# Longest a call may spend queued or backing off before it is given up as busy
+GEMINI_SCHEDULER_MAX_WAIT = float(os.getenv("GEMINI_SCHEDULER_MAX_WAIT", "60"))
+DEFAULT_TOKEN_ESTIMATE = 4000 # Tokens reserved for a call type before its real usage is known
+REQUESTS_BUCKET = "gemini_requests"
+TOKENS_BUCKET = "gemini_tokens"
+PAUSE_KEY = "gemini" # Set after a 429 so every queued call, in every worker, backs off together
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+PRIORITY_PREFETCH = 2
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_BATCH: "batch", PRIORITY_PREFETCH: "prefetch"}
+
+
+class CallPriority:
+    """ Scheduling priority of the calls made from one task. Shared by reference, so it can be raised while they wait. """
+
+    def __init__(self, value: int):
+        self.value = value
+
+
+# Priority of the calls made from the current task; copied onto the worker thread with the context
+_priority: contextvars.ContextVar = contextvars.ContextVar("gemini_priority", default=CallPriority(PRIORITY_INTERACTIVE))
+
+
+def set_priority(priority: int):
+    """ Sets the scheduling priority for Gemini calls made from the current task. """
+    _priority.set(CallPriority(priority))
+
+
+def current_priority() -> CallPriority:
+    """ The priority holder of the current task; see GeminiScheduler.raise_priority. """
+    return _priority.get()
+
+
+# Event set once the caller stopped waiting for the current call; copied onto the worker thread with the context
+_cancelled: contextvars.ContextVar = contextvars.ContextVar("gemini_cancelled", default=None)
+
+
+def set_cancel_event(event: threading.Event):
+    """ Calls made from the current context are abandoned before their next attempt once event is set. """
+    _cancelled.set(event)
+
+
+def is_cancelled() -> bool:
+    """ True if the caller of the current call has stopped waiting for it. """
+    event = _cancelled.get()
+    return event is not None and event.is_set()
+
+
+# time.monotonic() by which the caller needs the current call, continuations included; None for no limit
+_deadline: contextvars.ContextVar = contextvars.ContextVar("gemini_deadline", default=None)
+
+
+def set_call_deadline(deadline: Optional[float]):
+    """ Model calls made from the current context must finish by deadline (time.monotonic()). """
+    _deadline.set(deadline)
+
+
+def remaining_time() -> Optional[float]:
+    """ Seconds left before the current call's deadline, or None if it has none. """
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+class GeminiBusyError(Exception):
+    """ Raised when a call could not be made within the rate limits, retries or wait budget. """
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class GeminiTimeoutError(TimeoutError):
+    """ Raised when the caller stopped waiting for a call; the call itself is abandoned at its next attempt. """
+
+
+def _status_code(error: Exception) -> Optional[int]:
+    """ HTTP status of a Google API error, or None for other errors. """
+    # Not imported here: a Google API error can only exist once the SDK has loaded the module
+    api_exceptions = sys.modules.get("google.api_core.exceptions")
+    if api_exceptions is not None and isinstance(error, api_exceptions.GoogleAPICallError):
+        return error.code if isinstance(error.code, int) else None
+    code = getattr(error, "code", None)
+    return code if isinstance(code, int) else None
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """ Server-requested retry delay in seconds, from a Retry-After header or a RetryInfo detail. """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    value = headers.get("retry-after") or headers.get("Retry-After")
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+    for detail in getattr(error, "details", None) or []:
+        retry_delay = getattr(detail, "retry_delay", None)
+        if retry_delay is not None:
+            return retry_delay.seconds + retry_delay.nanos / 1e9
+    return None
+
+
+class GeminiScheduler:
+    """
+    Admits blocking model calls in priority order within the rate budget and
+    retries throttled or failed calls. Safe to use from any number of threads.
+    """
+
+    def __init__(self,
+                 requests_per_minute: int = GEMINI_RPM,
+                 tokens_per_minute: int = GEMINI_TPM,
+                 max_retries: int = GEMINI_MAX_RETRIES,
+                 base_delay: float = GEMINI_RETRY_BASE_DELAY,
+                 max_delay: float = GEMINI_RETRY_MAX_DELAY,
+                 max_wait: float = GEMINI_SCHEDULER_MAX_WAIT,
+                 budget: Optional[RateBuckets] = None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_wait = max_wait
+        self._budget = budget or RateBuckets()
+        if requests_per_minute > 0:
+            self._budget.configure(REQUESTS_BUCKET, requests_per_minute)
+        if tokens_per_minute > 0:
+            self._budget.configure(TOKENS_BUCKET, tokens_per_minute)
+        self._cond = threading.Condition()
+        self._waiting: list = [] # Heap of [priority, sequence, CallPriority]
+        self._sequence = itertools.count()
+        self._token_estimates: Dict[str, float] = {}
+        self._local = threading.local() # Tokens reserved by the current thread's call, per label
+        self._stats = {
+            "admitted": 0, "retries": 0, "throttled": 0, "server_errors": 0, "gave_up": 0,
+            "wait_ms_total": 0.0, "wait_ms_max": 0.0
+        }
+
+    def run(self, label: str, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        Calls func(*args, **kwargs) once admitted, retrying on 429 and 5xx errors.
+        label names the call type for token estimates (see record_usage).
+        Raises GeminiBusyError when the call cannot be made in time.
+        """
+        priority = _priority.get()
+        call_deadline = _deadline.get()
+        deadline = time.monotonic() + self.max_wait
+        if call_deadline is not None:
+            deadline = min(deadline, call_deadline)
+        attempt = 0
+        while True:
+            estimate = self._token_estimates.get(label, DEFAULT_TOKEN_ESTIMATE)
+            try:
+                self._acquire(priority, estimate, deadline)
+            except GeminiBusyError:
+                if call_deadline is not None and time.monotonic() >= call_deadline:
+                    raise GeminiTimeoutError(f"Gemini {label} could not start before its caller's deadline.") from None
+                raise
+            self._local.__dict__[label] = estimate
+            if is_cancelled():
+                raise GeminiTimeoutError(f"Gemini {label} abandoned: its caller timed out.")
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                status = _status_code(e)
+                if status is None or (status != 429 and status < 500):
+                    raise
+                server_delay = _retry_after(e)
+                delay = server_delay if server_delay is not None else \
+                    min(self.max_delay, self.base_delay * 2 ** attempt) * random.uniform(0.5, 1.5)
+                with self._cond:
+                    self._stats["throttled" if status == 429 else "server_errors"] += 1
+                    if attempt >= self.max_retries or time.monotonic() + delay > deadline:
+                        self._stats["gave_up"] += 1
+                        raise GeminiBusyError(f"Gemini {label} failed with {status} after {attempt + 1} attempts: {e}", delay) from e
+                    self._stats["retries"] += 1
+                    if status == 429:
+                        # Quota is shared: hold back every queued call, not just this one
+                        self._budget.pause(PAUSE_KEY, time.time() + delay)
+                        self._cond.notify_all()
+                logger.warning("Gemini %s got %s; retrying in %.1fs (attempt %s/%s)", label, status, delay, attempt + 2, self.max_retries + 1)
+                if status != 429:
+                    time.sleep(delay)
+                attempt += 1
+
+    def raise_priority(self, holder: CallPriority, priority: int):
+        """
+        Raises holder to priority if that is higher, moving its queued calls up with it.
+        Never blocks: if a waiter holds the lock (e.g. while taking from the shared
+        budget), the queue is re-sorted on its next pass instead.
+        """
+        if priority >= holder.value:
+            return
+        holder.value = priority
+        if self._cond.acquire(blocking=False):
+            try:
+                self._sync_priorities()
+                self._cond.notify_all()
+            finally:
+                self._cond.release()
+
+    def _sync_priorities(self):
+        """ Re-sorts waiters whose priority holder was raised. Caller holds the lock. """
+        changed = False
+        for entry in self._waiting:
+            if entry[0] != entry[2].value:
+                entry[0] = entry[2].value
+                changed = True
+        if changed:
+            heapq.heapify(self._waiting)
+
+    def record_usage(self, label: str, total_tokens: int):
+        """ Settles the tokens reserved for the current thread's call and updates the estimate for label. """
+        reserved = self._local.__dict__.pop(label, None)
+        with self._cond:
+            if reserved is not None:
+                self._budget.adjust(TOKENS_BUCKET, total_tokens - reserved)
+            previous = self._token_estimates.get(label)
+            self._token_estimates[label] = total_tokens if previous is None else 0.8 * previous + 0.2 * total_tokens
+
+    def _acquire(self, priority: CallPriority, estimate: float, deadline: float):
+        """ Blocks until this call is the highest-priority waiter and the budget allows it. """
+        enqueued_at = time.monotonic()
+        with self._cond:
+            entry = [priority.value, next(self._sequence), priority]
+            heapq.heappush(self._waiting, entry)
+            try:
+                while True:
+                    self._sync_priorities()
+                    now = time.monotonic()
+                    wait = None
+                    if self._waiting[0] is entry:
+                        # Takes the budget when it allows the call; other workers draw on it too
+                        wait = self._budget.paused_for(PAUSE_KEY) or \
+                            self._budget.try_take({REQUESTS_BUCKET: 1, TOKENS_BUCKET: estimate})
+                        if wait <= 0:
+                            break
+                    if now >= deadline:
+                        self._stats["gave_up"] += 1
+                        raise GeminiBusyError(
+                            f"Gemini call waited more than {self.max_wait:.0f}s for rate-limit capacity",
+                            wait if wait is not None else self.max_wait
+                        )
+                    self._cond.wait(timeout=min(wait if wait is not None else 1.0, deadline - now))
+            except BaseException:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+                raise
+            heapq.heappop(self._waiting)
+            waited_ms = (time.monotonic() - enqueued_at) * 1000
+            metrics.stage_seconds.observe(waited_ms / 1000, stage="scheduler_wait")
+            self._stats["admitted"] += 1
+            self._stats["wait_ms_total"] += waited_ms
+            self._stats["wait_ms_max"] = max(self._stats["wait_ms_max"], waited_ms)
+            self._cond.notify_all() # The next waiter becomes the head
+
+    def stats(self) -> dict:
+        with self._cond:
+            depth = {name: 0 for name in PRIORITY_NAMES.values()}
+            for priority, _, _ in self._waiting:
+                depth[PRIORITY_NAMES.get(priority, str(priority))] += 1
+            stats = dict(self._stats)
+            admitted = stats.pop("admitted")
+            wait_ms_total = stats.pop("wait_ms_total")
+            return {
+                "requests_per_minute": self.requests_per_minute,
+                "tokens_per_minute": self.tokens_per_minute,
+                "queue_depth": depth,
+                "admitted": admitted,
+                "wait_ms_avg": round(wait_ms_total / admitted, 1) if admitted else 0.0,
+                "wait_ms_max": round(stats.pop("wait_ms_max"), 1),
+                "paused_for_s": round(self._budget.paused_for(PAUSE_KEY), 1),
+                "budget_left": {
+                    "requests": _rounded(self._budget.level(REQUESTS_BUCKET)),
+                    "tokens": _rounded(self._budget.level(TOKENS_BUCKET))
+                },
+                "token_estimates": {label: round(value) for label, value in self._token_estimates.items()},
+                **stats
+            }
+
+
+def _rounded(value: Optional[float]) -> Optional[float]:
+    return round(value, 1) if value is not None else None
+
+
+gemini_scheduler = GeminiScheduler()
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+Production entry point: serves the app with several uvicorn worker processes.
+Caches, upload leases, jobs and Gemini rate budgets live in the shared SQLite
+database (CACHE_DB_PATH), so every worker sees the others' work.
+
+    python serve.py --workers 4 --port 8000
+"""
+import argparse
+import os
+
+import uvicorn
+from dotenv import load_dotenv
+
+load_dotenv()
+import log_config
+log_config.configure_logging() # For the supervisor process; workers configure their own on import
+
+# --- Configuration ---
+SERVE_HOST = os.getenv("SERVE_HOST", "0.0.0.0")
+SERVE_PORT = int(os.getenv("SERVE_PORT", "8000"))
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", str(os.cpu_count() or 1))) # Worker processes
+FORWARDED_ALLOW_IPS = os.getenv("FORWARDED_ALLOW_IPS", "127.0.0.1") # Proxies trusted for X-Forwarded-* headers
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve LessonGenie with multiple worker processes.")
+    parser.add_argument("--host", default=SERVE_HOST)
+    parser.add_argument("--port", type=int, default=SERVE_PORT)
+    parser.add_argument("--workers", type=int, default=WEB_CONCURRENCY)
+    args = parser.parse_args()
+
+    uvicorn.run(
+        "main:app",
+        host=args.host,
+        port=args.port,
+        workers=max(1, args.workers),
+        proxy_headers=True,
+        forwarded_allow_ips=FORWARDED_ALLOW_IPS,
+        log_config=None # Each worker routes uvicorn's records through our queued logging
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,613 @@
+# -*- coding: utf-8 -*-
+"""
+Service layer shared by the API endpoints: owns the caches and wraps the
+gemini_utils helpers with cache lookups.
+"""
+import os
+import asyncio
+import logging
+import shutil
+import tempfile
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+from pydantic import ValidationError
+
+import gemini_utils
+import pdf_pages
+import sharding
+import scheduler
+import metrics
+from scheduler import GeminiBusyError, GeminiTimeoutError
+from cache import PaperIndex, LessonCache, FileLeases, RateBuckets
+from file_lifecycle import FileLifecycleManager
+from json_stream import JsonStreamParser, WILDCARD
+from singleflight import SingleFlight
+from models import LessonResponse, ExtractedQuestionItem, QuestionListResponse, StepModel
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+EXTRACTION_MODEL_NAME = os.getenv("EXTRACTION_MODEL", "gemini-1.5-flash-latest") # Or pro if needed
+# Context caching (GEMINI_CONTEXT_CACHE=1) needs a versioned model here, e.g. gemini-1.5-flash-002
+LESSON_MODEL_NAME = os.getenv("LESSON_MODEL", "gemini-1.5-flash-latest")
+BATCH_LESSON_CONCURRENCY = int(os.getenv("BATCH_LESSON_CONCURRENCY", "4")) # Lessons generated at once per batch request
+# Lessons upload only the pages of their question when the paper has a local page index
+PAGE_SLICING_ENABLED = os.getenv("PAGE_SLICING", "1") == "1" and pdf_pages.is_available()
+PAGE_SLICING_MIN_PAGES = int(os.getenv("PAGE_SLICING_MIN_PAGES", "4")) # Shorter papers are sent whole
+# Opt-in: long papers are split into overlapping page ranges that are extracted concurrently.
+# Costs one upload and model call per shard instead of one per paper.
+SHARDED_EXTRACTION_ENABLED = os.getenv("SHARDED_EXTRACTION", "0") == "1" and pdf_pages.is_available()
+EXTRACTION_SHARD_MIN_PAGES = int(os.getenv("EXTRACTION_SHARD_MIN_PAGES", "16")) # Shorter papers are extracted in one call
+EXTRACTION_SHARD_PAGES = int(os.getenv("EXTRACTION_SHARD_PAGES", "8"))
+EXTRACTION_SHARD_OVERLAP_PAGES = int(os.getenv("EXTRACTION_SHARD_OVERLAP_PAGES", "1"))
+EXTRACTION_SHARD_CONCURRENCY = int(os.getenv("EXTRACTION_SHARD_CONCURRENCY", "4")) # Shards extracted at once per paper
+PAPER_STORE_DIR = os.getenv("PAPER_STORE_DIR", "cache/papers") # Local copies of indexed papers, by digest
+# Opt-in lesson prefetch: after extraction, lessons for the first N questions are generated in the background
+PREFETCH_LESSONS = int(os.getenv("PREFETCH_LESSONS", "0")) # 0 disables prefetching
+PREFETCH_ALL_MAX_QUESTIONS = int(os.getenv("PREFETCH_ALL_MAX_QUESTIONS", "6")) # Papers this short are prefetched whole
+PREFETCH_CONCURRENCY = int(os.getenv("PREFETCH_CONCURRENCY", "1")) # Prefetched lessons generated at once
+PREFETCH_MIN_IDLE_WORKERS = int(os.getenv("PREFETCH_MIN_IDLE_WORKERS", "2")) # Prefetch waits while fewer Gemini workers are idle
+PREFETCH_MAX_PER_HOUR = int(os.getenv("PREFETCH_MAX_PER_HOUR", "60")) # Spend cap: prefetched generations per hour, across all workers
+
+
+def _stored_pdf_path(pdf_digest: str) -> str:
+    return os.path.join(PAPER_STORE_DIR, f"{pdf_digest}.pdf")
+
+
+def _remove_stored_papers(digests: List[str]):
+    """ Deletes local copies of papers evicted from the paper index. """
+    for pdf_digest in digests:
+        try:
+            os.remove(_stored_pdf_path(pdf_digest))
+        except FileNotFoundError:
+            pass
+
+
+paper_index = PaperIndex(on_evict=_remove_stored_papers) # Content-addressed cache of uploads and extracted question lists
+lesson_cache = LessonCache() # Generated lessons keyed by (paper hash, question, model, prompt version)
+extraction_flights = SingleFlight() # Running extractions, by paper digest
+lesson_flights = SingleFlight() # Running lesson generations, by lesson cache key (or file and question)
+# Uploads are deleted by a background reaper once unused for FILE_LEASE_SECONDS, not after each request
+file_manager = FileLifecycleManager(
+    FileLeases(),
+    on_expire=lambda file_name: release_file(file_name),
+    on_missing=paper_index.forget_file,
+    is_referenced=paper_index.references_file,
+    in_use=lambda: _prefetch_pending.keys() # Prefetches still read these; released when they finish
+)
+
+
+class PipelineError(Exception):
+    """ A pipeline step failed; carries the HTTP status code and message for the client. """
+
+    def __init__(self, status_code: int, detail: str, retry_after: Optional[float] = None):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after # Seconds, for 503 responses
+
+
+def _busy_error(error: GeminiBusyError) -> PipelineError:
+    logger.warning("Gemini is over its rate limits: %s", error)
+    return PipelineError(503, "The AI service is busy right now. Please retry shortly.", retry_after=error.retry_after)
+
+
+def _timeout_error(error: GeminiTimeoutError) -> PipelineError:
+    logger.warning("Gemini call timed out: %s", error)
+    return PipelineError(504, "The AI service took too long to respond. Please retry.")
+
+
+# --- Question Extraction ---
+
+async def extract_paper(
+    pdf_path: str,
+    pdf_digest: str,
+    display_name: str,
+    on_question: Optional[Callable[[ExtractedQuestionItem], None]] = None,
+    on_stage: Optional[Callable[[str], None]] = None
+) -> QuestionListResponse:
+    """
+    Returns the question list for a saved PDF, uploading and extracting only when
+    the paper index has no usable entry for its digest. When on_question is given,
+    extraction is streamed and each question is reported as soon as it is complete.
+    When on_stage is given, it is called with "uploaded" and "extracted" as each
+    stage completes (immediately for cached stages). Concurrent calls for the same
+    digest share one extraction. Raises PipelineError on failure.
+    """
+    on_stage = on_stage or (lambda stage: None)
+    if extraction_flights.running(pdf_digest):
+        logger.info("Paper %s is already being extracted. Joining it.", pdf_digest[:12])
+    question_list, joined = await extraction_flights.run(
+        pdf_digest,
+        lambda: _extract_paper(pdf_path, pdf_digest, display_name, on_question, on_stage)
+    )
+    if joined:
+        on_stage("uploaded")
+        on_stage("extracted")
+        if on_question:
+            for question in question_list.questions:
+                on_question(question)
+    return question_list.model_copy(update={"paperHash": pdf_digest})
+
+
+async def _extract_paper(pdf_path, pdf_digest, display_name, on_question, on_stage) -> QuestionListResponse:
+    cached_questions, cached_file_name = paper_index.lookup(pdf_digest)
+    if cached_file_name and not file_manager.touch(cached_file_name):
+        cached_file_name = None # Its lease ran out and the reaper is deleting it
+    if cached_questions and cached_file_name:
+        logger.info("Paper %s found in cache. Reusing file %s.", pdf_digest[:12], cached_file_name)
+        on_stage("uploaded")
+        on_stage("extracted")
+        return _report_questions(cached_questions.model_copy(update={"pdfFileId": cached_file_name}), pdf_digest, on_question)
+
+    try:
+        uploaded_file = await gemini_utils.upload_pdf_to_gemini_async(pdf_path=pdf_path, display_name=display_name)
+    except GeminiTimeoutError as e:
+        raise _timeout_error(e)
+    if not uploaded_file:
+        raise PipelineError(500, "Failed to upload PDF to Gemini File API.")
+    file_manager.register(uploaded_file.name)
+    on_stage("uploaded")
+
+    if cached_questions:
+        # Questions are known but the previous upload expired; only the upload was redone
+        logger.info("Paper %s found in cache with an expired upload. Re-uploaded as %s.", pdf_digest[:12], uploaded_file.name)
+        paper_index.update_file(pdf_digest, uploaded_file.name)
+        if PAGE_SLICING_ENABLED:
+            await asyncio.to_thread(_keep_local_copy, pdf_path, pdf_digest)
+        on_stage("extracted")
+        return _report_questions(cached_questions.model_copy(update={"pdfFileId": uploaded_file.name}), pdf_digest, on_question)
+
+    try:
+        question_list = None
+        if SHARDED_EXTRACTION_ENABLED:
+            question_list = await _extract_sharded(pdf_path, uploaded_file.name)
+            if question_list and on_question:
+                for question in question_list.questions:
+                    on_question(question)
+        if question_list is None and on_question is None:
+            question_list = await gemini_utils.extract_questions_from_pdf_async(
+                uploaded_file=uploaded_file,
+                model_name=EXTRACTION_MODEL_NAME
+            )
+        elif question_list is None:
+            question_list = await _stream_question_list(uploaded_file, on_question)
+    except GeminiBusyError as e:
+        await gemini_utils.delete_uploaded_file_async(uploaded_file.name)
+        raise _busy_error(e)
+    except GeminiTimeoutError as e:
+        await gemini_utils.delete_uploaded_file_async(uploaded_file.name)
+        raise _timeout_error(e)
+    except Exception:
+        await gemini_utils.delete_uploaded_file_async(uploaded_file.name)
+        raise
+    if not question_list:
+        # Extraction failed, delete the file we just uploaded
+        await gemini_utils.delete_uploaded_file_async(uploaded_file.name)
+        raise PipelineError(500, "Failed to extract questions from the PDF.")
+
+    # We need pdfFileId in the response for the next step
+    if not question_list.pdfFileId:
+        question_list.pdfFileId = uploaded_file.name # Ensure it's set
+    if PAGE_SLICING_ENABLED:
+        await asyncio.to_thread(_index_pages, pdf_path, pdf_digest, question_list)
+    if question_list._salvaged:
+        # Questions were lost to cut-off output; a later upload of the paper extracts it again
+        logger.warning("Question list for paper %s was salvaged from incomplete output. Not caching it.", pdf_digest[:12])
+        on_stage("extracted")
+        return question_list
+    paper_index.store(pdf_digest, uploaded_file.name, question_list)
+    on_stage("extracted")
+    schedule_prefetch(question_list, pdf_digest)
+    return question_list
+
+
+async def _extract_sharded(pdf_path: str, pdf_file_id: str) -> Optional[QuestionListResponse]:
+    """
+    Extracts a long paper as overlapping page ranges in parallel and merges the
+    results, so latency follows the longest shard rather than the whole paper.
+    None when the paper is too short to shard or a shard failed; the caller then
+    extracts the whole document. GeminiBusyError is passed on.
+    """
+    try:
+        total_pages = await asyncio.to_thread(pdf_pages.page_count, pdf_path)
+    except Exception as e:
+        logger.warning("Could not count pages of %s for sharded extraction: %s", pdf_path, e)
+        return None
+    if total_pages < EXTRACTION_SHARD_MIN_PAGES:
+        return None
+    shards = sharding.plan_shards(total_pages, EXTRACTION_SHARD_PAGES, EXTRACTION_SHARD_OVERLAP_PAGES)
+    logger.info("Extracting %s pages as %s shards.", total_pages, len(shards))
+    semaphore = asyncio.Semaphore(EXTRACTION_SHARD_CONCURRENCY)
+    results = await asyncio.gather(
+        *(_extract_shard(pdf_path, page_start, page_end, semaphore) for page_start, page_end in shards),
+        return_exceptions=True
+    )
+    for result in results:
+        if isinstance(result, GeminiBusyError):
+            raise result
+    failed = [shard for shard, result in zip(shards, results) if result is None or isinstance(result, Exception)]
+    if failed:
+        logger.warning("Extraction failed for %s of %s shards (pages %s). Extracting the whole paper instead.",
+                       len(failed), len(shards), ", ".join(f"{start}-{end}" for start, end in failed))
+        return None
+    questions = sharding.merge_shards(list(zip(shards, [result.questions for result in results])))
+    logger.info("Merged %s shards into %s questions.", len(shards), len(questions))
+    merged = QuestionListResponse(pdfFileId=pdf_file_id, questions=questions)
+    merged._salvaged = any(result._salvaged for result in results)
+    return merged
+
+
+async def _extract_shard(pdf_path: str, page_start: int, page_end: int, semaphore: asyncio.Semaphore) -> Optional[QuestionListResponse]:
+    """ Uploads pages page_start..page_end of the paper on their own and extracts their questions. """
+    async with semaphore:
+        shard_path = f"{pdf_path}.p{page_start}-{page_end}.pdf"
+        try:
+            with metrics.stage("page_slice"):
+                await asyncio.to_thread(pdf_pages.write_page_slice, pdf_path, shard_path, page_start, page_end)
+            uploaded_shard = await gemini_utils.upload_pdf_to_gemini_async(
+                pdf_path=shard_path,
+                display_name=f"{os.path.basename(pdf_path)}-pages-{page_start}-{page_end}.pdf"
+            )
+        finally:
+            if os.path.exists(shard_path):
+                os.remove(shard_path)
+        if not uploaded_shard:
+            return None
+        try:
+            return await gemini_utils.extract_questions_from_pdf_async(
+                uploaded_file=uploaded_shard,
+                model_name=EXTRACTION_MODEL_NAME
+            )
+        finally:
+            # Shards are only needed for extraction; lessons use the whole upload or their own page slice
+            await gemini_utils.delete_uploaded_file_async(uploaded_shard.name)
+
+
+def _keep_local_copy(pdf_path: str, pdf_digest: str):
+    """ Keeps the paper in the local store so page slices can be cut from it later. """
+    stored_path = _stored_pdf_path(pdf_digest)
+    if not os.path.exists(stored_path):
+        os.makedirs(PAPER_STORE_DIR, exist_ok=True)
+        shutil.copyfile(pdf_path, stored_path)
+
+
+def _index_pages(pdf_path: str, pdf_digest: str, question_list: QuestionListResponse):
+    """ Records the page range of each question from the PDF's text layer (model-reported as fallback). """
+    try:
+        with metrics.stage("page_index"):
+            pdf_pages.locate_questions(pdf_path, question_list.questions)
+        _keep_local_copy(pdf_path, pdf_digest)
+    except Exception as e:
+        logger.warning("Could not index pages of paper %s: %s: %s", pdf_digest[:12], type(e).__name__, e)
+        return
+    located = sum(1 for question in question_list.questions if question.pageStart)
+    logger.info("Located pages for %s/%s questions.", located, len(question_list.questions))
+
+
+def _report_questions(question_list: QuestionListResponse, pdf_digest: str, on_question) -> QuestionListResponse:
+    """ Replays a cached question list through the streaming callback. """
+    if on_question:
+        for question in question_list.questions:
+            on_question(question)
+    schedule_prefetch(question_list, pdf_digest)
+    return question_list
+
+
+async def _stream_question_list(uploaded_file, on_question) -> Optional[QuestionListResponse]:
+    parser = JsonStreamParser({("questions", WILDCARD): "question"})
+    try:
+        async for chunk in gemini_utils.stream_questions_from_pdf_async(uploaded_file, EXTRACTION_MODEL_NAME):
+            for _, value in parser.feed(chunk):
+                try:
+                    on_question(ExtractedQuestionItem.model_validate(value))
+                except ValidationError:
+                    pass # Reported by the final validation
+    except (GeminiBusyError, GeminiTimeoutError):
+        raise
+    except Exception as e:
+        logger.error("An error occurred during streamed question extraction: %s: %s", type(e).__name__, e)
+        return None
+    # Full validation of the complete document, as in the non-streaming path
+    return gemini_utils.parse_question_list(parser.text, uploaded_file.name)
+
+
+# --- Lesson Generation ---
+
+def questions_for_file(pdf_file_id: str) -> Optional[List[ExtractedQuestionItem]]:
+    """ Returns the extracted questions of an indexed upload, or None if the file is unknown. """
+    paper_digest = paper_index.digest_for_file(pdf_file_id)
+    if not paper_digest:
+        return None
+    question_list = paper_index.get_questions(paper_digest)
+    return question_list.questions if question_list else None
+
+
+async def get_lesson(
+    pdf_file_id: str,
+    question_id: str,
+    question_text: Optional[str],
+    on_part: Optional[Callable[[str, Any], None]] = None
+) -> Optional[LessonResponse]:
+    """
+    Returns the lesson for one question, from the lesson cache when the paper is
+    indexed, otherwise by generating it. Returns None if generation fails; raises
+    PipelineError (503) when Gemini stays over its rate limits, or (504) when it
+    does not answer in time.
+    When on_part is given, generation is streamed and on_part("concept", html) and
+    on_part("step", StepModel) are called as soon as each part is complete.
+    """
+    cache_key = None
+    file_manager.touch(pdf_file_id) # Keep the upload while its questions are being studied
+    paper_digest = paper_index.digest_for_file(pdf_file_id)
+    if paper_digest:
+        cache_key = _lesson_key(paper_digest, question_id)
+        cached_lesson = lesson_cache.get(cache_key)
+        if cached_lesson:
+            logger.info("Lesson for Q ID '%s' found in cache.", question_id)
+            if _prefetched_keys.pop(cache_key, None):
+                _prefetch_stats["hits"] += 1
+            _replay_lesson(cached_lesson, on_part)
+            return cached_lesson
+
+    # Identical concurrent requests (or a running prefetch) share one generation
+    flight_key = cache_key or f"{pdf_file_id}|{question_id}"
+    if lesson_flights.running(flight_key):
+        logger.info("Lesson for Q ID '%s' is already being generated. Joining it.", question_id)
+        if cache_key and _prefetched_keys.pop(cache_key, None):
+            _prefetch_stats["joined"] += 1
+    lesson, joined = await lesson_flights.run(
+        flight_key,
+        lambda: _generate_lesson(pdf_file_id, question_id, question_text, paper_digest, cache_key, on_part)
+    )
+    if joined and lesson:
+        _replay_lesson(lesson, on_part)
+    return lesson
+
+
+def cached_lesson(paper_digest: str, question_id: str) -> Optional[LessonResponse]:
+    """ Returns the cached lesson for a question of an indexed paper, without generating it. """
+    # Not counted in the cache stats: a miss here is followed by a POST that looks the lesson up again
+    return lesson_cache.peek(_lesson_key(paper_digest, question_id))
+
+
+def current_question_list(paper_digest: str) -> Optional[QuestionListResponse]:
+    """ Returns the cached question list of a paper, pointing at its live upload ("" if there is none). """
+    question_list, file_name = paper_index.lookup(paper_digest)
+    if not question_list:
+        return None
+    if file_name and not file_manager.touch(file_name):
+        file_name = None
+    return question_list.model_copy(update={"pdfFileId": file_name or "", "paperHash": paper_digest})
+
+
+def _lesson_key(paper_digest: str, question_id: str) -> str:
+    return LessonCache.make_key(paper_digest, question_id, LESSON_MODEL_NAME, gemini_utils.LESSON_PROMPT_VERSION)
+
+
+def _replay_lesson(lesson: LessonResponse, on_part):
+    """ Reports a finished lesson through the streaming callback. """
+    if on_part:
+        on_part("concept", lesson.lessonData.coreConceptHtml)
+        for step in lesson.lessonData.steps:
+            on_part("step", step)
+
+
+async def _generate_lesson(pdf_file_id, question_id, question_text, paper_digest, cache_key, on_part) -> Optional[LessonResponse]:
+    lesson_file_id = pdf_file_id
+    if paper_digest and PAGE_SLICING_ENABLED:
+        question = _find_question(paper_digest, question_id)
+        if question:
+            question_text = question_text or question.questionText
+            lesson_file_id = await _page_slice_for_question(paper_digest, question) or pdf_file_id
+
+    try:
+        if on_part is None:
+            lesson = await gemini_utils.generate_structured_lesson_async(
+                pdf_file_id=lesson_file_id,
+                selected_question_id=question_id,
+                selected_question_text=question_text,
+                model_name=LESSON_MODEL_NAME
+            )
+        else:
+            lesson = await _stream_lesson(lesson_file_id, question_id, question_text, on_part)
+    except GeminiBusyError as e:
+        raise _busy_error(e)
+    except GeminiTimeoutError as e:
+        raise _timeout_error(e)
+    if lesson and cache_key:
+        if lesson._salvaged:
+            logger.warning("Lesson for Q ID '%s' was rebuilt from incomplete output. Not caching it.", question_id)
+        else:
+            lesson_cache.put(cache_key, lesson)
+    return lesson
+
+
+def _find_question(pdf_digest: str, question_id: str) -> Optional[ExtractedQuestionItem]:
+    question_list = paper_index.get_questions(pdf_digest)
+    if not question_list:
+        return None
+    return next((question for question in question_list.questions if question.questionId == question_id), None)
+
+
+async def _page_slice_for_question(pdf_digest: str, question: ExtractedQuestionItem) -> Optional[str]:
+    """
+    Returns the File API name of an upload holding only the question's pages, cut
+    from the local copy of the paper and uploaded once per (paper, page range).
+    None when the whole paper should be sent instead.
+    """
+    stored_path = _stored_pdf_path(pdf_digest)
+    if not question.pageStart or not os.path.exists(stored_path):
+        return None
+    page_start, page_end = question.pageStart, max(question.pageEnd or question.pageStart, question.pageStart)
+    slice_file_name = paper_index.get_slice(pdf_digest, page_start, page_end)
+    if slice_file_name and file_manager.touch(slice_file_name):
+        logger.info("Reusing page slice %s (pages %s-%s).", slice_file_name, page_start, page_end)
+        return slice_file_name
+
+    try:
+        total_pages = await asyncio.to_thread(pdf_pages.page_count, stored_path)
+        if total_pages < PAGE_SLICING_MIN_PAGES or page_end - page_start + 1 >= total_pages:
+            return None
+        slice_path = os.path.join(PAPER_STORE_DIR, f"{pdf_digest}.p{page_start}-{page_end}.pdf")
+        # Written under a temp name and renamed, so a failed write never leaves a partial slice behind
+        fd, temp_slice_path = tempfile.mkstemp(prefix=f".{pdf_digest}.", suffix=".part", dir=PAPER_STORE_DIR)
+        os.close(fd)
+        try:
+            with metrics.stage("page_slice"):
+                await asyncio.to_thread(pdf_pages.write_page_slice, stored_path, temp_slice_path, page_start, page_end)
+            os.replace(temp_slice_path, slice_path)
+        finally:
+            if os.path.exists(temp_slice_path):
+                os.remove(temp_slice_path)
+    except Exception as e:
+        logger.warning("Could not slice pages %s-%s of paper %s: %s", page_start, page_end, pdf_digest[:12], e)
+        return None
+    try:
+        uploaded_slice = await gemini_utils.upload_pdf_to_gemini_async(
+            pdf_path=slice_path,
+            display_name=f"paper-{pdf_digest[:12]}-pages-{page_start}-{page_end}.pdf"
+        )
+    except GeminiTimeoutError:
+        uploaded_slice = None # Logged; the lesson is generated from the whole paper instead
+    finally:
+        os.remove(slice_path)
+    if not uploaded_slice:
+        return None
+    file_manager.register(uploaded_slice.name)
+    logger.info("Uploaded pages %s-%s of %s as %s.", page_start, page_end, total_pages, uploaded_slice.name)
+    paper_index.store_slice(pdf_digest, page_start, page_end, uploaded_slice.name)
+    return uploaded_slice.name
+
+
+async def _stream_lesson(pdf_file_id, question_id, question_text, on_part) -> Optional[LessonResponse]:
+    parser = JsonStreamParser({
+        ("lessonData", "coreConceptHtml"): "concept",
+        ("lessonData", "steps", WILDCARD): "step",
+    })
+    # One deadline for the stream and any continuation, as for a non-streamed lesson
+    deadline = asyncio.get_running_loop().time() + gemini_utils.MODEL_CALL_TIMEOUT
+    try:
+        async for chunk in gemini_utils.stream_structured_lesson_async(
+            pdf_file_id, question_id, question_text, LESSON_MODEL_NAME, deadline=deadline
+        ):
+            for event, value in parser.feed(chunk):
+                if event == "step":
+                    try:
+                        value = StepModel.model_validate(value)
+                    except ValidationError:
+                        continue # Reported by the final validation
+                on_part(event, value)
+    except (GeminiBusyError, GeminiTimeoutError):
+        raise
+    except Exception as e:
+        logger.error("An error occurred during streamed lesson generation: %s: %s", type(e).__name__, e)
+        return None
+    # Full validation (and repair) of the complete document, as in the non-streaming path
+    return await gemini_utils.parse_lesson_async(parser.text, pdf_file_id, question_id, question_text, LESSON_MODEL_NAME, deadline=deadline)
+
+
+# --- Lesson Prefetch ---
+
+_prefetch_semaphore: Optional[asyncio.Semaphore] = None
+_prefetch_pending: Dict[str, int] = {} # File name -> prefetches queued or running
+_prefetch_budget = RateBuckets() # Shared by all worker processes
+if PREFETCH_MAX_PER_HOUR > 0:
+    _prefetch_budget.configure("prefetch", PREFETCH_MAX_PER_HOUR, period_seconds=3600)
+_prefetched_keys: "OrderedDict[str, bool]" = OrderedDict() # Prefetched lessons not yet requested
+PREFETCHED_KEYS_MAX = 1000
+_prefetch_tasks: set = set()
+_prefetch_stats = {"scheduled": 0, "generated": 0, "failed": 0, "skipped_budget": 0, "hits": 0, "joined": 0}
+
+
+def schedule_prefetch(question_list: QuestionListResponse, pdf_digest: str):
+    """
+    Queues background generation of the lessons a user is likely to open next:
+    every question of short papers, otherwise the first PREFETCH_LESSONS.
+    No-op unless PREFETCH_LESSONS is set.
+    """
+    global _prefetch_semaphore
+    if PREFETCH_LESSONS <= 0 or not question_list.pdfFileId:
+        return
+    if _prefetch_semaphore is None:
+        _prefetch_semaphore = asyncio.Semaphore(PREFETCH_CONCURRENCY)
+    questions = question_list.questions
+    if len(questions) > PREFETCH_ALL_MAX_QUESTIONS:
+        questions = questions[:PREFETCH_LESSONS]
+    pdf_file_id = question_list.pdfFileId
+    for question in questions:
+        cache_key = _lesson_key(pdf_digest, question.questionId)
+        if lesson_flights.running(cache_key) or lesson_cache.contains(cache_key):
+            continue
+        _prefetch_stats["scheduled"] += 1
+        _prefetch_pending[pdf_file_id] = _prefetch_pending.get(pdf_file_id, 0) + 1
+        task = asyncio.create_task(_prefetch_lesson(pdf_file_id, pdf_digest, question, cache_key))
+        _prefetch_tasks.add(task) # Keep a reference until it finishes
+        task.add_done_callback(_prefetch_tasks.discard)
+
+
+def _take_prefetch_budget() -> bool:
+    return PREFETCH_MAX_PER_HOUR > 0 and _prefetch_budget.try_take({"prefetch": 1}) == 0
+
+
+async def _prefetch_lesson(pdf_file_id: str, pdf_digest: str, question: ExtractedQuestionItem, cache_key: str):
+    scheduler.set_priority(scheduler.PRIORITY_PREFETCH) # Applies to this task only
+    try:
+        async with _prefetch_semaphore:
+            # Low priority: wait until interactive requests leave Gemini workers idle
+            while gemini_utils.get_executor_stats()["in_flight"] > gemini_utils.GEMINI_MAX_WORKERS - PREFETCH_MIN_IDLE_WORKERS:
+                await asyncio.sleep(0.5)
+            if lesson_flights.running(cache_key) or lesson_cache.contains(cache_key):
+                return
+            if not await asyncio.to_thread(_take_prefetch_budget): # BEGIN IMMEDIATE can wait for other workers
+                _prefetch_stats["skipped_budget"] += 1
+                return
+            logger.info("Prefetching lesson for Q ID '%s'.", question.questionId)
+            _prefetched_keys[cache_key] = True
+            while len(_prefetched_keys) > PREFETCHED_KEYS_MAX:
+                _prefetched_keys.popitem(last=False)
+            lesson, _ = await lesson_flights.run(
+                cache_key,
+                lambda: _generate_lesson(pdf_file_id, question.questionId, question.questionText, pdf_digest, cache_key, None)
+            )
+            if lesson:
+                _prefetch_stats["generated"] += 1
+            else:
+                _prefetch_stats["failed"] += 1
+                _prefetched_keys.pop(cache_key, None)
+    except Exception as e:
+        _prefetch_stats["failed"] += 1
+        _prefetched_keys.pop(cache_key, None)
+        logger.error("Error prefetching lesson for Q ID '%s': %s: %s", question.questionId, type(e).__name__, e)
+    finally:
+        _prefetch_pending[pdf_file_id] -= 1
+        if not _prefetch_pending[pdf_file_id]:
+            del _prefetch_pending[pdf_file_id]
+            # The reaper skipped the file while it was being read; release it now if its lease ran out meanwhile
+            if await file_manager.release_if_expired(pdf_file_id):
+                logger.info("Prefetches for %s finished after its lease expired. Released the file.", pdf_file_id)
+
+
+def prefetch_stats() -> dict:
+    served = _prefetch_stats["hits"] + _prefetch_stats["joined"]
+    return {
+        **_prefetch_stats,
+        "hit_rate": round(served / _prefetch_stats["generated"], 3) if _prefetch_stats["generated"] else None,
+        "budget_left": round(_prefetch_budget.level("prefetch") or 0, 1),
+        "max_per_hour": PREFETCH_MAX_PER_HOUR,
+        "pending": sum(_prefetch_pending.values())
+    }
+
+
+async def release_file(pdf_file_id: Optional[str]):
+    """
+    Deletes an upload from the File API and drops it from the paper index and the
+    lease table. Called by the file reaper once the upload's lease expires.
+    While lessons are being prefetched from the file, the reaper leaves its lease
+    in place and the release runs when they finish, so they still land in the
+    cache for later uploads of the same paper.
+    """
+    file_manager.leases.forget(pdf_file_id)
+    await gemini_utils.delete_uploaded_file_async(pdf_file_id)
+    paper_index.forget_file(pdf_file_id)
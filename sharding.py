@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Sharded question extraction for long papers: the page ranges a paper is split
+into (consecutive shards share a few pages, so a question crossing a boundary is
+seen whole by at least one shard), and the merge of the per-shard question lists
+into one list in document order without the duplicates the overlap produces.
+"""
+from difflib import SequenceMatcher
+from typing import List, Optional, Tuple
+
+from models import ExtractedQuestionItem
+from pdf_pages import normalize_text
+
+DUPLICATE_MIN_CHARS = 20 # Shorter texts must match exactly to count as the same question
+DUPLICATE_SIMILARITY = 0.9 # SequenceMatcher ratio above which two texts are the same question
+
+PageRange = Tuple[int, int] # 1-based, inclusive
+
+
+def plan_shards(total_pages: int, shard_pages: int, overlap_pages: int) -> List[PageRange]:
+    """ Splits 1..total_pages into ranges of shard_pages pages, each overlapping the previous by overlap_pages. """
+    step = max(1, shard_pages - overlap_pages)
+    shards = []
+    page_start = 1
+    while True:
+        page_end = min(total_pages, page_start + shard_pages - 1)
+        shards.append((page_start, page_end))
+        if page_end >= total_pages:
+            return shards
+        page_start += step
+
+
+def _document_pages(question: ExtractedQuestionItem, shard: PageRange) -> ExtractedQuestionItem:
+    """ Converts the shard-relative page numbers the model reported to document pages. """
+    page_start, page_end = shard
+
+    def convert(page: Optional[int]) -> Optional[int]:
+        if not page:
+            return None
+        page = page_start + page - 1
+        return page if page <= page_end else None
+
+    start = convert(question.pageStart)
+    end = convert(question.pageEnd) or start
+    return question.model_copy(update={"pageStart": start, "pageEnd": end if start and end and end >= start else start})
+
+
+def _same_question(first: str, second: str) -> bool:
+    """ Compares normalized question texts; a fragment of a question cut at a shard edge counts as the same. """
+    if first == second:
+        return True
+    shorter, longer = sorted((first, second), key=len)
+    if len(shorter) < DUPLICATE_MIN_CHARS:
+        return False
+    return shorter in longer or SequenceMatcher(None, first, second, autojunk=False).ratio() >= DUPLICATE_SIMILARITY
+
+
+def _combine(kept: ExtractedQuestionItem, duplicate: ExtractedQuestionItem) -> ExtractedQuestionItem:
+    """ Keeps the more complete text and the union of both page ranges. """
+    text = duplicate.questionText if len(duplicate.questionText) > len(kept.questionText) else kept.questionText
+    starts = [page for page in (kept.pageStart, duplicate.pageStart) if page]
+    ends = [page for page in (kept.pageEnd, duplicate.pageEnd) if page]
+    return kept.model_copy(update={
+        "questionText": text,
+        "pageStart": min(starts) if starts else None,
+        "pageEnd": max(ends) if ends else None
+    })
+
+
+def merge_shards(shard_results: List[Tuple[PageRange, List[ExtractedQuestionItem]]]) -> List[ExtractedQuestionItem]:
+    """
+    Merges per-shard question lists (given in page order) into one list in document
+    order. A question also found by the previous shard is merged into its earlier
+    entry. questionIds are renumbered q1..qN by position, so they do not depend on
+    how the model numbered each shard.
+    """
+    merged: List[ExtractedQuestionItem] = []
+    merged_texts: List[str] = []
+    previous: List[int] = [] # Indexes in merged of the previous shard's questions
+    for shard, questions in shard_results:
+        current = []
+        for question in questions:
+            question = _document_pages(question, shard)
+            text = normalize_text(question.questionText)
+            duplicate = next((index for index in previous if _same_question(merged_texts[index], text)), None)
+            if duplicate is not None:
+                merged[duplicate] = _combine(merged[duplicate], question)
+                merged_texts[duplicate] = normalize_text(merged[duplicate].questionText)
+                current.append(duplicate)
+                continue
+            merged.append(question)
+            merged_texts.append(text)
+            current.append(len(merged) - 1)
+        previous = current
+    return [question.model_copy(update={"questionId": f"q{number}"}) for number, question in enumerate(merged, start=1)]
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Single-flight request coalescing: concurrent calls with the same key share one
+running task, so identical requests arriving together cost one model call.
+A flight's Gemini calls run at the highest priority among its callers.
+"""
+import asyncio
+import contextvars
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+import scheduler
+
+
+class SingleFlight:
+    """ Runs at most one task per key; callers arriving while it runs join it and receive its result. """
+
+    def __init__(self):
+        self._flights: Dict[Hashable, asyncio.Future] = {}
+        self._priorities: Dict[Hashable, scheduler.CallPriority] = {}
+        self.originated = 0
+        self.joined = 0
+
+    def running(self, key: Hashable) -> bool:
+        return key in self._flights
+
+    async def run(self, key: Hashable, start: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        Returns (result, joined). start() is only called when no task for key is
+        running. The task is shielded: it finishes even if the caller that started
+        it goes away, so joined callers still get the result (or its exception).
+        """
+        flight = self._flights.get(key)
+        if flight is not None:
+            self.joined += 1
+            # e.g. an interactive request joining a prefetch: the shared call moves up the queue
+            scheduler.gemini_scheduler.raise_priority(self._priorities[key], scheduler.current_priority().value)
+            return await asyncio.shield(flight), True
+
+        # The flight gets its own priority holder, so raising it leaves the starting task's untouched
+        context = contextvars.copy_context()
+        context.run(scheduler.set_priority, scheduler.current_priority().value)
+        flight = context.run(asyncio.ensure_future, start())
+        self.originated += 1
+        self._flights[key] = flight
+        self._priorities[key] = context.run(scheduler.current_priority)
+
+        def finished(done: asyncio.Future):
+            if self._flights.get(key) is done:
+                del self._flights[key]
+                del self._priorities[key]
+            if not done.cancelled():
+                done.exception() # Mark retrieved in case every caller went away
+
+        flight.add_done_callback(finished)
+        return await asyncio.shield(flight), False
+
+    def stats(self) -> dict:
+        return {"originated": self.originated, "joined": self.joined, "in_flight": len(self._flights)}
@@ -4,9 +4,11 @@
 """
 Standalone Codebase Snapshot Tool (Concise Commands)
 
-This script provides two main functions, runnable from the command line:
+This script provides these functions, runnable from the command line:
 1.  fm <folder>: Creates a single Markdown file snapshot from a source code folder.
 2.  mf <markdown_file>: Recreates a folder structure from a Markdown snapshot file.
+3.  ls <markdown_file>: Lists the files in a snapshot written with --index.
+4.  get <markdown_file> <path>...: Extracts selected files from such a snapshot without reading the rest.
 
 Usage:
   # Create snapshot FROM 'my_project_folder' TO 'snapshot.md' (Folder -> Markdown)
@@ -15,19 +17,78 @@ Usage:
   # Create snapshot with additional ignore patterns
   python this_script.py fm ./proj -o out.md --ignore "*.log" --ignore "temp/"
 
+  # Read files on 16 threads (default: a few more than the CPU count)
+  python this_script.py fm ./proj -o out.md --jobs 16
+
+  # Re-read only files changed since the last run; also write just the changes to delta.md
+  python this_script.py fm ./proj -o out.md --incremental --delta delta.md
+
+  # Apply a delta to a folder recreated earlier (writes changed files, removes deleted ones)
+  python this_script.py mf delta.md -o ./recreated_project
+
   # Recreate folder structure FROM 'snapshot.md' TO 'recreated_project' (Markdown -> Folder)
   python this_script.py mf snapshot.md -o ./recreated_project
+
+  # Leave out binaries (always) and keep only the first 1 MB of bigger files; write it gzip-compressed
+  python this_script.py fm ./proj -o out.md.gz --max-file-size 1000000 --oversize truncate
+
+  # Index the snapshot, then list it and pull out single files, folders or globs
+  python this_script.py fm ./proj -o out.md --index
+  python this_script.py ls out.md "*.py"
+  python this_script.py get out.md src/main.py "docs/" -o ./restored
 """
 
 import os
+import io
+import re
+import codecs
+import contextlib
+import gzip
+import hashlib
+import json
+import time
 import mimetypes
 import fnmatch
+import functools
 import platform
 import argparse
 import sys
+import tempfile
+import unicodedata
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard # Optional: only needed for zstd-compressed snapshots
+except ImportError:
+    zstandard = None
 
 # --- Configuration ---
 ENCODING = 'utf-8'
+DEFAULT_JOBS = min(32, (os.cpu_count() or 1) + 4) # Threads reading files for fm, writing them for mf
+READ_AHEAD_PER_JOB = 8 # Files read ahead of the writer per thread; bounds memory on huge trees
+IS_CASE_SENSITIVE_FS = platform.system() != "Windows"
+WRITE_BEHIND_FILES = 64 # Files mf has parsed but not yet written; bounds its memory together with the next line
+STREAM_CHUNK_BYTES = 1024 * 1024 # mf streams a file to disk while parsing once its block grows past this
+MANIFEST_SUFFIX = ".manifest.json" # fm --incremental keeps the size, mtime, hash and offset of each file here
+MANIFEST_VERSION = 1
+DELTA_HEADING = "# Codebase Snapshot Delta" # First line of fm --delta output; only there do **Deleted:** markers remove files
+RACY_WINDOW_NS = 2 * 10**9 # Files modified this close to the previous run are re-read even if their stat matches
+COPY_CHUNK_BYTES = 1024 * 1024
+SNIFF_BYTES = 8192 # Leading bytes checked for NULs and byte order marks before the rest of a file is read
+SPOOL_MEMORY_BYTES = 256 * 1024 # Rendered sections larger than this wait for the writer on disk instead of in memory
+OVERSIZE_MODES = ("skip", "truncate") # What fm does with files over --max-file-size
+# UTF-16/32 text has NUL bytes, so a byte order mark is looked for before the NUL check (UTF-32 LE before UTF-16 LE)
+TEXT_CONTROLS = frozenset("\t\n\r\f\v\x1b") # Control characters text decoded under a byte order mark may contain
+BOM_ENCODINGS = ((codecs.BOM_UTF32_LE, "utf-32"), (codecs.BOM_UTF32_BE, "utf-32"), (codecs.BOM_UTF16_LE, "utf-16"), (codecs.BOM_UTF16_BE, "utf-16"))
+TRUNCATED_MARKER = "**Truncated:** Only the start of this {size} byte file is included (limit {limit} bytes)." # First line of a truncated block
+TRUNCATED_MARKER_RE = re.compile(re.escape(TRUNCATED_MARKER).replace(r"\{size\}", r"\d+").replace(r"\{limit\}", r"\d+"))
+COMPRESSION_SUFFIXES = {".gz": "gzip", ".zst": "zstd", ".zstd": "zstd"} # Output compression implied by the file name
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+_UMASK = os.umask(0); os.umask(_UMASK) # Read once; streamed files get the mode open() would give them
 
 # --- Default Ignore Patterns ---
 DEFAULT_IGNORE_PATTERNS = [
@@ -40,66 +101,85 @@ DEFAULT_IGNORE_PATTERNS = [
     'settings.local.py',
 ]
 
-# --- Core Helper Functions (No Changes Here) ---
+LANG_MAP_MIME = {
+    "text/x-python": "python", "application/x-python-code": "python",
+    "text/javascript": "javascript", "application/javascript": "javascript",
+    "text/html": "html", "text/css": "css", "application/json": "json",
+    "application/xml": "xml", "text/xml": "xml",
+    "text/x-java-source": "java", "text/x-java": "java",
+    "text/x-csrc": "c", "text/x-c": "c", "text/x-c++src": "cpp", "text/x-c++": "cpp",
+    "application/x-sh": "bash", "text/x-shellscript": "bash",
+    "text/markdown": "markdown", "text/x-yaml": "yaml", "application/x-yaml": "yaml",
+    "text/plain": ""
+}
+LANG_MAP_EXT = {
+    ".py": "python", ".pyw": "python", ".js": "javascript", ".mjs": "javascript", ".cjs": "javascript",
+    ".html": "html", ".htm": "html", ".css": "css", ".java": "java", ".cpp": "cpp", ".cxx": "cpp",
+    ".cc": "cpp", ".hpp": "cpp", ".hxx": "cpp", ".c": "c", ".h": "c", ".cs": "csharp", ".php": "php",
+    ".rb": "ruby", ".go": "go", ".rs": "rust", ".ts": "typescript", ".tsx": "typescript",
+    ".json": "json", ".xml": "xml", ".yaml": "yaml", ".yml": "yaml", ".sh": "bash", ".bash": "bash",
+    ".sql": "sql", ".md": "markdown", ".markdown": "markdown", ".txt": ""
+}
+
+# --- Core Helper Functions ---
+
+class IgnoreMatcher:
+    """All ignore patterns compiled into one regex, matched against a path's basename and its full relative path."""
+    def __init__(self, ignore_patterns):
+        flags = 0 if IS_CASE_SENSITIVE_FS else re.IGNORECASE
+        combined = "|".join(fnmatch.translate(pattern) for pattern in ignore_patterns)
+        self.regex = re.compile(combined or r"(?!)", flags) # (?!) never matches
+
+    def __call__(self, relative_path):
+        normalized_path = relative_path.replace("\\", "/")
+        basename = normalized_path.rsplit("/", 1)[-1]
+        return bool(self.regex.match(basename) or self.regex.match(normalized_path))
+
+@functools.lru_cache(maxsize=64)
+def _compiled_matcher(ignore_patterns):
+    return IgnoreMatcher(ignore_patterns)
 
 def is_ignored(relative_path, ignore_patterns):
-    normalized_path = relative_path.replace("\\", "/")
-    basename = os.path.basename(normalized_path)
-    is_case_sensitive_fs = platform.system() != "Windows"
-    for pattern in ignore_patterns:
-        if fnmatch.fnmatch(basename, pattern) or \
-           (not is_case_sensitive_fs and fnmatch.fnmatch(basename.lower(), pattern.lower())):
-            return True
-        if fnmatch.fnmatch(normalized_path, pattern) or \
-           (not is_case_sensitive_fs and fnmatch.fnmatch(normalized_path.lower(), pattern.lower())):
-            return True
-    return False
+    return _compiled_matcher(tuple(ignore_patterns))(relative_path)
 
 def guess_language(filepath):
-    mimetypes.init()
-    mime_type, _ = mimetypes.guess_type(filepath)
+    return _language_for_extension(os.path.splitext(filepath)[1])
+
+@functools.lru_cache(maxsize=None)
+def _language_for_extension(ext):
+    # guess_type only looks at the extension, so the answer is the same for every file sharing it
+    mime_type, _ = mimetypes.guess_type("file" + ext)
     if mime_type:
-        lang_map_mime = {
-            "text/x-python": "python", "application/x-python-code": "python",
-            "text/javascript": "javascript", "application/javascript": "javascript",
-            "text/html": "html", "text/css": "css", "application/json": "json",
-            "application/xml": "xml", "text/xml": "xml",
-            "text/x-java-source": "java", "text/x-java": "java",
-            "text/x-csrc": "c", "text/x-c": "c", "text/x-c++src": "cpp", "text/x-c++": "cpp",
-            "application/x-sh": "bash", "text/x-shellscript": "bash",
-            "text/markdown": "markdown", "text/x-yaml": "yaml", "application/x-yaml": "yaml",
-            "text/plain": ""
-        }
-        if mime_type in lang_map_mime: return lang_map_mime[mime_type]
+        if mime_type in LANG_MAP_MIME: return LANG_MAP_MIME[mime_type]
         if mime_type.startswith("text/"): return ""
-    _, ext = os.path.splitext(filepath.lower())
-    lang_map_ext = {
-        ".py": "python", ".pyw": "python", ".js": "javascript", ".mjs": "javascript", ".cjs": "javascript",
-        ".html": "html", ".htm": "html", ".css": "css", ".java": "java", ".cpp": "cpp", ".cxx": "cpp",
-        ".cc": "cpp", ".hpp": "cpp", ".hxx": "cpp", ".c": "c", ".h": "c", ".cs": "csharp", ".php": "php",
-        ".rb": "ruby", ".go": "go", ".rs": "rust", ".ts": "typescript", ".tsx": "typescript",
-        ".json": "json", ".xml": "xml", ".yaml": "yaml", ".yml": "yaml", ".sh": "bash", ".bash": "bash",
-        ".sql": "sql", ".md": "markdown", ".markdown": "markdown", ".txt": ""
-    }
-    return lang_map_ext.get(ext, "")
+    return LANG_MAP_EXT.get(ext.lower(), "")
 
-def write_code_to_file(output_dir, relative_filepath, code_lines, encoding=ENCODING):
+def _safe_output_path(output_dir, relative_filepath):
+    """Returns the absolute path relative_filepath is written to, or None if it would land outside output_dir."""
     safe_relative_path = os.path.normpath(relative_filepath).replace("\\", "/")
     if safe_relative_path.startswith("..") or os.path.isabs(safe_relative_path):
         print(f"[WRITE] [WARN] Skipping potentially unsafe path: {relative_filepath}")
-        return False
+        return None
     abs_output_dir = os.path.abspath(output_dir)
     full_path = os.path.join(abs_output_dir, safe_relative_path)
     abs_full_path = os.path.abspath(full_path)
     if not abs_full_path.startswith(abs_output_dir + os.path.sep) and abs_full_path != abs_output_dir:
         print(f"[WRITE] [ERROR] Security Error: Attempted write outside target directory: {relative_filepath} -> {abs_full_path}")
-        return False
+        return None
+    return full_path
+
+def _prepare_parent(full_path):
+    """Creates the parent directories of full_path. False if full_path itself is a directory."""
     dir_name = os.path.dirname(full_path)
+    if dir_name: os.makedirs(dir_name, exist_ok=True)
+    if os.path.isdir(full_path):
+        print(f"[WRITE] [ERROR] Cannot write file. Path exists and is a directory: {full_path}")
+        return False
+    return True
+
+def _write_lines(full_path, code_lines, encoding=ENCODING):
     try:
-        if dir_name: os.makedirs(dir_name, exist_ok=True)
-        if os.path.isdir(full_path):
-             print(f"[WRITE] [ERROR] Cannot write file. Path exists and is a directory: {full_path}")
-             return False
+        if not _prepare_parent(full_path): return False
         with open(full_path, "w", encoding=encoding) as outfile:
             outfile.writelines(code_lines)
         return True
@@ -110,77 +190,339 @@ def write_code_to_file(output_dir, relative_filepath, code_lines, encoding=ENCOD
         print(f"[WRITE] [ERROR] General Error writing file {full_path}: {e}")
         return False
 
-# --- Main Logic Functions (No Changes Here) ---
+def write_code_to_file(output_dir, relative_filepath, code_lines, encoding=ENCODING):
+    full_path = _safe_output_path(output_dir, relative_filepath)
+    return full_path is not None and _write_lines(full_path, code_lines, encoding)
+
+class _BlockWriter:
+    """Collects the lines of one code block for full_path (None: content is only counted, never written).
+    Once a block outgrows STREAM_CHUNK_BYTES it is streamed to a temp file next to its destination instead,
+    which replaces the destination when the block is complete."""
+    def __init__(self, full_path, encoding):
+        self.full_path = full_path; self.encoding = encoding
+        self.lines = []; self.size = 0; self.has_content = False
+        self.spill = None; self.spill_path = None
+
+    def add(self, line):
+        self.has_content = True
+        if self.full_path is None: return
+        if self.spill is not None:
+            self.spill.write(line); return
+        self.lines.append(line); self.size += len(line)
+        if self.size > STREAM_CHUNK_BYTES and _prepare_parent(self.full_path):
+            fd, self.spill_path = tempfile.mkstemp(prefix=f".{os.path.basename(self.full_path)}.", suffix=".part", dir=os.path.dirname(self.full_path))
+            self.spill = os.fdopen(fd, "w", encoding=self.encoding)
+            self.spill.writelines(self.lines); self.lines = []
+
+    def commit(self):
+        """Moves a streamed block into place. Only for spilled blocks; others go through _write_lines."""
+        try:
+            self.spill.close()
+            if not _prepare_parent(self.full_path): return False
+            os.chmod(self.spill_path, 0o666 & ~_UMASK)
+            os.replace(self.spill_path, self.full_path); self.spill_path = None
+            return True
+        except OSError as e:
+            print(f"[WRITE] [ERROR] OS Error writing file {self.full_path}: {e}")
+            return False
+        finally:
+            self.discard()
+
+    def discard(self):
+        self.lines = []
+        if self.spill is not None: self.spill.close(); self.spill = None
+        if self.spill_path is not None:
+            try: os.remove(self.spill_path)
+            except OSError: pass
+            self.spill_path = None
+
+# --- Main Logic Functions ---
+
+def _walk_files(abs_root, matcher, exclude=()):
+    """Yields (path, relative_filepath) in snapshot order; relative_filepath is None for ignored entries.
+    Ignored directories are yielded once and not descended into. Paths in exclude (the tool's own outputs) are ignored."""
+    for dirpath, dirnames, filenames in os.walk(abs_root, topdown=True):
+        kept_dirs = []
+        for d in sorted(dirnames):
+            if matcher(os.path.relpath(os.path.join(dirpath, d), abs_root)): yield d, None
+            else: kept_dirs.append(d)
+        dirnames[:] = kept_dirs # Ignored directories are never descended into
+        for filename in sorted(filenames):
+            filepath = os.path.join(dirpath, filename)
+            relative_filepath = os.path.relpath(filepath, abs_root).replace("\\", "/")
+            yield filepath, (None if filepath in exclude or matcher(relative_filepath) else relative_filepath)
+
+def _sniff_encoding(head, encoding):
+    """The encoding to decode a file with, judged from its first block; None if it looks binary. A byte order
+    mark is trusted only if the block decodes under it to text without NULs, control or unassigned characters."""
+    for bom, bom_encoding in BOM_ENCODINGS:
+        if head.startswith(bom):
+            try: text = codecs.getincrementaldecoder(bom_encoding)().decode(head) # Not final: the block may end mid-character
+            except UnicodeDecodeError: return None
+            return None if any(unicodedata.category(ch) in ("Cc", "Cn", "Co", "Cs") and ch not in TEXT_CONTROLS for ch in text) else bom_encoding
+    return None if b"\0" in head else encoding
+
+def _decode_chunks(f, head, encoding, digest, limit=None):
+    """Yields the text of a file whose first bytes (head) were already read, decoding the rest in
+    COPY_CHUNK_BYTES reads with text-mode newline handling. Reads at most limit bytes, dropping a
+    character cut in half by the limit. Every byte read is added to digest."""
+    decoder = codecs.getincrementaldecoder(encoding)()
+    remaining = None if limit is None else limit - len(head)
+    carry = "" # A trailing \r waits for the next chunk in case it starts with \n
+    chunk = head
+    while chunk:
+        digest.update(chunk)
+        text = carry + decoder.decode(chunk); carry = ""
+        if text.endswith("\r"): text, carry = text[:-1], "\r"
+        yield text.replace("\r\n", "\n").replace("\r", "\n")
+        if remaining is not None and remaining <= 0: break
+        chunk = f.read(COPY_CHUNK_BYTES if remaining is None else min(COPY_CHUNK_BYTES, remaining))
+        if remaining is not None: remaining -= len(chunk)
+    yield (carry + decoder.decode(b"", final=limit is None)).replace("\r", "\n")
+
+def _render_file(filepath, relative_filepath, encoding, max_file_bytes=None, oversize="skip"):
+    """Runs on a reader thread: sniffs, reads and decodes one file. Returns (section, digest, warning, error). The section
+    is encoded bytes, or a spooled temp file for content; digest is the sha256 of the file, or of the size and the bytes
+    read when only part of it was. Binary files and files skipped for size are never read past their first block."""
+    header = f"## {relative_filepath}\n\n"
+    def note(text): return f"{header}```\n**Note:** {text}\nContent not displayed.\n```\n\n".encode(encoding, errors="replace")
+    digest = hashlib.sha256()
+    section = None
+    try:
+        with open(filepath, "rb") as f_content:
+            size = os.fstat(f_content.fileno()).st_size
+            head = f_content.read(SNIFF_BYTES)
+            file_encoding = _sniff_encoding(head, encoding)
+            oversized = max_file_bytes is not None and size > max_file_bytes
+            if file_encoding is None or (oversized and oversize == "skip"):
+                digest.update(head)
+                if file_encoding is None:
+                    return (note("File appears to be binary or uses an incompatible encoding."), f"{digest.hexdigest()}:{size}",
+                            f"[WARN] Binary or non-{encoding} file skipped content: {relative_filepath}", None)
+                return (note(f"File is larger than the {max_file_bytes} byte limit ({size} bytes)."), f"{digest.hexdigest()}:{size}",
+                        f"[WARN] Oversized file ({size} bytes) skipped content: {relative_filepath}", None)
+            language = guess_language(filepath)
+            if oversized:
+                content = "".join(_decode_chunks(f_content, head[:max_file_bytes], file_encoding, digest, limit=max_file_bytes))
+                if "\n" in content: content = content[:content.rfind("\n") + 1] # End on a whole line
+                marker = TRUNCATED_MARKER.format(size=size, limit=max_file_bytes) + "\n"
+                return (f"{header}```{language}\n{marker}{content}\n```\n\n".encode(encoding, errors="replace"), f"{digest.hexdigest()}:{size}",
+                        f"[WARN] Oversized file ({size} bytes) truncated: {relative_filepath}", None)
+            section = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_BYTES)
+            section.write(f"{header}```{language}\n".encode(encoding, errors="replace"))
+            for text in _decode_chunks(f_content, head, file_encoding, digest):
+                section.write(text.encode(encoding, errors="replace"))
+            section.write("\n```\n\n".encode(encoding))
+            return section, digest.hexdigest(), None, None
+    except UnicodeDecodeError:
+        if section is not None: section.close()
+        return (note("File appears to be binary or uses an incompatible encoding."), f"{digest.hexdigest()}:{size}",
+                f"[WARN] Binary or non-{encoding} file skipped content: {relative_filepath}", None)
+    except Exception as read_err:
+        if section is not None: section.close()
+        return (f"{header}```\n**Error reading file:** {read_err}\n```\n\n".encode(encoding, errors="replace"), None, None,
+                f"Error reading file '{relative_filepath}': {read_err}")
+
+def _write_section(section, outputs):
+    """Writes a rendered section (bytes or spooled file, which is closed) to every output. Returns its length."""
+    if isinstance(section, bytes):
+        for output in outputs: output.write(section)
+        return len(section)
+    length = 0
+    with section:
+        section.seek(0)
+        while chunk := section.read(COPY_CHUNK_BYTES):
+            for output in outputs: output.write(chunk)
+            length += len(chunk)
+    return length
+
+def _compression_for(path, compression=None):
+    """The compression to write path with: the one asked for, else the one its extension implies ('none' for plain)."""
+    if compression: return None if compression == "none" else compression
+    return COMPRESSION_SUFFIXES.get(os.path.splitext(path)[1].lower())
+
+def _open_output(path, compression):
+    """Opens a snapshot for binary writing, through a streaming gzip or zstd compressor if asked."""
+    if compression == "gzip":
+        return gzip.GzipFile(path, "wb", compresslevel=GZIP_LEVEL, mtime=0) # mtime=0 keeps the output reproducible
+    if compression == "zstd":
+        if zstandard is None: raise IOError("zstd output needs the 'zstandard' package (pip install zstandard)")
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(open(path, "wb"), closefd=True)
+    return open(path, "wb")
+
+def _open_snapshot(path):
+    """Opens a snapshot for binary reading, decompressing gzip and zstd snapshots transparently."""
+    with open(path, "rb") as probe: magic = probe.read(len(ZSTD_MAGIC))
+    if magic.startswith(GZIP_MAGIC):
+        return gzip.GzipFile(path, "rb")
+    if magic == ZSTD_MAGIC:
+        if zstandard is None: raise IOError("reading a zstd snapshot needs the 'zstandard' package (pip install zstandard)")
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+    return open(path, "rb")
+
+def _read_manifest(snapshot_file):
+    """Returns (manifest, None) if the manifest next to snapshot_file still describes it, else (None, reason)."""
+    try:
+        with open(snapshot_file + MANIFEST_SUFFIX, "r", encoding="utf-8") as f: manifest = json.load(f)
+        snapshot_stat = os.stat(snapshot_file)
+    except (OSError, ValueError):
+        return None, f"No usable manifest ({snapshot_file}{MANIFEST_SUFFIX})"
+    if manifest.get("version") != MANIFEST_VERSION:
+        return None, "Manifest was written by a different version of this tool"
+    if (manifest.get("snapshot_size"), manifest.get("snapshot_mtime_ns")) != (snapshot_stat.st_size, snapshot_stat.st_mtime_ns):
+        return None, "Snapshot was modified after its manifest was written"
+    return manifest, None
+
+def _load_manifest(output_file, encoding, ignore_patterns, content_settings):
+    """Returns the manifest of the previous snapshot at output_file, or None if there is none it can be trusted for."""
+    manifest, problem = _read_manifest(output_file)
+    if manifest is None:
+        print(f"[INFO] {problem}; reading every file.")
+        return None
+    if (manifest.get("encoding"), manifest.get("ignore"), manifest.get("content")) != (encoding, sorted(ignore_patterns), content_settings):
+        print(f"[INFO] Manifest was written with different settings; reading every file.")
+        return None
+    return manifest
+
+def _write_manifest(output_file, manifest):
+    snapshot_stat = os.stat(output_file)
+    manifest.update(snapshot_size=snapshot_stat.st_size, snapshot_mtime_ns=snapshot_stat.st_mtime_ns)
+    with open(output_file + MANIFEST_SUFFIX + ".tmp", "w", encoding="utf-8") as f: json.dump(manifest, f, separators=(",", ":"))
+    os.replace(output_file + MANIFEST_SUFFIX + ".tmp", output_file + MANIFEST_SUFFIX)
 
-def create_codebase_snapshot(root_dir, output_file, encoding=ENCODING, base_ignore_patterns=DEFAULT_IGNORE_PATTERNS, user_ignore_patterns=[]):
+def _copy_section(src, dst, offset, length):
+    src.seek(offset) # Sections are copied in snapshot order, so compressed snapshots only ever seek forward
+    while length > 0:
+        chunk = src.read(min(length, COPY_CHUNK_BYTES))
+        if not chunk: raise IOError("previous snapshot is shorter than its manifest says")
+        dst.write(chunk); length -= len(chunk)
+
+def create_codebase_snapshot(root_dir, output_file, encoding=ENCODING, base_ignore_patterns=DEFAULT_IGNORE_PATTERNS, user_ignore_patterns=[], jobs=DEFAULT_JOBS, incremental=False, delta_file=None, index=False, max_file_bytes=None, oversize="skip", compression=None):
     processed_files_count = 0
     ignored_items_count = 0
     errors = []
     all_ignore_patterns = list(set(base_ignore_patterns + user_ignore_patterns))
+    matcher = IgnoreMatcher(all_ignore_patterns)
     abs_root = os.path.abspath(root_dir)
     if not os.path.isdir(abs_root):
         print(f"[ERROR] Source directory not found or not a directory: {abs_root}", file=sys.stderr)
         return False, 0, 0, ["Source directory not found."]
 
+    jobs = max(1, jobs)
+    incremental = incremental or delta_file is not None
+    compression = _compression_for(output_file, compression)
     print("-" * 60)
     print(f"Starting snapshot creation (Folder -> Markdown):")
     print(f"  Source: {abs_root}")
     print(f"  Output: {output_file}")
+    if delta_file: print(f"  Delta:  {delta_file}")
     print(f"  Ignoring: {all_ignore_patterns}")
+    print(f"  Reader threads: {jobs}")
+    if max_file_bytes is not None: print(f"  Files over {max_file_bytes} bytes: {oversize}")
+    if compression: print(f"  Compression: {compression}")
     print("-" * 60)
+
+    # Incremental runs copy the section of every file whose size and mtime are unchanged from the
+    # previous snapshot, unless it was modified so close to that run that its mtime cannot be trusted.
+    content_settings = {"max_file_bytes": max_file_bytes, "oversize": oversize}
+    previous = _load_manifest(output_file, encoding, all_ignore_patterns, content_settings) if incremental else None
+    previous_files = previous["files"] if previous else {}
+    trusted_before_ns = previous["started_ns"] - RACY_WINDOW_NS if previous else 0
+    manifest = {"version": MANIFEST_VERSION, "encoding": encoding, "ignore": sorted(all_ignore_patterns), "content": content_settings, "started_ns": time.time_ns(), "files": {}}
+    changes = {"added": 0, "changed": 0, "unchanged": 0, "deleted": 0}
+    temp_output = output_file + ".tmp"
+    exclude = {os.path.abspath(path) for path in (output_file, temp_output, output_file + MANIFEST_SUFFIX, output_file + MANIFEST_SUFFIX + ".tmp", delta_file) if path}
+
+    # Files are read concurrently but written in walk order: pending holds their futures in that
+    # order, and the oldest is written as soon as it is done (a reorder buffer). Offsets in the
+    # manifest count uncompressed bytes.
+    pending = deque()
+    position = 0
+    def write_oldest(md_file, previous_snapshot, delta):
+        nonlocal position
+        relative_filepath, file_stat, future, reused = pending.popleft()
+        if reused:
+            _copy_section(previous_snapshot, md_file, reused["offset"], reused["length"])
+            digest, length = reused["sha256"], reused["length"]
+            changes["unchanged"] += 1
+        else:
+            print(f"[PROCESS] Adding: {relative_filepath}")
+            try:
+                section, digest, warning, error = future.result()
+            except Exception as e:
+                section = f"## {relative_filepath}\n\n```\n**Error processing file:** {e}\n```\n\n".encode(encoding, errors="replace")
+                digest, warning, error = None, None, f"Error processing file '{relative_filepath}': {e}"
+            old_entry = previous_files.get(relative_filepath)
+            kind = "added" if old_entry is None else "unchanged" if digest and old_entry["sha256"] == digest else "changed"
+            changes[kind] += 1
+            length = _write_section(section, (md_file, delta) if delta and kind != "unchanged" else (md_file,))
+            if warning: print(warning)
+            if error:
+                errors.append(error); print(f"[ERROR] {error}")
+        manifest["files"][relative_filepath] = {
+            "size": file_stat.st_size if file_stat else None, "mtime_ns": file_stat.st_mtime_ns if file_stat else None,
+            "sha256": digest, "offset": position, "length": length
+        }
+        position += length
+
     try:
-        with open(output_file, "w", encoding=encoding) as md_file:
-            md_file.write("# Codebase Snapshot\n\n")
-            md_file.write(f"Source Directory: `{os.path.basename(abs_root)}`\n\n")
-            for dirpath, dirnames, filenames in os.walk(abs_root, topdown=True):
-                dirs_to_remove = set()
-                for d in dirnames:
-                    rel_dir_path = os.path.relpath(os.path.join(dirpath, d), abs_root)
-                    if is_ignored(rel_dir_path, all_ignore_patterns): dirs_to_remove.add(d)
-                if dirs_to_remove:
-                    ignored_items_count += len(dirs_to_remove)
-                    dirnames[:] = [d for d in dirnames if d not in dirs_to_remove]
-                filenames.sort()
-                for filename in filenames:
-                    filepath = os.path.join(dirpath, filename)
-                    relative_filepath = os.path.relpath(filepath, abs_root).replace("\\", "/")
-                    if is_ignored(relative_filepath, all_ignore_patterns):
-                        ignored_items_count += 1; continue
-                    processed_files_count += 1
-                    print(f"[PROCESS] Adding: {relative_filepath}")
-                    md_file.write(f"## {relative_filepath}\n\n")
-                    try:
-                        try:
-                             with open(filepath, "r", encoding=encoding) as f_content: content = f_content.read()
-                             language = guess_language(filepath)
-                             md_file.write(f"```{language}\n{content}\n```\n\n")
-                        except UnicodeDecodeError:
-                             md_file.write("```\n**Note:** File appears to be binary or uses an incompatible encoding.\nContent not displayed.\n```\n\n")
-                             print(f"[WARN] Binary or non-{encoding} file skipped content: {relative_filepath}")
-                        except Exception as read_err:
-                             errors.append(f"Error reading file '{relative_filepath}': {read_err}")
-                             md_file.write(f"```\n**Error reading file:** {read_err}\n```\n\n")
-                             print(f"[ERROR] Could not read file: {relative_filepath} - {read_err}")
-                    except Exception as e:
-                        errors.append(f"Error processing file '{relative_filepath}': {e}")
-                        md_file.write(f"```\n**Error processing file:** {e}\n```\n\n")
-                        print(f"[ERROR] Processing failed for: {relative_filepath} - {e}")
+        with _open_output(temp_output, compression) as md_file, \
+                (_open_snapshot(output_file) if previous else contextlib.nullcontext()) as previous_snapshot, \
+                (_open_output(delta_file, _compression_for(delta_file)) if delta_file else contextlib.nullcontext()) as delta, \
+                ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="snapshot") as pool:
+            header = f"Source Directory: `{os.path.basename(abs_root)}`\n\n".encode(encoding)
+            md_file.write(b"# Codebase Snapshot\n\n" + header); position = len(b"# Codebase Snapshot\n\n" + header)
+            if delta: delta.write(f"{DELTA_HEADING}\n\n".encode(encoding) + header)
+            for filepath, relative_filepath in _walk_files(abs_root, matcher, exclude):
+                if relative_filepath is None:
+                    ignored_items_count += 1; continue
+                processed_files_count += 1
+                try: file_stat = os.stat(filepath)
+                except OSError: file_stat = None
+                old_entry = previous_files.get(relative_filepath)
+                if old_entry and file_stat and old_entry["sha256"] and old_entry["mtime_ns"] < trusted_before_ns \
+                        and (old_entry["size"], old_entry["mtime_ns"]) == (file_stat.st_size, file_stat.st_mtime_ns):
+                    pending.append((relative_filepath, file_stat, None, old_entry))
+                else:
+                    pending.append((relative_filepath, file_stat, pool.submit(_render_file, filepath, relative_filepath, encoding, max_file_bytes, oversize), None))
+                while pending and (pending[0][3] or pending[0][2].done() or len(pending) >= jobs * READ_AHEAD_PER_JOB):
+                    write_oldest(md_file, previous_snapshot, delta)
+            while pending: write_oldest(md_file, previous_snapshot, delta)
+            for relative_filepath in previous_files.keys() - manifest["files"].keys():
+                changes["deleted"] += 1
+                print(f"[PROCESS] Deleted: {relative_filepath}")
+                if delta: delta.write(f"## {relative_filepath}\n\n```\n**Deleted:** File removed since the previous snapshot.\n```\n\n".encode(encoding, errors="replace"))
+        os.replace(temp_output, output_file)
+        if incremental or index: _write_manifest(output_file, manifest)
     except IOError as e:
+        with contextlib.suppress(OSError): os.remove(temp_output)
         print(f"[ERROR] Failed to write snapshot file '{output_file}': {e}", file=sys.stderr)
         return False, processed_files_count, ignored_items_count, [f"IOError writing snapshot: {e}"]
     except Exception as e:
+        with contextlib.suppress(OSError): os.remove(temp_output)
         print(f"[ERROR] An unexpected error occurred during snapshot generation: {e}", file=sys.stderr)
         return False, processed_files_count, ignored_items_count, [f"Unexpected error: {e}"]
     print("-" * 60)
     print(f"Snapshot creation finished.")
     print(f"  Processed: {processed_files_count} files")
     print(f"  Ignored:   {ignored_items_count} items")
+    if incremental: print(f"  Changes:   {changes['added']} added, {changes['changed']} changed, {changes['deleted']} deleted, {changes['unchanged']} unchanged")
     if errors: print(f"  Errors:    {len(errors)}"); [print(f"    - {err}") for err in errors]
     print("-" * 60)
     return True, processed_files_count, ignored_items_count, errors
 
-def extract_codebase(md_file, output_dir, encoding=ENCODING):
-    created_files_count = 0; errors = []; file_write_attempts = 0
+def _snapshot_lines(md_file, encoding, sections=None):
+    """Yields the snapshot's lines, or only those of the (offset, length) byte ranges in sections, read one at a time."""
+    if sections is None:
+        with _open_snapshot(md_file) as raw: yield from io.TextIOWrapper(raw, encoding=encoding) # Same newline handling as text mode
+        return
+    with _open_snapshot(md_file) as f: # Sections are in snapshot order: compressed snapshots only seek forward
+        for offset, length in sections:
+            f.seek(offset)
+            yield from io.StringIO(f.read(length).decode(encoding), newline=None) # Same newline handling as text mode
+
+def extract_codebase(md_file, output_dir, encoding=ENCODING, jobs=DEFAULT_JOBS, sections=None):
+    created_files_count = 0; errors = []; file_write_attempts = 0; deleted_files_count = 0
     abs_output_dir = os.path.abspath(output_dir)
     if not os.path.isfile(md_file):
         print(f"[ERROR] Snapshot file not found: {md_file}", file=sys.stderr)
@@ -189,62 +531,142 @@ def extract_codebase(md_file, output_dir, encoding=ENCODING):
     try:
         os.makedirs(abs_output_dir, exist_ok=True); print(f"[INFO] Ensured output directory exists: {abs_output_dir}")
     except OSError as e: print(f"[ERROR] Failed to create output directory '{abs_output_dir}': {e}", file=sys.stderr); return False, 0, [f"Failed to create output directory: {e}"]
-    try:
-        with open(md_file, "r", encoding=encoding) as f: lines = f.readlines()
-    except Exception as e: print(f"[ERROR] Failed to read snapshot file '{md_file}': {e}", file=sys.stderr); return False, 0, [f"Failed to read snapshot file: {e}"]
-    relative_filepath = None; in_code_block = False; code_lines = []; skip_block_content = False
-    for line_num, line in enumerate(lines, 1):
-        line_stripped = line.strip()
-        if line_stripped.startswith("## "):
-            if relative_filepath and code_lines and not skip_block_content:
-                file_write_attempts += 1
-                if write_code_to_file(abs_output_dir, relative_filepath, code_lines, encoding): created_files_count += 1
-                else: errors.append(f"Failed write: {relative_filepath} (ended near line {line_num})")
-            code_lines = []; relative_filepath = None; in_code_block = False; skip_block_content = False
-            new_relative_filepath = line[3:].strip().strip('/').strip('\\')
-            if not new_relative_filepath: errors.append(f"Warning: Found '##' header without a filepath on line {line_num}. Skipping.")
-            else: relative_filepath = new_relative_filepath
-        elif line_stripped.startswith("```"):
-            if in_code_block:
-                in_code_block = False
-                if relative_filepath and code_lines and not skip_block_content:
-                     file_write_attempts += 1
-                     if write_code_to_file(abs_output_dir, relative_filepath, code_lines, encoding): created_files_count += 1
-                     else: errors.append(f"Failed write: {relative_filepath} (block ended line {line_num})")
-                elif skip_block_content: pass
-                elif relative_filepath and not code_lines:
-                    file_write_attempts += 1; print(f"[WARN] Empty code block for {relative_filepath} on line {line_num}. Creating empty file.")
-                    if write_code_to_file(abs_output_dir, relative_filepath, [], encoding): created_files_count += 1
-                    else: errors.append(f"Failed write (empty): {relative_filepath}")
-                elif not relative_filepath and code_lines: errors.append(f"Warning: Code block found ending on line {line_num} without a preceding '## filepath' header. Content ignored.")
-                code_lines = []; skip_block_content = False
-            else: in_code_block = True; code_lines = []; skip_block_content = False
-        elif in_code_block:
-            if line_stripped.startswith("**Note:") or line_stripped.startswith("**Error reading file:") or line_stripped.startswith("**Binary File:"):
-                 skip_block_content = True; print(f"[INFO] Skipping content block for {relative_filepath} due to marker: {line_stripped[:30]}...")
-            if not skip_block_content: code_lines.append(line)
-    if relative_filepath and code_lines and not skip_block_content:
+
+    # The snapshot is parsed line by line. Finished blocks are written by a pool of at most
+    # WRITE_BEHIND_FILES queued files (oldest awaited first); big blocks stream to disk as they are read.
+    pending = deque() # (future, full_path, failure message)
+    in_flight = {} # full_path -> future of its latest queued write, so rewrites land in order
+    def settle_oldest():
+        nonlocal created_files_count
+        future, full_path, failure = pending.popleft()
+        if future.result(): created_files_count += 1
+        else: errors.append(failure)
+        if in_flight.get(full_path) is future: del in_flight[full_path]
+    def finish_block(writer, failure):
+        nonlocal file_write_attempts, created_files_count
         file_write_attempts += 1
-        if write_code_to_file(abs_output_dir, relative_filepath, code_lines, encoding): created_files_count += 1
-        else: errors.append(f"Failed write (end of file): {relative_filepath}")
-    elif relative_filepath and skip_block_content: pass
+        if writer.full_path is None:
+            errors.append(failure); return
+        if writer.full_path in in_flight: in_flight[writer.full_path].result()
+        if writer.spill is not None:
+            if writer.commit(): created_files_count += 1
+            else: errors.append(failure)
+            return
+        while len(pending) >= WRITE_BEHIND_FILES or (pending and pending[0][0].done()): settle_oldest()
+        future = pool.submit(_write_lines, writer.full_path, writer.lines, encoding)
+        in_flight[writer.full_path] = future
+        pending.append((future, writer.full_path, failure))
+    def remove_file(line_num):
+        # Delta snapshots (fm --delta) mark files removed since the previous snapshot
+        nonlocal deleted_files_count
+        full_path = _safe_output_path(abs_output_dir, relative_filepath)
+        if full_path is None:
+            errors.append(f"Failed delete: {relative_filepath} (line {line_num})"); return
+        if full_path in in_flight: in_flight[full_path].result()
+        try:
+            if os.path.isfile(full_path):
+                os.remove(full_path); deleted_files_count += 1; print(f"[DELETE] Removed: {relative_filepath}")
+        except OSError as e:
+            errors.append(f"Failed delete: {relative_filepath}: {e}")
+    def start_block():
+        return _BlockWriter(_safe_output_path(abs_output_dir, relative_filepath) if relative_filepath else None, encoding)
+
+    relative_filepath = None; in_code_block = False; writer = _BlockWriter(None, encoding); skip_block_content = False; is_delta = False
+    pool = ThreadPoolExecutor(max_workers=max(1, jobs), thread_name_prefix="snapshot-write")
+    try:
+        with contextlib.closing(_snapshot_lines(md_file, encoding, sections)) as f:
+            for line_num, line in enumerate(f, 1):
+                line_stripped = line.strip()
+                if line_num == 1: is_delta = line_stripped == DELTA_HEADING # Only fm --delta output removes files
+                if line_stripped.startswith("## "):
+                    if relative_filepath and writer.has_content and not skip_block_content:
+                        finish_block(writer, f"Failed write: {relative_filepath} (ended near line {line_num})")
+                    else: writer.discard()
+                    relative_filepath = None; in_code_block = False; skip_block_content = False
+                    new_relative_filepath = line[3:].strip().strip('/').strip('\\')
+                    if not new_relative_filepath: errors.append(f"Warning: Found '##' header without a filepath on line {line_num}. Skipping.")
+                    else: relative_filepath = new_relative_filepath
+                    writer = _BlockWriter(None, encoding)
+                elif line_stripped.startswith("```"):
+                    if in_code_block:
+                        in_code_block = False
+                        if relative_filepath and writer.has_content and not skip_block_content:
+                            finish_block(writer, f"Failed write: {relative_filepath} (block ended line {line_num})")
+                        elif skip_block_content: pass
+                        elif relative_filepath and not writer.has_content:
+                            print(f"[WARN] Empty code block for {relative_filepath} on line {line_num}. Creating empty file.")
+                            finish_block(writer, f"Failed write (empty): {relative_filepath}")
+                        elif not relative_filepath and writer.has_content: errors.append(f"Warning: Code block found ending on line {line_num} without a preceding '## filepath' header. Content ignored.")
+                        writer = _BlockWriter(None, encoding); skip_block_content = False
+                    else:
+                        writer.discard(); in_code_block = True; writer = start_block(); skip_block_content = False
+                elif in_code_block:
+                    if is_delta and line_stripped.startswith("**Deleted:") and relative_filepath and not writer.has_content and not skip_block_content:
+                        skip_block_content = True; writer.discard(); remove_file(line_num)
+                    elif line_stripped.startswith("**Note:") or line_stripped.startswith("**Error reading file:") or line_stripped.startswith("**Binary File:"):
+                        skip_block_content = True; writer.discard(); print(f"[INFO] Skipping content block for {relative_filepath} due to marker: {line_stripped[:30]}...")
+                    elif relative_filepath and not writer.has_content and not skip_block_content and TRUNCATED_MARKER_RE.fullmatch(line.rstrip("\r\n")):
+                        # fm --max-file-size --oversize truncate: the block holds only the start of the file
+                        errors.append(f"Warning: {relative_filepath} was truncated in the snapshot; only its start was recreated (line {line_num})."); continue
+                    if not skip_block_content: writer.add(line)
+        if relative_filepath and writer.has_content and not skip_block_content:
+            finish_block(writer, f"Failed write (end of file): {relative_filepath}")
+        while pending: settle_oldest()
+    except (OSError, UnicodeDecodeError) as e:
+        print(f"[ERROR] Failed to read snapshot file '{md_file}': {e}", file=sys.stderr); return False, created_files_count, [f"Failed to read snapshot file: {e}"]
+    finally:
+        writer.discard()
+        pool.shutdown(wait=True)
     print("-" * 60); print(f"Codebase extraction finished."); print(f"  Attempted writes: {file_write_attempts}"); print(f"  Successfully created: {created_files_count} files")
+    if deleted_files_count: print(f"  Deleted: {deleted_files_count} files")
     if errors: print(f"  Errors/Warnings: {len(errors)}"); [print(f"    - {err}") for err in errors]
     print("-" * 60)
     return True, created_files_count, errors
 
 
+def _select_entries(manifest, patterns):
+    """Index entries matching any pattern: an exact path, a folder (every file under it), or a glob matched
+    like --ignore patterns (against the basename or the whole path). Returns [(path, entry)] in snapshot order."""
+    matcher = IgnoreMatcher(patterns)
+    folders = tuple(pattern.strip("/") + "/" for pattern in patterns)
+    selected = [(path, entry) for path, entry in manifest["files"].items() if path in patterns or path.startswith(folders) or matcher(path)]
+    return sorted(selected, key=lambda item: item[1]["offset"])
+
+def list_snapshot(md_file, patterns=()):
+    manifest, problem = _read_manifest(md_file)
+    if manifest is None:
+        print(f"[ERROR] {problem}. Rewrite the snapshot with 'fm --index' to list it.", file=sys.stderr)
+        return False, []
+    entries = _select_entries(manifest, patterns) if patterns else sorted(manifest["files"].items(), key=lambda item: item[1]["offset"])
+    for path, entry in entries:
+        print(f"{entry['size'] if entry['size'] is not None else '-':>12}  {path}")
+    return True, entries
+
+def extract_selected(md_file, output_dir, patterns, jobs=DEFAULT_JOBS):
+    """Extracts the files matching patterns, reading only their sections of the snapshot via its index."""
+    manifest, problem = _read_manifest(md_file)
+    if manifest is None:
+        print(f"[ERROR] {problem}. Rewrite the snapshot with 'fm --index', or use mf to extract everything.", file=sys.stderr)
+        return False, 0, [problem]
+    entries = _select_entries(manifest, patterns)
+    print(f"[INFO] Selected {len(entries)} of {len(manifest['files'])} files.")
+    if not entries:
+        return False, 0, ["No files in the snapshot match the given paths."]
+    sections = [(entry["offset"], entry["length"]) for _, entry in entries]
+    return extract_codebase(md_file, output_dir, encoding=manifest["encoding"], jobs=jobs, sections=sections)
+
+
 # --- Command Line Interface (Modified for Positional Args) ---
 def main():
     parser = argparse.ArgumentParser(
-        description="Standalone Codebase Snapshot Tool. Use 'fm <folder>' or 'mf <markdown_file>'.",
+        description="Standalone Codebase Snapshot Tool. Use 'fm <folder>', 'mf <markdown_file>', 'ls <markdown_file>' or 'get <markdown_file> <path>...'.",
         formatter_class=argparse.RawDescriptionHelpFormatter,
         epilog="""Examples:
   python %(prog)s fm ./my_project -o project_snapshot.md
   python %(prog)s mf project_snapshot.md -o ./recreated_project"""
     )
 
-    subparsers = parser.add_subparsers(dest='command', required=True, help='Available commands: fm, mf')
+    subparsers = parser.add_subparsers(dest='command', required=True, help='Available commands: fm, mf, ls, get')
 
     # --- Sub-parser for fm (Folder to Markdown) ---
     parser_fm = subparsers.add_parser('fm', help='Create Markdown from Folder.')
@@ -254,6 +676,13 @@ def main():
     parser_fm.add_argument('--output', '-o', required=True, dest='output_markdown', help='Path for the output Markdown snapshot file.')
     # Optional ignore patterns (remains the same)
     parser_fm.add_argument('--ignore', action='append', default=[], help='Additional ignore patterns (glob style). Can be used multiple times.')
+    parser_fm.add_argument('--index', action='store_true', help=f'Write an index of each file\'s byte range next to the output ({MANIFEST_SUFFIX}) for ls and get. Implied by --incremental.')
+    parser_fm.add_argument('--incremental', action='store_true', help=f'Only re-read files changed since the last run, using the manifest kept next to the output ({MANIFEST_SUFFIX}).')
+    parser_fm.add_argument('--delta', dest='delta_markdown', help='Also write a Markdown file with only the added, changed and deleted files (implies --incremental). Apply it with mf.')
+    parser_fm.add_argument('--jobs', '-j', type=int, default=DEFAULT_JOBS, help=f'Threads reading files in parallel (default: {DEFAULT_JOBS}).')
+    parser_fm.add_argument('--max-file-size', type=int, default=None, dest='max_file_bytes', help='Files larger than this many bytes are skipped or truncated (see --oversize). Default: no limit.')
+    parser_fm.add_argument('--oversize', choices=OVERSIZE_MODES, default='skip', help='What to do with files over --max-file-size: leave a note (skip) or keep their start (truncate).')
+    parser_fm.add_argument('--compress', choices=('none', 'gzip', 'zstd'), default=None, help='Compress the snapshot while writing it. Default: from the output extension (.gz, .zst). mf, ls and get read compressed snapshots transparently.')
 
     # --- Sub-parser for mf (Markdown to Folder) ---
     parser_mf = subparsers.add_parser('mf', help='Create Folder from Markdown.')
@@ -261,6 +690,19 @@ def main():
     parser_mf.add_argument('input_markdown', help='Path to the input Markdown snapshot file.')
     # Optional argument for output directory
     parser_mf.add_argument('--output', '-o', required=True, dest='output_directory', help='Path to the directory where the codebase will be recreated.')
+    parser_mf.add_argument('--jobs', '-j', type=int, default=DEFAULT_JOBS, help=f'Threads writing files in parallel (default: {DEFAULT_JOBS}).')
+
+    # --- Sub-parser for ls (List an indexed snapshot) ---
+    parser_ls = subparsers.add_parser('ls', help='List the files in a snapshot written with --index.')
+    parser_ls.add_argument('input_markdown', help='Path to the Markdown snapshot file.')
+    parser_ls.add_argument('patterns', nargs='*', help='Only list these paths, folders or globs (glob style, as for --ignore).')
+
+    # --- Sub-parser for get (Extract selected files from an indexed snapshot) ---
+    parser_get = subparsers.add_parser('get', help='Extract selected files from a snapshot written with --index.')
+    parser_get.add_argument('input_markdown', help='Path to the Markdown snapshot file.')
+    parser_get.add_argument('patterns', nargs='+', help='Paths, folders or globs to extract (glob style, as for --ignore).')
+    parser_get.add_argument('--output', '-o', required=True, dest='output_directory', help='Directory the selected files are written to.')
+    parser_get.add_argument('--jobs', '-j', type=int, default=DEFAULT_JOBS, help=f'Threads writing files in parallel (default: {DEFAULT_JOBS}).')
 
     args = parser.parse_args()
 
@@ -272,7 +714,14 @@ def main():
             output_file=args.output_markdown,    # Use '-o' arg (renamed via dest)
             encoding=ENCODING,
             base_ignore_patterns=DEFAULT_IGNORE_PATTERNS,
-            user_ignore_patterns=args.ignore
+            user_ignore_patterns=args.ignore,
+            jobs=args.jobs,
+            incremental=args.incremental,
+            delta_file=args.delta_markdown,
+            index=args.index,
+            max_file_bytes=args.max_file_bytes,
+            oversize=args.oversize,
+            compression=args.compress
         )
         if success:
             print(f"\nSuccess! Snapshot created at: {args.output_markdown}")
@@ -288,7 +737,8 @@ def main():
         success, created_count, errors = extract_codebase(
             md_file=args.input_markdown,       # Use positional arg
             output_dir=args.output_directory,  # Use '-o' arg (renamed via dest)
-            encoding=ENCODING
+            encoding=ENCODING,
+            jobs=args.jobs
         )
         if success:
              print(f"\nSuccess! Codebase extracted to: {args.output_directory}")
@@ -299,6 +749,21 @@ def main():
             print(f"\nFailed to extract codebase.", file=sys.stderr)
             sys.exit(1)
 
+    elif args.command == 'ls':
+        success, _ = list_snapshot(args.input_markdown, args.patterns)
+        sys.exit(0 if success else 1)
+
+    elif args.command == 'get':
+        print(f"Running: Extract selected files (get)")
+        success, created_count, errors = extract_selected(args.input_markdown, args.output_directory, args.patterns, jobs=args.jobs)
+        if success:
+            print(f"\nSuccess! Extracted {created_count} files to: {args.output_directory}")
+            if errors: print(f"Completed with {len(errors)} errors/warnings during file writing.")
+            sys.exit(0)
+        else:
+            print(f"\nFailed to extract files.", file=sys.stderr)
+            sys.exit(1)
+
 # --- Main Execution Guard ---
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Start-up benchmark: how long a fresh process takes to import the app, and how
+long a served instance takes to answer its first request and to become ready
+(GET /ready returns 200 once the Gemini SDK is warm). Runs against this checkout.
+
+    python startup_benchmark.py --runs 5
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+IMPORT_SNIPPET = "import time; started = time.perf_counter(); import main; print(time.perf_counter() - started)"
+READY_TIMEOUT_SECONDS = 60
+
+
+def _environment() -> dict:
+    # A placeholder key is enough: nothing here calls the API
+    env = {**os.environ, "FILE_RECONCILE_ON_STARTUP": "0", "LOG_LEVEL": "WARNING"}
+    env.setdefault("GEMINI_API_KEY", "startup-benchmark")
+    return env
+
+
+def measure_import(python: str) -> float:
+    """ Seconds a fresh interpreter spends importing main. """
+    output = subprocess.run([python, "-c", IMPORT_SNIPPET], env=_environment(), check=True,
+                            capture_output=True, text=True).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def _free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def _get_status(url: str) -> int:
+    try:
+        with urllib.request.urlopen(url, timeout=1) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def measure_serve(python: str) -> tuple:
+    """ Seconds from process start to the first answered request, and to GET /ready returning 200. """
+    port = _free_port()
+    url = f"http://127.0.0.1:{port}/ready"
+    started = time.perf_counter()
+    server = subprocess.Popen([python, "serve.py", "--workers", "1", "--host", "127.0.0.1", "--port", str(port)],
+                              env=_environment(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    first_response = None
+    try:
+        while time.perf_counter() - started < READY_TIMEOUT_SECONDS:
+            try:
+                status = _get_status(url)
+            except OSError:
+                time.sleep(0.01) # Not listening yet
+                continue
+            first_response = first_response or time.perf_counter() - started
+            if status == 200:
+                return first_response, time.perf_counter() - started
+            time.sleep(0.01)
+        raise TimeoutError(f"Server was not ready within {READY_TIMEOUT_SECONDS}s.")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def _summary(samples: list) -> str:
+    return f"median {statistics.median(samples):.3f}s  min {min(samples):.3f}s  max {max(samples):.3f}s"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure LessonGenie start-up time.")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--python", default=sys.executable, help="Interpreter to measure with.")
+    parser.add_argument("--import-only", action="store_true", help="Skip the served-instance measurement.")
+    args = parser.parse_args()
+
+    imports = [measure_import(args.python) for _ in range(args.runs)]
+    print(f"import main:     {_summary(imports)}")
+    if args.import_only:
+        return
+    served = [measure_serve(args.python) for _ in range(args.runs)]
+    print(f"first response:  {_summary([first for first, _ in served])}")
+    print(f"ready (warm):    {_summary([ready for _, ready in served])}")
+
+
+if __name__ == "__main__":
+    main()
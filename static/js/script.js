@@ -35,6 +35,7 @@ const backToUploadButton = document.getElementById('back-to-upload-button');
 
 // Global state
 let currentPdfFileId = null;
+let currentPaperHash = null; // Addresses the paper's cacheable GET resources
 let currentExtractedQuestions = [];
 
 // --- Event Listeners ---
@@ -134,21 +135,40 @@ async function handleExtractQuestionsSubmit(event) {
     formData.append('pdf_file', pdfFile);
 
     try {
-        const response = await fetch('/extract-questions', { method: 'POST', body: formData });
-        const result = await response.json();
-        if (!response.ok) throw new Error(result.detail || `HTTP error! Status: ${response.status}`);
-        if (!result.pdfFileId || !result.questions) throw new Error("Invalid data received.");
+        let streamedCount = 0;
+        let result = null;
+        // Questions are streamed one by one; the 'done' event carries the validated list
+        await streamEvents('/extract-questions/stream', { method: 'POST', body: formData }, (eventName, data) => {
+            if (eventName === 'question') {
+                if (streamedCount === 0) {
+                    hideQuestionListSkeleton();
+                    if (extractedQuestionsListEl) {
+                        extractedQuestionsListEl.innerHTML = '';
+                        extractedQuestionsListEl.classList.remove('hidden');
+                    }
+                }
+                const li = appendQuestionItem(data, streamedCount++);
+                if (li) li.style.pointerEvents = 'none'; // Clickable once 'done' delivers the PDF file ID
+            } else if (eventName === 'done') {
+                result = data;
+            } else if (eventName === 'error') {
+                throw new Error(data.detail || 'Extraction failed.');
+            }
+        });
+        if (!result || !result.pdfFileId || !result.questions) throw new Error("Invalid data received.");
 
         console.log("Extracted questions data:", result);
         currentPdfFileId = result.pdfFileId;
+        currentPaperHash = result.paperHash || null;
         currentExtractedQuestions = result.questions;
         hideQuestionListSkeleton(); // Hide skeleton
-        displayQuestionList(result.questions); // Display actual list
+        displayQuestionList(result.questions); // Display the final, validated list
         // No need to call showQuestionList() again, it's already visible
 
     } catch (error) {
         console.error('Error extracting questions:', error);
         hideQuestionListSkeleton(); // Hide skeleton on error
+        if (extractedQuestionsListEl) extractedQuestionsListEl.innerHTML = ''; // Drop partially streamed items
         showError(`Extraction failed: ${error.message}`, "question-list"); // Show error in question list area
     } finally {
         // Button might not be visible anymore, but doesn't hurt to reset
@@ -172,9 +192,20 @@ async function handleQuestionSelection(event) {
     showSkeletonLoader(); // Show lesson skeleton immediately
     hideError("lesson");  // Hide previous lesson errors
 
+    // Lessons generated before are plain GET resources, usually answered by the browser cache
+    const cachedLesson = await fetchCachedLesson(selectedQuestionId);
+    if (cachedLesson) {
+        console.log("Showing previously generated lesson:", cachedLesson);
+        displayLesson(cachedLesson);
+        showActualLessonContent();
+        return;
+    }
 
     try {
-        const response = await fetch('/generate-specific-lesson', {
+        let streamedStepCount = 0;
+        let result = null;
+        // The core concept and each step are streamed as they are generated; 'done' carries the validated lesson
+        await streamEvents('/generate-specific-lesson/stream', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
             body: JSON.stringify({
@@ -182,12 +213,25 @@ async function handleQuestionSelection(event) {
                 selectedQuestionId: selectedQuestionId,
                 selectedQuestionText: selectedQuestionText
             }),
+        }, (eventName, data) => {
+            if (eventName === 'concept') {
+                if (lessonConceptEl) lessonConceptEl.innerHTML = data;
+                if (lessonStepsTimelineEl) lessonStepsTimelineEl.innerHTML = '';
+                hideSkeletonLoader();
+                if (lessonContentArea) lessonContentArea.classList.remove('hidden');
+            } else if (eventName === 'step') {
+                const stepElement = createTimelineStepElement(data.stepNumber, data.title, data.descriptionHtml, 0);
+                if (lessonStepsTimelineEl) lessonStepsTimelineEl.appendChild(stepElement);
+                streamedStepCount++;
+            } else if (eventName === 'done') {
+                result = data;
+            } else if (eventName === 'error') {
+                throw new Error(data.detail || 'Lesson generation failed.');
+            }
         });
+        if (!result) throw new Error("Invalid data received.");
 
-        const result = await response.json();
-        if (!response.ok) throw new Error(result.detail || `HTTP error! Status: ${response.status}`);
-
-        console.log("Received specific lesson data:", result);
+        console.log(`Received specific lesson data (${streamedStepCount} steps streamed):`, result);
         displayLesson(result);
         showActualLessonContent(); // Hide skeleton, show content
 
@@ -199,6 +243,49 @@ async function handleQuestionSelection(event) {
     }
 }
 
+// Returns the already generated lesson for a question of the current paper, or null.
+async function fetchCachedLesson(questionId) {
+    if (!currentPaperHash) return null;
+    try {
+        const response = await fetch(`/papers/${currentPaperHash}/lessons/${encodeURIComponent(questionId)}`);
+        return response.ok ? await response.json() : null;
+    } catch (error) {
+        return null; // Fall back to generating it
+    }
+}
+
+// --- Streaming Helper ---
+
+// POSTs to a Server-Sent Events endpoint and calls onEvent(eventName, parsedData) per event.
+// Non-2xx responses are plain JSON errors and are thrown.
+async function streamEvents(url, options, onEvent) {
+    const response = await fetch(url, options);
+    if (!response.ok) {
+        const result = await response.json().catch(() => ({}));
+        throw new Error(result.detail || `HTTP error! Status: ${response.status}`);
+    }
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const rawEvent = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+            let eventName = 'message';
+            let data = '';
+            rawEvent.split('\n').forEach(line => {
+                if (line.startsWith('event: ')) eventName = line.slice(7);
+                else if (line.startsWith('data: ')) data += line.slice(6);
+            });
+            if (data) onEvent(eventName, JSON.parse(data));
+        }
+    }
+}
+
 // --- Display & Skeleton Functions ---
 
 function displayQuestionList(questions) {
@@ -211,23 +298,27 @@ function displayQuestionList(questions) {
         return;
     }
 
-    questions.forEach((q, index) => {
-        const li = document.createElement('li');
-        const qId = q.questionId || `item-${index}`;
-        const qText = q.questionText || "Question text missing";
-        li.className = 'border border-gray-200 p-4 rounded-md hover:bg-indigo-50 cursor-pointer transition duration-150 flex justify-between items-center';
-        li.innerHTML = `
-            <div class="flex-grow mr-4 overflow-hidden">
-                <span class="font-semibold text-indigo-700 block text-sm truncate">Detected Question (ID: ${qId})</span>
-                <span class="text-gray-800 block mt-1 text-sm">${qText.substring(0, 120)}...</span>
-            </div>
-            <svg class="w-6 h-6 text-indigo-500 flex-shrink-0" xmlns="http://www.w3.org/2000/svg" fill="none" viewBox="0 0 24 24" stroke-width="2" stroke="currentColor"><path stroke-linecap="round" stroke-linejoin="round" d="M13 7l5 5m0 0l-5 5m5-5H6" /></svg>
-        `;
-        li.dataset.questionId = qId;
-        li.dataset.questionText = qText;
-        li.addEventListener('click', handleQuestionSelection);
-        extractedQuestionsListEl.appendChild(li);
-    });
+    questions.forEach((q, index) => appendQuestionItem(q, index));
+}
+
+function appendQuestionItem(q, index) {
+    if (!extractedQuestionsListEl) return;
+    const li = document.createElement('li');
+    const qId = q.questionId || `item-${index}`;
+    const qText = q.questionText || "Question text missing";
+    li.className = 'border border-gray-200 p-4 rounded-md hover:bg-indigo-50 cursor-pointer transition duration-150 flex justify-between items-center';
+    li.innerHTML = `
+        <div class="flex-grow mr-4 overflow-hidden">
+            <span class="font-semibold text-indigo-700 block text-sm truncate">Detected Question (ID: ${qId})</span>
+            <span class="text-gray-800 block mt-1 text-sm">${qText.substring(0, 120)}...</span>
+        </div>
+        <svg class="w-6 h-6 text-indigo-500 flex-shrink-0" xmlns="http://www.w3.org/2000/svg" fill="none" viewBox="0 0 24 24" stroke-width="2" stroke="currentColor"><path stroke-linecap="round" stroke-linejoin="round" d="M13 7l5 5m0 0l-5 5m5-5H6" /></svg>
+    `;
+    li.dataset.questionId = qId;
+    li.dataset.questionText = qText;
+    li.addEventListener('click', handleQuestionSelection);
+    extractedQuestionsListEl.appendChild(li);
+    return li;
 }
 
 function showQuestionListSkeleton() {
@@ -397,6 +488,7 @@ function resetUI() {
     if (selectedFileNameEl) selectedFileNameEl.textContent = '';
     showUploadForm();
     currentPdfFileId = null;
+    currentPaperHash = null;
     currentExtractedQuestions = [];
     // Reset button text to initial state
     setLoadingState(false, 'Extract Questions');
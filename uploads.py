@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming ingestion of uploaded PDFs: the upload is copied to disk in fixed-size
+chunks while its SHA-256 digest and PDF signature are checked, so memory per
+upload stays constant regardless of file size. Oversized request bodies are
+refused as they arrive, before the multipart parser has spooled them.
+"""
+import hashlib
+import os
+from typing import Optional, Tuple
+
+import aiofiles
+from fastapi import HTTPException, UploadFile
+
+# --- Configuration ---
+UPLOAD_CHUNK_SIZE = 1024 * 1024 # 1 MiB per read/write
+MAX_UPLOAD_BYTES = int(float(os.getenv("MAX_UPLOAD_MB", "50")) * 1024 * 1024)
+MULTIPART_OVERHEAD_BYTES = 64 * 1024 # Allowance for multipart boundaries and headers
+PDF_MAGIC = b"%PDF"
+
+
+MAX_BODY_BYTES = MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES
+
+
+def too_large_detail(max_bytes: int = MAX_UPLOAD_BYTES) -> str:
+    return f"PDF file is larger than the {max_bytes // (1024 * 1024)} MB limit."
+
+
+def content_length_too_large(content_length: Optional[str]) -> bool:
+    """ True when a declared request body is certainly over the upload limit. """
+    if not content_length or not content_length.isdigit():
+        return False # Unknown (e.g. chunked); enforced by UploadBodyLimit instead
+    return int(content_length) > MAX_BODY_BYTES
+
+
+class UploadBodyLimit:
+    """
+    ASGI middleware counting the body bytes of upload requests as they are received.
+    Once more than max_body_bytes have arrived the read fails with HTTPException 413,
+    so a chunked or under-declared upload is cut off instead of being spooled in full.
+    """
+
+    def __init__(self, app, paths, max_body_bytes: int = MAX_BODY_BYTES):
+        self.app = app
+        self.paths = frozenset(paths)
+        self.max_body_bytes = max_body_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_body_bytes:
+                    raise HTTPException(status_code=413, detail=too_large_detail())
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+async def save_pdf_upload(upload: UploadFile, dest_path: str, max_bytes: int = MAX_UPLOAD_BYTES) -> Tuple[str, int]:
+    """
+    Streams an uploaded PDF to dest_path. Returns (sha256 hex digest, size in bytes).
+    Raises HTTPException 400 for empty or non-PDF uploads and 413 when the upload
+    exceeds max_bytes; the partially written file is left for the caller to remove.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    head = b""
+    async with aiofiles.open(dest_path, "wb") as out_file:
+        while True:
+            chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_bytes:
+                raise HTTPException(status_code=413, detail=too_large_detail(max_bytes))
+            if len(head) < len(PDF_MAGIC):
+                head += chunk[:len(PDF_MAGIC) - len(head)]
+                if len(head) == len(PDF_MAGIC) and head != PDF_MAGIC:
+                    raise HTTPException(status_code=400, detail="Uploaded file is not a PDF.")
+            digest.update(chunk)
+            await out_file.write(chunk)
+    if size == 0:
+        raise HTTPException(status_code=400, detail="PDF file is empty.")
+    if head != PDF_MAGIC:
+        raise HTTPException(status_code=400, detail="Uploaded file is not a PDF.")
+    return digest.hexdigest(), size